@@ -0,0 +1,3 @@
+python -m src.run_convert_trajectories \
+    --trajectory_path trajectories/MiniGrid-Dynamic-Obstacles-8x8-v0bd60729d-dc0b-4294-9110-8d5f672aa82c.pkl \
+    --chunk_size 1024
@@ -0,0 +1,63 @@
+'''
+Benchmarks the GAE implementations of src.ppo.compute_adv_vectorized
+across rollout lengths T and numbers of environments.
+
+    python -m src.benchmarks.advantages --T 16 128 1024 --num_envs 4 64
+'''
+import argparse
+
+import torch as t
+
+from src.benchmarks.utils import print_table, time_function
+from src.ppo.compute_adv_vectorized import ADVANTAGE_METHODS
+
+
+def get_inputs(T, num_envs, device):
+    return (
+        t.rand(num_envs, device=device),
+        (t.rand(num_envs, device=device) < 0.05).float(),
+        t.rand((T, num_envs), device=device),
+        t.rand((T, num_envs), device=device),
+        (t.rand((T, num_envs), device=device) < 0.05).float(),
+        device,
+        0.99,
+        0.95,
+    )
+
+
+def run(Ts, num_envs, methods, repeats, device, max_vectorized_T):
+    rows = []
+    for T in Ts:
+        for n in num_envs:
+            inputs = get_inputs(T, n, device)
+            row = {"T": T, "num_envs": n}
+            for method in methods:
+                if method == "vectorized" and T > max_vectorized_T:
+                    # O(T^2) memory
+                    row[f"{method}_ms"] = "-"
+                    continue
+                row[f"{method}_ms"] = 1e3 * time_function(
+                    lambda: ADVANTAGE_METHODS[method](*inputs), repeats, device=device)
+            rows.append(row)
+            print_table(rows[-1:], list(row))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Advantage Benchmark",
+        description="Times the loop, vectorized and scan implementations of GAE.")
+    parser.add_argument("--T", type=int, nargs="+", default=[8, 32, 128, 512, 2048])
+    parser.add_argument("--num_envs", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--methods", type=str, nargs="+", default=list(ADVANTAGE_METHODS),
+                        choices=list(ADVANTAGE_METHODS))
+    parser.add_argument("--max_vectorized_T", type=int, default=1024,
+                        help="Longer rollouts are not run with the O(T^2) vectorized form")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--device", type=str, default="cuda" if t.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    rows = run(args.T, args.num_envs, args.methods, args.repeats, args.device,
+               args.max_vectorized_T)
+    print()
+    print_table(rows, list(rows[0]))
@@ -0,0 +1,98 @@
+'''
+Benchmarks the per step overhead of the context windows of
+TrajPPOAgent.rollout (appending a step, resetting the windows of the envs
+whose episodes ended and getting the windows) against the number of envs,
+with three ways of resetting:
+
+    - loop: the original loop over the envs, writing the windows of each
+        env that is done separately
+    - masked: masked fills of the whole buffers
+    - indexed: RolloutContext.reset, indexed fills of the rows of the envs
+        that are done, skipped on steps where none are
+
+    python -m src.benchmarks.context_reset --num_envs 8 64 256
+'''
+import argparse
+
+import numpy as np
+import torch as t
+
+from src.benchmarks.utils import print_table, time_function
+from src.rollout_context import RolloutContext
+
+
+def reset_loop(context, mask, obs):
+    obss, acts, _, timesteps = context.get()
+    for i, d in enumerate(mask):
+        if d:
+            obss[i, -1] = obs[i]
+            obss[i, :-1] = 0
+            if acts is not None:
+                acts[i] = context.action_pad_token
+            timesteps[i] = 0
+
+
+def reset_masked(context, mask, obs):
+    mask = t.as_tensor(mask, device=context.obs.device)
+
+    def expand(buffer):
+        return mask.view(-1, *[1] * (buffer.ndim - 1))
+
+    context.obs.masked_fill_(expand(context.obs), 0)
+    context.actions.masked_fill_(expand(context.actions), context.action_pad_token)
+    context.rtg.masked_fill_(expand(context.rtg), 0)
+    context.timesteps.masked_fill_(expand(context.timesteps), 0)
+    context.write_slot(context.obs, obs)
+
+
+RESETS = {
+    "loop": reset_loop,
+    "masked": reset_masked,
+    "indexed": RolloutContext.reset,
+}
+
+
+def run(num_envs, obs_timesteps, obs_shape, done_prob, steps, repeats, device):
+    rows = []
+    for n in num_envs:
+        generator = np.random.default_rng(0)
+        masks = generator.random((steps, n)) < done_prob
+        observations = t.rand((steps, n, *obs_shape), device=device)
+        actions = t.randint(0, 3, (steps, n), device=device)
+
+        row = {"num_envs": n}
+        for name, reset in RESETS.items():
+            context = RolloutContext(n, obs_timesteps, obs_shape, action_pad_token=3, device=device)
+            context.start(observations[0], padded=True)
+
+            def rollout():
+                for step in range(steps):
+                    context.append(observations[step], actions[step])
+                    reset(context, masks[step], observations[step])
+                    context.get()
+
+            row[f"{name}_us_per_step"] = 1e6 * time_function(
+                rollout, repeats, device=device) / steps
+        rows.append(row)
+        print_table(rows[-1:], list(row))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Context Reset Benchmark",
+        description="Times the context window updates of trajectory PPO rollouts.")
+    parser.add_argument("--num_envs", type=int, nargs="+", default=[4, 16, 64, 256])
+    parser.add_argument("--obs_timesteps", type=int, default=5)
+    parser.add_argument("--obs_shape", type=int, nargs="+", default=[7, 7, 3])
+    parser.add_argument("--done_prob", type=float, default=0.02,
+                        help="The probability of an episode ending at each step")
+    parser.add_argument("--steps", type=int, default=128)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", type=str, default="cuda" if t.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    rows = run(args.num_envs, args.obs_timesteps, tuple(args.obs_shape), args.done_prob,
+               args.steps, args.repeats, args.device)
+    print()
+    print_table(rows, list(rows[0]))
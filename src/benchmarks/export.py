@@ -0,0 +1,62 @@
+'''
+Benchmarks the latency of a DecisionTransformer's action predictions at
+small batch sizes, eager against exported to TorchScript (see
+src/decision_transformer/export.py).
+
+    python -m src.benchmarks.export --batch_size 1 8 --n_ctx 2 26
+'''
+import argparse
+
+import torch as t
+
+from src.benchmarks.utils import print_table, time_function
+from src.config import EnvironmentConfig, TransformerModelConfig
+from src.decision_transformer.export import (export_decision_transformer,
+                                             get_context_length,
+                                             get_example_inputs)
+from src.models.trajectory_model import DecisionTransformer
+
+
+def run(env_id, batch_sizes, n_ctxs, d_model, n_layers, repeats, device):
+    environment_config = EnvironmentConfig(env_id=env_id, max_steps=1000, device=device)
+    rows = []
+    for n_ctx in n_ctxs:
+        t.manual_seed(0)
+        model = DecisionTransformer(environment_config, TransformerModelConfig(
+            d_model=d_model, n_heads=4, d_mlp=4 * d_model, n_layers=n_layers, n_ctx=n_ctx,
+            device=str(device))).to(device).eval()
+        context_length = get_context_length(model)
+        for batch_size in batch_sizes:
+            states, actions, rtgs, timesteps = get_example_inputs(
+                model, batch_size, context_length)
+            actions = actions if context_length > 1 else None
+            exported = export_decision_transformer(model, batch_size)
+
+            row = {"n_ctx": n_ctx, "batch_size": batch_size}
+            with t.no_grad():
+                for name, predict in [("eager", model), ("exported", exported)]:
+                    row[f"{name}_us"] = 1e6 * time_function(
+                        lambda: predict(states, actions, rtgs, timesteps), repeats, device=device)
+            row["speedup"] = row["eager_us"] / row["exported_us"]
+            rows.append(row)
+            print_table(rows[-1:], list(row))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Export Benchmark",
+        description="Times eager and exported decision transformer action predictions.")
+    parser.add_argument("--env_id", type=str, default="MiniGrid-Dynamic-Obstacles-8x8-v0")
+    parser.add_argument("--batch_size", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--n_ctx", type=int, nargs="+", default=[2, 26])
+    parser.add_argument("--d_model", type=int, default=128)
+    parser.add_argument("--n_layers", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=50)
+    parser.add_argument("--device", type=str, default="cuda" if t.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    rows = run(args.env_id, args.batch_size, args.n_ctx, args.d_model, args.n_layers,
+               args.repeats, t.device(args.device))
+    print()
+    print_table(rows, list(rows[0]))
@@ -0,0 +1,80 @@
+'''
+Benchmarks the training and inference throughput of a DecisionTransformer,
+in sequences per second, running the HookedTransformer with its hook points
+and on the fast path (see TrajectoryTransformer.run_transformer).
+
+    python -m src.benchmarks.fast_path --d_model 128 256 --batch_size 128
+'''
+import argparse
+
+import torch as t
+from torch import nn
+
+from src.benchmarks.precision import get_batch
+from src.benchmarks.utils import print_table, time_function
+from src.config import EnvironmentConfig, TransformerModelConfig
+from src.models.trajectory_model import DecisionTransformer
+
+
+def run(env_id, d_models, n_layers, n_ctx, batch_size, repeats, device):
+    environment_config = EnvironmentConfig(env_id=env_id, max_steps=1000, device=device)
+    loss_fn = nn.CrossEntropyLoss()
+    rows = []
+    for d_model in d_models:
+        t.manual_seed(0)
+        model = DecisionTransformer(environment_config, TransformerModelConfig(
+            d_model=d_model, n_heads=4, d_mlp=4 * d_model, n_layers=n_layers, n_ctx=n_ctx,
+            device=str(device))).to(device)
+        optimizer = t.optim.AdamW(model.parameters(), lr=1e-4)
+        states, actions, rtgs, timesteps = get_batch(model, batch_size, device)
+
+        def forward():
+            _, action_preds, _ = model(
+                states=states, actions=actions[:, :-1].unsqueeze(-1),
+                rtgs=rtgs, timesteps=timesteps)
+            return action_preds
+
+        def train_step():
+            optimizer.zero_grad()
+            loss = loss_fn(forward().flatten(0, 1), actions.flatten())
+            loss.backward()
+            optimizer.step()
+
+        def inference():
+            with t.inference_mode():
+                forward()
+
+        row = {"d_model": d_model}
+        for name, fast_path in [("hooked", False), ("fast", True)]:
+            model.fast_path = fast_path
+            model.train()
+            row[f"{name}_train_seq_per_s"] = batch_size / time_function(
+                train_step, repeats, device=device)
+            model.eval()
+            row[f"{name}_inference_seq_per_s"] = batch_size / time_function(
+                inference, repeats, device=device)
+        for phase in ["train", "inference"]:
+            row[f"{phase}_speedup"] = row[f"fast_{phase}_seq_per_s"] / \
+                row[f"hooked_{phase}_seq_per_s"]
+        rows.append(row)
+        print_table(rows[-1:], list(row))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Fast Path Benchmark",
+        description="Times decision transformer training and inference with and without hooks.")
+    parser.add_argument("--env_id", type=str, default="MiniGrid-Dynamic-Obstacles-8x8-v0")
+    parser.add_argument("--d_model", type=int, nargs="+", default=[64, 128, 256])
+    parser.add_argument("--n_layers", type=int, default=2)
+    parser.add_argument("--n_ctx", type=int, default=26)
+    parser.add_argument("--batch_size", type=int, default=128)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--device", type=str, default="cuda" if t.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    rows = run(args.env_id, args.d_model, args.n_layers, args.n_ctx, args.batch_size,
+               args.repeats, t.device(args.device))
+    print()
+    print_table(rows, list(rows[0]))
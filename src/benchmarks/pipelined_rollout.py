@@ -0,0 +1,93 @@
+'''
+Benchmarks PPO rollouts, in environment steps per second, with and without
+pipelining (the policy acting for half of the envs while the other half
+steps) for every vector env backend.
+
+    python -m src.benchmarks.pipelined_rollout --num_envs 8 32 --vector_envs sync async
+'''
+import argparse
+import time
+
+import torch as t
+
+from src.benchmarks.utils import print_table
+from src.config import EnvironmentConfig, OnlineTrainConfig, TransformerModelConfig
+from src.environments.environments import VECTOR_ENVS, make_env, make_vector_env
+from src.ppo.agent import FCAgent, TrajPPOAgent
+from src.ppo.memory import Memory
+
+
+def get_agent(agent, envs, environment_config, device):
+    if agent == "fc":
+        return FCAgent(envs, device=device)
+    return TrajPPOAgent(
+        envs, environment_config,
+        TransformerModelConfig(n_ctx=5, d_model=64, n_layers=1, n_heads=2, d_mlp=128),
+        device=device)
+
+
+def steps_per_second(agent, envs, online_config, device, repeats):
+    '''
+    Times repeats rollouts of num_steps, after a warmup rollout, and returns
+    the environment steps per second, counting every environment.
+    '''
+    memory = Memory(envs, online_config, device)
+    agent.rollout(memory, online_config.num_steps, envs)
+    memory.reset()
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        agent.rollout(memory, online_config.num_steps, envs)
+        memory.reset()
+    return repeats * online_config.batch_size / (time.perf_counter() - start)
+
+
+def run(env_id, agent_type, vector_envs, num_envs, num_steps, max_steps, repeats, device):
+    environment_config = EnvironmentConfig(env_id=env_id, max_steps=max_steps, device=device)
+    rows = []
+    for n in num_envs:
+        online_config = OnlineTrainConfig(num_envs=n, num_steps=num_steps)
+        row = {"num_envs": n}
+        for vector_env in vector_envs:
+            for pipelined in [False, True]:
+                envs = make_vector_env([make_env(
+                    env_id=env_id,
+                    seed=i,
+                    idx=i,
+                    capture_video=False,
+                    run_name="benchmark",
+                    max_steps=max_steps,
+                ) for i in range(n)], vector_env=vector_env, pipelined=pipelined)
+                t.manual_seed(0)
+                agent = get_agent(agent_type, envs, environment_config, device)
+                name = f"{vector_env}_pipelined" if pipelined else vector_env
+                row[f"{name}_steps_per_s"] = steps_per_second(
+                    agent, envs, online_config, device, repeats)
+                envs.close()
+            row[f"{vector_env}_speedup"] = row[f"{vector_env}_pipelined_steps_per_s"] / \
+                row[f"{vector_env}_steps_per_s"]
+        rows.append(row)
+        print_table(rows[-1:], list(row))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Pipelined Rollout Benchmark",
+        description="Times PPO rollouts with and without pipelining.")
+    parser.add_argument("--env_id", type=str, default="MiniGrid-Dynamic-Obstacles-8x8-v0")
+    parser.add_argument("--agent", type=str, default="fc", choices=["fc", "traj"])
+    parser.add_argument("--vector_envs", type=str, nargs="+", default=VECTOR_ENVS,
+                        choices=VECTOR_ENVS)
+    parser.add_argument("--num_envs", type=int, nargs="+", default=[4, 16, 32])
+    parser.add_argument("--num_steps", type=int, default=128)
+    parser.add_argument("--max_steps", type=int, default=1000,
+                        help="Long enough that trajectory agents never see more timesteps")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--device", type=str, default="cuda" if t.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    rows = run(args.env_id, args.agent, args.vector_envs, args.num_envs, args.num_steps,
+               args.max_steps, args.repeats, t.device(args.device))
+    print()
+    print_table(rows, list(rows[0]))
@@ -0,0 +1,92 @@
+'''
+Benchmarks the rollout and learn throughput of TrajPPOAgent with separate
+actor and critic transformers against a single shared trunk
+(TransformerModelConfig.shared_trunk), in environment steps per second.
+
+    python -m src.benchmarks.shared_trunk --num_envs 8 32 --n_ctx 3 9
+'''
+import argparse
+import time
+
+import torch as t
+
+from src.benchmarks.utils import print_table
+from src.config import EnvironmentConfig, OnlineTrainConfig, TransformerModelConfig
+from src.environments.environments import make_env, make_vector_env
+from src.ppo.agent import TrajPPOAgent
+from src.ppo.memory import Memory
+
+
+def steps_per_second(agent, envs, online_config, device, repeats):
+    '''
+    Times repeats rollouts and learning phases, after a warmup one, and
+    returns the environment steps per second of each.
+    '''
+    memory = Memory(envs, online_config, device)
+    optimizer, scheduler = agent.make_optimizer(
+        repeats + 1, online_config.learning_rate, online_config.learning_rate)
+    rollout_time = learn_time = 0
+    for repeat in range(repeats + 1):
+        start = time.perf_counter()
+        agent.rollout(memory, online_config.num_steps, envs)
+        middle = time.perf_counter()
+        agent.learn(memory, online_config, optimizer, scheduler, track=False)
+        end = time.perf_counter()
+        memory.reset()
+        if repeat > 0:
+            rollout_time += middle - start
+            learn_time += end - middle
+    steps = repeats * online_config.batch_size
+    return steps / rollout_time, steps / learn_time
+
+
+def run(env_id, num_envs, n_ctxs, d_model, n_layers, num_steps, repeats, device):
+    environment_config = EnvironmentConfig(env_id=env_id, max_steps=1000, device=device)
+    rows = []
+    for n_ctx in n_ctxs:
+        for n in num_envs:
+            online_config = OnlineTrainConfig(num_envs=n, num_steps=num_steps, update_epochs=1)
+            row = {"n_ctx": n_ctx, "num_envs": n}
+            for shared_trunk in [False, True]:
+                envs = make_vector_env([make_env(
+                    env_id=env_id,
+                    seed=i,
+                    idx=i,
+                    capture_video=False,
+                    run_name="benchmark",
+                    max_steps=1000,
+                ) for i in range(n)])
+                t.manual_seed(0)
+                agent = TrajPPOAgent(envs, environment_config, TransformerModelConfig(
+                    n_ctx=n_ctx, d_model=d_model, n_layers=n_layers, n_heads=2,
+                    d_mlp=2 * d_model, shared_trunk=shared_trunk), device=device)
+                name = "shared" if shared_trunk else "separate"
+                row[f"{name}_rollout_steps_per_s"], row[f"{name}_learn_steps_per_s"] = \
+                    steps_per_second(agent, envs, online_config, device, repeats)
+                envs.close()
+            for phase in ["rollout", "learn"]:
+                row[f"{phase}_speedup"] = row[f"shared_{phase}_steps_per_s"] / \
+                    row[f"separate_{phase}_steps_per_s"]
+            rows.append(row)
+            print_table(rows[-1:], list(row))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Shared Trunk Benchmark",
+        description="Times trajectory PPO with separate and shared actor-critic transformers.")
+    parser.add_argument("--env_id", type=str, default="MiniGrid-Dynamic-Obstacles-8x8-v0")
+    parser.add_argument("--num_envs", type=int, nargs="+", default=[8, 32])
+    parser.add_argument("--n_ctx", type=int, nargs="+", default=[3, 9])
+    parser.add_argument("--d_model", type=int, default=128)
+    parser.add_argument("--n_layers", type=int, default=2)
+    parser.add_argument("--num_steps", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--device", type=str, default="cuda" if t.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    rows = run(args.env_id, args.num_envs, args.n_ctx, args.d_model, args.n_layers,
+               args.num_steps, args.repeats, t.device(args.device))
+    print()
+    print_table(rows, list(rows[0]))
@@ -0,0 +1,143 @@
+'''
+Benchmarks the token interleaving of the trajectory transformers against
+the previous implementation, which filled a zero tensor with one strided
+write per token type and concatenated an extra row in get_logits.
+
+    python -m src.benchmarks.token_embeddings --batch_sizes 64 4096
+'''
+import argparse
+import types
+
+import torch as t
+
+from src.benchmarks.utils import print_table, time_function
+from src.config import EnvironmentConfig, TransformerModelConfig
+from src.models.trajectory_model import CloneTransformer, DecisionTransformer
+
+
+def reference_decision_transformer_tokens(self, state_embeddings, time_embeddings,
+                                          reward_embeddings, action_embeddings=None, targets=None):
+    batches, timesteps = state_embeddings.shape[0], time_embeddings.shape[1]
+    reward_embeddings = reward_embeddings + time_embeddings
+    state_embeddings = state_embeddings + time_embeddings
+    action_embeddings = action_embeddings + time_embeddings[:, :action_embeddings.shape[1]]
+    trajectory_length = timesteps * 3 - (action_embeddings.shape[1] < timesteps)
+
+    token_embeddings = t.zeros(
+        (batches, trajectory_length, self.transformer_config.d_model),
+        dtype=t.float32, device=state_embeddings.device)
+    token_embeddings[:, ::3, :] = reward_embeddings
+    token_embeddings[:, 1::3, :] = state_embeddings
+    token_embeddings[:, 2::3, :] = action_embeddings
+    return token_embeddings
+
+
+def reference_decision_transformer_logits(self, x, batch_size, seq_length, no_actions):
+    if (x.shape[1] % 3 != 0) and ((x.shape[1] + 1) % 3 == 0):
+        x = t.concat((x, x[:, -2].unsqueeze(1)), dim=1)
+    x = x.reshape(batch_size, seq_length, 3, self.transformer_config.d_model)
+    x = x.permute(0, 2, 1, 3)
+    return self.predict_states(x[:, 2]), self.predict_actions(x[:, 1]), self.predict_rewards(x[:, 2])
+
+
+def reference_clone_transformer_tokens(self, state_embeddings, time_embeddings, action_embeddings=None):
+    batches, timesteps = state_embeddings.shape[0], time_embeddings.shape[1]
+    state_embeddings = state_embeddings + time_embeddings
+    if action_embeddings.shape[1] == timesteps - 1:
+        action_embeddings = action_embeddings + time_embeddings[:, :-1]
+        action_embeddings = t.cat(
+            [action_embeddings, action_embeddings[:, -1, :].unsqueeze(1)], dim=1)
+    else:
+        action_embeddings = action_embeddings + time_embeddings
+
+    token_embeddings = t.zeros(
+        (batches, timesteps * 2, self.transformer_config.d_model),
+        dtype=t.float32, device=state_embeddings.device)
+    token_embeddings[:, 0::2, :] = state_embeddings
+    token_embeddings[:, 1::2, :] = action_embeddings
+    return token_embeddings
+
+
+def get_model(model_type, n_ctx, d_model, device):
+    transformer_config = TransformerModelConfig(
+        d_model=d_model, n_heads=4, d_mlp=4 * d_model, n_layers=1,
+        n_ctx=n_ctx, device=device)
+    model_class = DecisionTransformer if model_type == "decision_transformer" else CloneTransformer
+    return model_class(
+        transformer_config=transformer_config,
+        environment_config=EnvironmentConfig()).to(device).eval()
+
+
+def get_inputs(model_type, n_ctx, batch_size, device):
+    # full context, the last timestep without an action
+    timesteps = n_ctx // 3 + 1 if model_type == "decision_transformer" else (n_ctx + 1) // 2
+    states = t.rand((batch_size, timesteps, 7, 7, 3), device=device)
+    actions = t.randint(0, 3, (batch_size, timesteps - 1, 1), device=device)
+    rtgs = t.rand((batch_size, timesteps, 1), device=device)
+    times = t.randint(0, 100, (batch_size, timesteps, 1), device=device)
+    if model_type == "decision_transformer":
+        return (states, actions, rtgs, times)
+    return (states, actions, times)
+
+
+def use_reference(model):
+    if isinstance(model, DecisionTransformer):
+        model.get_token_embeddings = types.MethodType(reference_decision_transformer_tokens, model)
+        model.get_logits = types.MethodType(reference_decision_transformer_logits, model)
+    else:
+        model.get_token_embeddings = types.MethodType(reference_clone_transformer_tokens, model)
+
+
+def run(model_types, n_ctxs, batch_sizes, d_model, repeats, device, stage="forward"):
+    rows = []
+    for model_type in model_types:
+        for n_ctx in n_ctxs[model_type]:
+            for batch_size in batch_sizes:
+                inputs = get_inputs(model_type, n_ctx, batch_size, device)
+                model = get_model(model_type, n_ctx, d_model, device)
+                reference = get_model(model_type, n_ctx, d_model, device)
+                use_reference(reference)
+
+                # the whole forward pass or only embedding and interleaving
+                def call(m):
+                    return m(*inputs) if stage == "forward" else m.to_tokens(*inputs)
+
+                row = {"model": model_type, "n_ctx": n_ctx, "batch": batch_size}
+                with t.no_grad():
+                    row["reference_ms"] = 1e3 * time_function(
+                        lambda: call(reference), repeats, device=device)
+                    row["stack_ms"] = 1e3 * time_function(
+                        lambda: call(model), repeats, device=device)
+                    model.reuse_token_buffer = True
+                    row["buffer_ms"] = 1e3 * time_function(
+                        lambda: call(model), repeats, device=device)
+                row["speedup"] = row["reference_ms"] / min(row["stack_ms"], row["buffer_ms"])
+                rows.append(row)
+                print_table(rows[-1:], list(row))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Token Embedding Benchmark",
+        description="Times forward passes with the stacked token interleaving against the previous implementation.")
+    parser.add_argument("--model_types", type=str, nargs="+",
+                        default=["decision_transformer", "clone_transformer"])
+    parser.add_argument("--dt_n_ctx", type=int, nargs="+", default=[5, 26, 62, 89],
+                        help="Context sizes for decision transformers (3k + 2)")
+    parser.add_argument("--clone_n_ctx", type=int, nargs="+", default=[3, 27, 63, 89],
+                        help="Context sizes for clone transformers (odd)")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 64, 512, 4096])
+    parser.add_argument("--stage", type=str, default="forward", choices=["forward", "tokens"],
+                        help="Time the whole forward pass or only to_tokens")
+    parser.add_argument("--d_model", type=int, default=128)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--device", type=str, default="cuda" if t.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    rows = run(
+        args.model_types,
+        {"decision_transformer": args.dt_n_ctx, "clone_transformer": args.clone_n_ctx},
+        args.batch_sizes, args.d_model, args.repeats, args.device, args.stage)
+    print()
+    print_table(rows, list(rows[0]))
@@ -0,0 +1,41 @@
+'''
+Shared helpers for the benchmarks in this package. Every benchmark is a
+module that can be run with python -m src.benchmarks.<name>.
+'''
+import time
+
+import numpy as np
+import torch as t
+
+
+def time_function(function, repeats=10, warmup=2, device="cpu"):
+    '''
+    Returns the median wall time of function() in seconds, synchronizing
+    with the GPU around every call when benchmarking on cuda.
+    '''
+    def synchronize():
+        if t.device(device).type == "cuda":
+            t.cuda.synchronize()
+
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeats):
+        synchronize()
+        start = time.perf_counter()
+        function()
+        synchronize()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def print_table(rows, columns):
+    '''
+    Prints a list of dictionaries as an aligned table with the given columns.
+    '''
+    cells = [[str(column) for column in columns]] + [
+        [f"{row[column]:.4g}" if isinstance(row[column], float) else str(row[column])
+         for column in columns] for row in rows]
+    widths = [max(len(line[i]) for line in cells) for i in range(len(columns))]
+    for line in cells:
+        print("  ".join(cell.rjust(width) for cell, width in zip(line, widths)))
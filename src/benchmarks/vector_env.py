@@ -0,0 +1,72 @@
+'''
+Benchmarks the throughput of the vector env backends of make_vector_env,
+in environment steps per second, against the number of environments.
+
+    python -m src.benchmarks.vector_env --num_envs 4 16 64
+'''
+import argparse
+import time
+
+from src.benchmarks.utils import print_table
+from src.environments.environments import VECTOR_ENVS, make_env, make_vector_env
+
+
+def steps_per_second(envs, steps, warmup=10):
+    '''
+    Steps envs with random actions and returns the environment steps per
+    second, counting every environment of the batch.
+    '''
+    envs.reset(seed=0)
+    envs.action_space.seed(0)
+    actions = [envs.action_space.sample() for _ in range(warmup + steps)]
+    for action in actions[:warmup]:
+        envs.step(action)
+
+    start = time.perf_counter()
+    for action in actions[warmup:]:
+        envs.step(action)
+    return steps * envs.num_envs / (time.perf_counter() - start)
+
+
+def run(env_id, vector_envs, num_envs, steps, max_steps, view_size):
+    rows = []
+    for n in num_envs:
+        row = {"num_envs": n}
+        for vector_env in vector_envs:
+            envs = make_vector_env([make_env(
+                env_id=env_id,
+                seed=i,
+                idx=i,
+                capture_video=False,
+                run_name="benchmark",
+                max_steps=max_steps,
+                agent_view_size=view_size,
+            ) for i in range(n)], vector_env=vector_env)
+            row[f"{vector_env}_steps_per_s"] = steps_per_second(envs, steps)
+            envs.close()
+        for vector_env in vector_envs[1:]:
+            row[f"{vector_env}_speedup"] = row[f"{vector_env}_steps_per_s"] / \
+                row[f"{vector_envs[0]}_steps_per_s"]
+        rows.append(row)
+        print_table(rows[-1:], list(row))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Vector Env Benchmark",
+        description="Times random rollouts with every vector env backend.")
+    parser.add_argument("--env_id", type=str, default="MiniGrid-Dynamic-Obstacles-8x8-v0")
+    parser.add_argument("--vector_envs", type=str, nargs="+", default=VECTOR_ENVS,
+                        choices=VECTOR_ENVS, help="The first one is the baseline for the speedups")
+    parser.add_argument("--num_envs", type=int, nargs="+", default=[1, 4, 16, 32, 64])
+    parser.add_argument("--steps", type=int, default=200,
+                        help="Steps of the vector env per measurement")
+    parser.add_argument("--max_steps", type=int, default=100)
+    parser.add_argument("--view_size", type=int, default=7)
+    args = parser.parse_args()
+
+    rows = run(args.env_id, args.vector_envs, args.num_envs,
+               args.steps, args.max_steps, args.view_size)
+    print()
+    print_table(rows, list(rows[0]))
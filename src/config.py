@@ -28,6 +28,11 @@ class TransformerModelConfig():
     time_embedding_type: str = 'embedding'
     seed: int = 1
     device: str = 'cpu'
+    # run the transformer without its hook points, see TrajectoryTransformer.run_transformer
+    fast_path: bool = False
+    # trajectory PPO only: one trunk for the actor and critic
+    shared_trunk: bool = False
+    value_trunk_weight: float = 1.0
 
     def __post_init__(self):
         assert self.d_model % self.n_heads == 0
@@ -53,9 +58,12 @@ class EnvironmentConfig():
     action_space: None = None
     observation_space: None = None
     device: str = 'cpu'
+    vector_env: str = 'sync'
 
     def __post_init__(self):
 
+        assert self.vector_env in ['sync', 'async', 'async_shared_memory']
+
         env = gym.make(self.env_id)
 
         if self.env_id.startswith('MiniGrid'):
@@ -94,6 +102,12 @@ class OfflineTrainConfig:
     model_type: str = 'decision_transformer'
     initial_rtg: list[float] = (0.0, 1.0)
     eval_max_time_steps: int = 100
+    eval_vector_env: str = 'sync'
+    num_workers: int = 0
+    prefetch_factor: int = 2
+    persistent_workers: bool = False
+    pin_memory: bool = False
+    precision: str = 'fp32'
 
     def __post__init__(self):
 
@@ -114,6 +128,7 @@ class OnlineTrainConfig:
     num_steps: int = 128
     gamma: float = 0.99
     gae_lambda: float = 0.95
+    advantage_method: str = 'auto'
     num_minibatches: int = 4
     update_epochs: int = 4
     clip_coef: float = 0.4
@@ -121,13 +136,30 @@ class OnlineTrainConfig:
     vf_coef: float = 0.5
     max_grad_norm: float = 2
     trajectory_path: str = None
+    stream_trajectories: bool = False
     fully_observed: bool = False
     prob_go_from_end: float = 0.0
+    pipelined_rollout: bool = False
+    num_workers: int = 0
+    max_policy_lag: int = 1
+    off_policy_correction: str = 'none'
+    importance_clip: float = 1.0
+    precision: str = 'fp32'
 
     def __post_init__(self):
         self.batch_size = int(self.num_envs * self.num_steps)
         self.minibatch_size = self.batch_size // self.num_minibatches
 
+        if self.pipelined_rollout:
+            assert self.num_envs >= 2, "A pipelined rollout needs at least two envs"
+
+        assert self.num_workers >= 0
+        if self.num_workers > 0:
+            assert self.num_envs % self.num_workers == 0, \
+                "num_envs must be divisible by num_workers"
+        assert self.off_policy_correction in ['none', 'ratio', 'vtrace']
+        assert self.precision in ['fp32', 'bf16']
+
         if self.trajectory_path is None:
             self.trajectory_path = os.path.join(
                 "trajectories", str(uuid.uuid4()) + ".gz")
@@ -154,18 +186,21 @@ class ConfigJsonEncoder(json.JSONEncoder):
 def parse_metadata_to_environment_config(metadata: dict):
     '''
     Parses the metadata dictionary from a loaded trajectory to an EnvironmentConfig object.
+    Settings that older trajectory files do not record fall back to the EnvironmentConfig defaults.
     '''
+    defaults = {
+        field.name: field.default for field in dataclasses.fields(EnvironmentConfig)}
 
     env_id = metadata['env_id']
-    one_hot_obs = metadata['one_hot_obs']
-    img_obs = metadata['img_obs']
-    fully_observed = metadata['fully_observed']
-    max_steps = metadata['max_steps']
-    seed = metadata['seed']
-    view_size = metadata['view_size']
-    capture_video = metadata['capture_video']
-    video_dir = metadata['video_dir']
-    render_mode = metadata['render_mode']
+    one_hot_obs = metadata.get('one_hot_obs', defaults['one_hot_obs'])
+    img_obs = metadata.get('img_obs', defaults['img_obs'])
+    fully_observed = metadata.get('fully_observed', defaults['fully_observed'])
+    max_steps = metadata.get('max_steps', defaults['max_steps'])
+    seed = metadata.get('seed', defaults['seed'])
+    view_size = metadata.get('view_size', defaults['view_size'])
+    capture_video = metadata.get('capture_video', defaults['capture_video'])
+    video_dir = metadata.get('video_dir', defaults['video_dir'])
+    render_mode = metadata.get('render_mode', defaults['render_mode'])
 
     return EnvironmentConfig(env_id=env_id, one_hot_obs=one_hot_obs,
                              img_obs=img_obs, fully_observed=fully_observed,
@@ -1,13 +1,36 @@
+import math
+from argparse import Namespace
+
 import pandas as pd
 import plotly.express as px
+import torch as t
 from tqdm import tqdm
 import numpy as np
 from .train import evaluate_dt_agent
+from .utils import get_max_len_from_model_type
+from src.environments.environments import make_vector_env
+from src.models.trajectory_model import DecisionTransformer, CloneTransformer
+from src.rollout_context import RolloutContext
 import plotly.graph_objects as go
 
 
 def calibration_statistics(dt, env_id, env_func, initial_rtg_range=np.linspace(-1, 1, 21), trajectories=100,
-                           num_envs=8):
+                           num_envs=8, batched=True, device="cpu", vector_env="sync"):
+    '''
+    Evaluates the model at every initial RTG in initial_rtg_range and returns
+    a list of evaluate_dt_agent statistics, one per initial RTG.
+
+    By default the whole grid is rolled out at once (see
+    batched_calibration_statistics). With batched=False evaluate_dt_agent is
+    run once per initial RTG instead. Either way the environments are
+    vectorized with vector_env, see make_vector_env.
+    '''
+    if batched:
+        return batched_calibration_statistics(
+            dt, env_func, initial_rtg_range=initial_rtg_range,
+            trajectories=trajectories, num_envs=num_envs, device=device,
+            vector_env=vector_env)
+
     statistics = []
     pbar = tqdm(initial_rtg_range, desc="initial_rtg")
     for initial_rtg in pbar:
@@ -20,11 +43,177 @@ def calibration_statistics(dt, env_id, env_func, initial_rtg_range=np.linspace(-
             initial_rtg=initial_rtg,
             trajectories=trajectories,
             use_tqdm=False,
-            num_envs=num_envs))
+            num_envs=num_envs,
+            device=device,
+            vector_env=vector_env))
         pbar.set_description(f"initial_rtg: {initial_rtg}")
     return statistics
 
 
+@t.no_grad()
+def batched_calibration_statistics(dt, env_func, initial_rtg_range=np.linspace(-1, 1, 21), trajectories=100,
+                                   num_envs=8, seed=0, device="cpu", use_tqdm=True, vector_env="sync"):
+    '''
+    Rolls out every initial RTG in initial_rtg_range in one batch of
+    len(initial_rtg_range) * num_envs environments, with a single forward
+    pass of the model and a single step of the vector env (see
+    make_vector_env) per step. Row r * num_envs + e of the batch plays env e
+    of initial RTG r.
+
+    Episodes are played in rounds of num_envs. Episode i is reset with
+    seed + i for every initial RTG, so all of them see the same starting
+    states, and envs that finish early idle (their steps are ignored) until
+    the round is over.
+
+    Returns a list with the same statistics as evaluate_dt_agent for every
+    initial RTG, with the episodes in the order they were seeded.
+    '''
+    dt.eval()
+
+    if not hasattr(dt, "transformer_config"):
+        dt.transformer_config = Namespace(
+            n_ctx=dt.n_ctx,
+            time_embedding_type=dt.time_embedding_type,
+        )
+
+    # there is no point in envs that never play an episode
+    num_envs = min(num_envs, trajectories)
+    n_rtgs = len(initial_rtg_range)
+    batch_size = n_rtgs * num_envs
+    envs = make_vector_env([env_func for _ in range(batch_size)], vector_env=vector_env)
+    initial_rtgs = t.tensor(
+        np.repeat(initial_rtg_range, num_envs), dtype=t.float32, device=device)
+    timestep_dtype = t.float32 if dt.transformer_config.time_embedding_type == "linear" else t.long
+
+    use_kv_cache = isinstance(dt, DecisionTransformer)
+    if not use_kv_cache:
+        max_len = get_max_len_from_model_type(
+            model_type="clone_transformer" if isinstance(
+                dt, CloneTransformer) else "decision_transformer",
+            n_ctx=dt.transformer_config.n_ctx,
+        )
+
+    n_terminated = np.zeros(n_rtgs, dtype=int)
+    n_truncated = np.zeros(n_rtgs, dtype=int)
+    n_positive = np.zeros(n_rtgs, dtype=int)
+    reward_total = np.zeros(n_rtgs)
+    # (round, env) for every initial RTG
+    n_rounds = math.ceil(trajectories / num_envs)
+    traj_lengths = np.zeros((n_rtgs, n_rounds, num_envs), dtype=int)
+    final_rewards = np.zeros((n_rtgs, n_rounds, num_envs))
+
+    context = None
+    pbar = tqdm(total=n_rtgs * trajectories, desc="Calibrating", disable=not use_tqdm)
+    for round_idx in range(n_rounds):
+        episodes = round_idx * num_envs + np.arange(num_envs)
+        active = np.tile(episodes < trajectories, n_rtgs)
+        seeds = np.tile(seed + episodes, n_rtgs)
+
+        obs, _ = envs.reset(seed=[int(env_seed) for env_seed in seeds])
+        obs = obs["image"]
+        if context is None and not use_kv_cache:
+            context = RolloutContext(
+                batch_size, max_len, obs.shape[1:], obs_dtype=t.from_numpy(obs).dtype,
+                timestep_dtype=timestep_dtype, device=device)
+
+        rtg = initial_rtgs.clone()
+        lengths = np.zeros(batch_size, dtype=int)
+        action_preds = predict_next_actions(
+            dt, t.tensor(obs).to(device), rtg,
+            t.zeros(batch_size, dtype=timestep_dtype, device=device),
+            context=context)
+
+        while True:
+            new_actions = t.argmax(action_preds, dim=-1)
+            new_obs, rewards, terminated, truncated, _ = envs.step(new_actions.cpu().numpy())
+            obs = new_obs["image"]
+            rewards = np.where(active, rewards, 0.0)
+            terminated = terminated & active
+            truncated = truncated & active
+            dones = terminated | truncated
+
+            # any truncation counts, as in evaluate_dt_agent
+            n_terminated += terminated.reshape(n_rtgs, num_envs).sum(axis=1)
+            n_truncated += truncated.reshape(n_rtgs, num_envs).sum(axis=1)
+            n_positive += (rewards > 0).reshape(n_rtgs, num_envs).sum(axis=1)
+            reward_total += rewards.reshape(n_rtgs, num_envs).sum(axis=1)
+
+            lengths += active
+            finished = dones.reshape(n_rtgs, num_envs)
+            traj_lengths[:, round_idx][finished] = lengths.reshape(n_rtgs, num_envs)[finished]
+            final_rewards[:, round_idx][finished] = rewards.reshape(n_rtgs, num_envs)[finished]
+            pbar.update(dones.sum())
+
+            active &= ~dones
+            if not active.any():
+                break
+
+            rtg = rtg - t.tensor(rewards, dtype=t.float32, device=device)
+            action_preds = predict_next_actions(
+                dt, t.tensor(obs).to(device), rtg,
+                t.tensor(lengths, dtype=timestep_dtype, device=device),
+                actions=new_actions, context=context)
+
+    pbar.close()
+    envs.close()
+
+    statistics = []
+    for r, initial_rtg in enumerate(initial_rtg_range):
+        # drop the idle envs of the last round
+        lengths = traj_lengths[r].reshape(-1)[:trajectories]
+        statistics.append({
+            "initial_rtg": initial_rtg,
+            "prop_completed": n_terminated[r] / trajectories,
+            "prop_truncated": n_truncated[r] / trajectories,
+            "mean_reward": reward_total[r] / trajectories,
+            "prop_positive_reward": n_positive[r] / trajectories,
+            "mean_traj_length": lengths.sum() / trajectories,
+            "traj_lengths": lengths.tolist(),
+            "rewards": final_rewards[r].reshape(-1)[:trajectories].tolist(),
+        })
+
+    return statistics
+
+
+def predict_next_actions(dt, obs, rtg, timesteps, actions=None, context=None):
+    '''
+    Predicts the next action of every row of a batched rollout from the new
+    obs (batch, ...), rtg (batch,) and timesteps (batch,) and the actions
+    (batch,) taken at the previous timestep, None at the first timestep.
+
+    Decision transformers decode incrementally from their key value cache.
+    Other models keep their context windows in context, a RolloutContext,
+    and run all of it through the model.
+    '''
+    if isinstance(dt, DecisionTransformer):
+        if actions is None:
+            dt.start_episode(batch_size=obs.shape[0])
+        else:
+            actions = actions.reshape(-1, 1, 1)
+        return dt.predict_next_action(
+            states=obs.unsqueeze(1), rtgs=rtg.reshape(-1, 1, 1),
+            timesteps=timesteps.reshape(-1, 1, 1), actions=actions)
+
+    if actions is None:
+        context.start(obs, rtg=rtg.reshape(-1, 1), timesteps=timesteps.reshape(-1, 1))
+    else:
+        context.append(obs, action=actions, rtg=rtg.reshape(-1, 1),
+                       timesteps=timesteps.reshape(-1, 1))
+    obs, actions, rtg, timesteps = context.get()
+
+    if isinstance(dt, CloneTransformer):
+        state_preds, action_preds = dt.forward(
+            states=obs, actions=actions, timesteps=timesteps)
+    else:  # it's probably a legacy model in which case the interface is:
+        steps = min(dt.transformer_config.n_ctx // 3, obs.shape[1])
+        state_preds, action_preds, reward_preds = dt.forward(
+            states=obs[:, -steps:], actions=context.get_previous_actions(steps),
+            rtgs=rtg[:, -steps:], timesteps=timesteps[:, -steps:])
+
+    # the action is predicted from the last state
+    return action_preds[:, -1]
+
+
 def plot_calibration_statistics(statistics, show_spread=False, CI=0.95):
 
     df = pd.DataFrame(statistics)
@@ -0,0 +1,215 @@
+'''
+Exports trained decision transformers to TorchScript for low latency
+inference.
+
+At small batch sizes the forward pass of a decision transformer is dominated
+by Python: einops rearranges, branching on the configuration and the hook
+points of the HookedTransformer. export_decision_transformer traces the
+forward pass for one fixed (batch size, context length), with every hook
+removed, and freezes the trace into a graph of tensor operations.
+
+    exported = export_decision_transformer(model, batch_size=8)
+    _, action_preds, _ = exported(states, actions, rtgs, timesteps)
+    exported.save("model.ts")
+    exported = load_exported_decision_transformer("model.ts", model)
+
+The outputs of the exported model are checked against the eager model when
+it is exported and when it is loaded. Both the decision transformers of
+src.models.trajectory_model and legacy ones can be exported.
+'''
+import contextlib
+import json
+import warnings
+from collections import OrderedDict
+
+import torch as t
+from torch import nn
+
+from src.models.trajectory_model import DecisionTransformer
+
+from .model import DecisionTransformer as DecisionTransformerLegacy
+
+
+class ActionPredictor(nn.Module):
+    '''
+    The function that is traced: a decision transformer's action predictions
+    (batch, context length, n_actions). Actions with no timesteps stand for
+    None, the first timestep of an episode.
+    '''
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, states, actions, rtgs, timesteps):
+        actions = actions if actions.shape[1] > 0 else None
+        return self.model(states, actions, rtgs, timesteps)[1]
+
+
+class ExportedDecisionTransformer(nn.Module):
+    '''
+    A decision transformer traced to TorchScript for inputs of one batch
+    size and context length, see export_decision_transformer. Its forward
+    has the interface of DecisionTransformer.forward, but only predicts
+    actions.
+    '''
+
+    def __init__(self, module, model, batch_size: int, context_length: int):
+        super().__init__()
+        self.module = module
+        self.batch_size = batch_size
+        self.context_length = context_length
+        self.legacy = isinstance(model, DecisionTransformerLegacy)
+        if not self.legacy:
+            self.transformer_config = model.transformer_config
+            self.environment_config = model.environment_config
+
+    def forward(self, states, actions, rtgs, timesteps):
+        if tuple(states.shape[:2]) != (self.batch_size, self.context_length):
+            raise ValueError(
+                f"The model was exported for a batch size of {self.batch_size} and "
+                f"{self.context_length} timesteps of context, got {tuple(states.shape[:2])}")
+        if actions is None:
+            actions = t.zeros((self.batch_size, 0, 1), dtype=t.long, device=states.device)
+        return None, self.module(states, actions, rtgs, timesteps), None
+
+    def save(self, path):
+        '''Saves the TorchScript module, see load_exported_decision_transformer.'''
+        metadata = {"batch_size": self.batch_size, "context_length": self.context_length}
+        t.jit.save(self.module, path, _extra_files={"metadata.json": json.dumps(metadata)})
+
+
+def get_context_length(model):
+    '''The most timesteps a decision transformer's context window holds.'''
+    if isinstance(model, DecisionTransformerLegacy):
+        return model.n_ctx // 3
+    return (model.transformer_config.n_ctx + 1) // 3
+
+
+def get_example_inputs(model, batch_size: int, context_length: int, seed: int = 0):
+    '''
+    Returns random (states, actions, rtgs, timesteps) of the given shape,
+    in the format of the model. Actions have context_length - 1 timesteps
+    (context_length for legacy models, which predict from every timestep).
+    '''
+    if isinstance(model, DecisionTransformerLegacy):
+        observation_space, action_space = model.env.observation_space, model.env.action_space
+        max_timestep, linear_time = model.max_timestep, model.time_embedding_type == "linear"
+        n_actions = context_length
+    else:
+        observation_space = model.environment_config.observation_space
+        action_space = model.environment_config.action_space
+        max_timestep = model.environment_config.max_steps
+        linear_time = model.transformer_config.time_embedding_type == "linear"
+        n_actions = context_length - 1
+    obs_shape = observation_space["image"].shape \
+        if "image" in getattr(observation_space, "spaces", {}) else observation_space.shape
+    device = next(model.parameters()).device
+
+    generator = t.Generator().manual_seed(seed)
+    states = t.randint(0, 10, (batch_size, context_length, *obs_shape), generator=generator)
+    actions = t.randint(0, action_space.n, (batch_size, n_actions, 1), generator=generator)
+    rtgs = t.rand((batch_size, context_length, 1), generator=generator)
+    start = t.randint(0, max(max_timestep - context_length, 0) + 1, (batch_size, 1, 1),
+                      generator=generator)
+    timesteps = start + t.arange(context_length).view(1, -1, 1)
+    if linear_time:
+        timesteps = timesteps.to(t.float32)
+    return tuple(x.to(device) for x in (states.to(t.float32), actions, rtgs, timesteps))
+
+
+@contextlib.contextmanager
+def hooks_removed(model: nn.Module):
+    '''
+    Removes the forward hooks of every module of the model (such as those of
+    transformer_lens hook points) and restores them on exit.
+    '''
+    modules = list(model.modules())
+    hooks = [(module._forward_pre_hooks, module._forward_hooks) for module in modules]
+    for module in modules:
+        module._forward_pre_hooks, module._forward_hooks = OrderedDict(), OrderedDict()
+    try:
+        yield
+    finally:
+        for module, (pre_hooks, forward_hooks) in zip(modules, hooks):
+            module._forward_pre_hooks, module._forward_hooks = pre_hooks, forward_hooks
+
+
+def check_exported_model(exported: ExportedDecisionTransformer, model,
+                         inputs=None, atol: float = 1e-4, rtol: float = 1e-4):
+    '''
+    Raises a ValueError if the action predictions of the exported model
+    differ from those of the eager model, on the given inputs or random ones.
+    '''
+    if inputs is None:
+        inputs = get_example_inputs(model, exported.batch_size, exported.context_length, seed=1)
+    states, actions, rtgs, timesteps = inputs
+    was_training = model.training
+    model.eval()
+    with t.no_grad():
+        eager_actions = None if actions is not None and actions.shape[1] == 0 else actions
+        _, expected, _ = model(states, eager_actions, rtgs, timesteps)
+        _, action_preds, _ = exported(states, actions, rtgs, timesteps)
+    model.train(was_training)
+
+    if not t.allclose(action_preds, expected, atol=atol, rtol=rtol):
+        difference = (action_preds - expected).abs().max().item()
+        raise ValueError(
+            f"The exported model's action predictions differ from the eager model's by {difference:.3g}")
+
+
+def export_decision_transformer(model, batch_size: int, context_length: int = None,
+                                check: bool = True) -> ExportedDecisionTransformer:
+    '''
+    Traces the action predictions of a (trained) decision transformer for
+    inputs of batch_size and context_length timesteps (by default the
+    model's whole context window), without any hooks, and freezes the trace.
+    The exported model holds a copy of the weights, so later changes to the
+    model don't affect it.
+
+    Args:
+        model: a DecisionTransformer, or a legacy one
+        batch_size: the batch size of the inputs
+        context_length: the timesteps of the inputs
+        check: whether to check the outputs against the eager model
+
+    Returns:
+        an ExportedDecisionTransformer
+    '''
+    assert isinstance(model, (DecisionTransformer, DecisionTransformerLegacy)), \
+        "Only decision transformers can be exported"
+    context_length = get_context_length(model) if context_length is None else context_length
+    assert 0 < context_length <= get_context_length(model), \
+        f"The context length must be between 1 and {get_context_length(model)}"
+
+    inputs = get_example_inputs(model, batch_size, context_length)
+    was_training = model.training
+    model.eval()
+    with hooks_removed(model), t.no_grad(), warnings.catch_warnings():
+        # the branches on shapes and the timestep check are traced as constants
+        warnings.filterwarnings("ignore", category=t.jit.TracerWarning)
+        module = t.jit.trace(ActionPredictor(model).eval(), inputs, check_trace=False)
+        module = t.jit.optimize_for_inference(t.jit.freeze(module))
+    model.train(was_training)
+
+    exported = ExportedDecisionTransformer(module, model, batch_size, context_length)
+    if check:
+        check_exported_model(exported, model, inputs)
+        check_exported_model(exported, model)
+    return exported
+
+
+def load_exported_decision_transformer(path, model, check: bool = True) -> ExportedDecisionTransformer:
+    '''
+    Loads a model saved with ExportedDecisionTransformer.save, checking its
+    outputs against the eager model it was exported from.
+    '''
+    extra_files = {"metadata.json": ""}
+    module = t.jit.load(path, map_location=next(model.parameters()).device,
+                        _extra_files=extra_files)
+    metadata = json.loads(extra_files["metadata.json"])
+    exported = ExportedDecisionTransformer(
+        module, model, metadata["batch_size"], metadata["context_length"])
+    if check:
+        check_exported_model(exported, model)
+    return exported
@@ -1,27 +1,50 @@
+import glob
 import gzip
 import lzma
+import os
 import pickle
 import random
+from collections.abc import Sequence
 
 import numpy as np
 import plotly.express as px
 import torch as t
 from einops import rearrange
 
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
+
+from src.config import parse_metadata_to_environment_config
+from src.trajectory_store import (COLUMNAR_SUFFIX, OBSERVATION_DTYPES,
+                                  get_content_hash, get_observation_moments,
+                                  get_observation_type, is_columnar_path,
+                                  merge_moments, read_cached_array,
+                                  read_columnar, read_stats_cache,
+                                  write_cached_array, write_stats_cache)
+
+TRAJECTORY_SUFFIXES = (".pkl", ".xz", ".gz", COLUMNAR_SUFFIX)
+
+# environment settings that have to agree between the shards of a dataset
+SHARD_COMPATIBILITY_KEYS = (
+    "env_id", "one_hot_obs", "img_obs", "fully_observed", "view_size")
 
 
 class TrajectoryReader():
     '''
     The trajectory reader is responsible for reading trajectories from a file.
+
+    Columnar stores (directories ending in .traj) are memory mapped rather
+    than loaded, legacy .pkl/.xz/.gz files are unpickled into memory.
     '''
 
     def __init__(self, path):
         self.path = path.strip()
 
     def read(self):
+        # columnar stores are memory mapped, one file per field
+        if is_columnar_path(self.path):
+            data = read_columnar(self.path)
         # if path ends in .pkl, read as pickle
-        if self.path.endswith('.pkl'):
+        elif self.path.endswith('.pkl'):
             with open(self.path, 'rb') as f:
                 data = pickle.load(f)
         # if path ends in .xz, read as lzma
@@ -38,6 +61,207 @@ class TrajectoryReader():
         return data
 
 
+def get_shard_paths(trajectory_path):
+    '''
+    Resolves a trajectory path to the shards of a dataset. The path can be a
+    single trajectory file or columnar store, a directory of them or a glob
+    pattern. Shards are sorted so that the global trajectory index is stable.
+    '''
+    trajectory_path = trajectory_path.strip()
+    if any(c in trajectory_path for c in "*?["):
+        paths = sorted(
+            path for path in glob.glob(trajectory_path)
+            if path.rstrip("/").endswith(TRAJECTORY_SUFFIXES))
+    elif os.path.isdir(trajectory_path) and not is_columnar_path(trajectory_path):
+        paths = sorted(
+            os.path.join(trajectory_path, name) for name in os.listdir(trajectory_path)
+            if name.rstrip("/").endswith(TRAJECTORY_SUFFIXES))
+    else:
+        paths = [trajectory_path]
+
+    if len(paths) == 0:
+        raise FileNotFoundError(f"No trajectory files found at {trajectory_path}")
+    return paths
+
+
+def get_reward_to_go(rewards, traj_starts, traj_lens, gamma=1.0):
+    '''
+    Computes the discounted reward-to-go of every step of a flat buffer of
+    trajectories.
+
+    Undiscounted, this is a reverse cumsum over the whole buffer minus the
+    reverse cumsum at the end of each step's trajectory. Otherwise the
+    recursion rtg[i] = r[i] + gamma * rtg[i + 1] is run backwards from the
+    end of every trajectory at once, so the python loop is over the longest
+    trajectory rather than over all steps.
+    '''
+    rewards = np.asarray(rewards, dtype=np.float64)
+    traj_ends = np.repeat(traj_starts + traj_lens, traj_lens)
+
+    if gamma == 1.0:
+        reverse_cumsum = np.append(np.cumsum(rewards[::-1])[::-1], 0.0)
+        return (reverse_cumsum[:-1] - reverse_cumsum[traj_ends]).astype(np.float32)
+
+    # positions grouped by their distance to the end of their trajectory
+    steps_to_end = traj_ends - 1 - np.arange(len(rewards))
+    order = np.argsort(steps_to_end, kind="stable")
+    bounds = np.searchsorted(
+        steps_to_end[order], np.arange(steps_to_end.max(initial=0) + 2))
+
+    rtg = rewards.copy()
+    for k in range(1, len(bounds) - 1):
+        positions = order[bounds[k]:bounds[k + 1]]
+        rtg[positions] += gamma * rtg[positions + 1]
+    return rtg.astype(np.float32)
+
+
+class TrajectoryShard():
+    '''
+    A single trajectory file or columnar store of a (possibly sharded)
+    dataset.
+
+    Actions, rewards, dones and truncations are flattened to (b t) order and
+    split into trajectories when the shard is created. Observations are left
+    where they are: pickled shards keep the unpickled array and columnar
+    shards only memory map theirs when they are first accessed.
+
+    Statistics that need a pass over the data (trajectory boundaries,
+    returns, action counts and observation moments) are kept in a cache
+    keyed by the content hash of the shard, so warm starts skip those passes.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        data = TrajectoryReader(path).read()
+        self.metadata = data['metadata']
+
+        observations = data['data'].get('observations')
+        self.observation_shape = tuple(observations.shape)
+        self.num_steps_per_env = observations.shape[0]
+        self._observations = None
+        if not is_columnar_path(path):
+            self._observations = np.swapaxes(np.asanyarray(observations), 0, 1)
+
+        self.actions = rearrange(np.asarray(data['data'].get('actions')), "t b -> (b t)")
+        self.rewards = rearrange(np.asarray(data['data'].get('rewards')), "t b -> (b t)")
+        self.dones = rearrange(np.asarray(data['data'].get('dones')), "t b -> (b t)")
+        self.truncated = rearrange(np.asarray(data['data'].get('truncated')), "t b -> (b t)")
+        self.num_steps = len(self.actions)
+
+        self.stats_key = get_content_hash(path)
+        self.stats = read_stats_cache(path, self.stats_key)
+        if self.stats is None:
+            self.stats = self.get_stats()
+            write_stats_cache(path, self.stats_key, self.stats)
+
+        self.traj_starts = self.stats["traj_starts"]
+        self.traj_lens = self.stats["traj_lens"]
+        self.returns = self.stats["returns"]
+        self.action_counts = self.stats["action_counts"]
+
+    def get_stats(self):
+        '''
+        Computes the trajectory boundaries, returns and action counts of
+        the shard.
+        '''
+        # trajectories end on a done/truncation or at the end of an env's rollout
+        done_or_truncated = np.logical_or(self.dones, self.truncated)
+        done_or_truncated[self.num_steps_per_env - 1::self.num_steps_per_env] = True
+        traj_ends = np.flatnonzero(done_or_truncated) + 1
+        traj_starts = np.concatenate([[0], traj_ends[:-1]]).astype(np.int64)
+
+        # only discrete actions have a histogram
+        if self.actions.ndim == 1 and np.issubdtype(self.actions.dtype, np.integer):
+            action_counts = np.bincount(self.actions)
+        else:
+            action_counts = np.zeros(0, dtype=np.int64)
+
+        return {
+            "traj_starts": traj_starts,
+            "traj_lens": traj_ends - traj_starts,
+            "returns": np.add.reduceat(self.rewards.astype(np.float64), traj_starts),
+            "action_counts": action_counts,
+        }
+
+    def get_observation_moments(self):
+        '''
+        Returns the count, mean and M2 of the observations (see
+        get_observation_moments), computed in a single streaming pass the
+        first time they are needed and cached with the other statistics.
+        '''
+        if "observation_mean" not in self.stats:
+            count, mean, m2 = get_observation_moments(self.observations)
+            self.stats.update(
+                observation_count=np.array(count), observation_mean=mean, observation_m2=m2)
+            write_stats_cache(self.path, self.stats_key, self.stats)
+
+        return (int(self.stats["observation_count"]),
+                self.stats["observation_mean"], self.stats["observation_m2"])
+
+    @property
+    def observations(self):
+        '''
+        The observations as a (b, t, ...) view, so flat (b t) positions split
+        into an env and a step without copying the (memory mapped) array.
+        '''
+        if self._observations is None:
+            self._observations = np.swapaxes(
+                read_columnar(self.path)['data']['observations'], 0, 1)
+        return self._observations
+
+    def load_reward_to_go(self, gamma=1.0):
+        '''
+        Returns the reward-to-go of every step. Columnar shards cache it on
+        disk (per gamma), so it is only computed once.
+        '''
+        cache_name = f"reward_to_go_gamma_{gamma}"
+        rtg = read_cached_array(self.path, cache_name, np.float32, self.rewards.shape)
+        if rtg is not None:
+            return rtg
+
+        rtg = get_reward_to_go(self.rewards, self.traj_starts, self.traj_lens, gamma)
+        if is_columnar_path(self.path):
+            write_cached_array(self.path, cache_name, rtg)
+        return rtg
+
+
+class ObservationBuffer():
+    '''
+    Flat (b t) access to the observations of every shard of a dataset,
+    without copying them. Slices return a view of a single trajectory (and
+    must not cross env or shard boundaries), gather collects arbitrary
+    positions into a new float32 array.
+    '''
+
+    def __init__(self, shards, shard_offsets):
+        self.shards = shards
+        self.shard_offsets = shard_offsets
+
+    def __getitem__(self, index):
+        assert isinstance(index, slice), "Use gather for anything but slices"
+        shard_id = np.searchsorted(self.shard_offsets, index.start, side="right") - 1
+        shard = self.shards[shard_id]
+        row, offset = divmod(
+            index.start - self.shard_offsets[shard_id], shard.num_steps_per_env)
+        return shard.observations[row, offset:offset + index.stop - index.start]
+
+    def gather(self, positions):
+        shard_ids = np.searchsorted(self.shard_offsets, positions, side="right") - 1
+        state_shape = self.shards[0].observation_shape[2:]
+        gathered = np.empty((*positions.shape, *state_shape), dtype=np.float32)
+        for shard_id in np.unique(shard_ids):
+            shard = self.shards[shard_id]
+            selected = shard_ids == shard_id
+            local = positions[selected] - self.shard_offsets[shard_id]
+            gathered[selected] = shard.observations[
+                local // shard.num_steps_per_env, local % shard.num_steps_per_env]
+        return gathered
+
+    @property
+    def nbytes(self):
+        return sum(shard.observations.nbytes for shard in self.shards)
+
+
 class TrajectoryDataset(Dataset):
 
     def __init__(self,
@@ -46,6 +270,7 @@ class TrajectoryDataset(Dataset):
                  prob_go_from_end=0,
                  pct_traj=1.0,
                  rtg_scale=1,
+                 rtg_gamma=1.0,
                  normalize_state=False,
                  device='cpu'):
         self.trajectory_path = trajectory_path
@@ -55,101 +280,149 @@ class TrajectoryDataset(Dataset):
         self.device = device
         self.normalize_state = normalize_state
         self.rtg_scale = rtg_scale
+        self.rtg_gamma = rtg_gamma
         self.load_trajectories()
 
-    def load_trajectories(self) -> None:
+        if self.normalize_state:
+            self.state_mean, self.state_std = self.get_state_mean_std()
+        else:
+            self.state_mean = 0
+            self.state_std = 1
 
-        traj_reader = TrajectoryReader(self.trajectory_path)
-        data = traj_reader.read()
+    def __getstate__(self):
+        '''
+        Pickling a memory map copies its whole content, so columnar datasets
+        sent to DataLoader worker processes (or saved) only carry their
+        arguments and state statistics. Every process then opens its own
+        memory maps when unpickling.
+        '''
+        if not all(is_columnar_path(shard.path) for shard in self.shards):
+            return self.__dict__
+
+        return {key: self.__dict__[key] for key in [
+            "trajectory_path", "max_len", "prob_go_from_end", "pct_traj",
+            "device", "normalize_state", "rtg_scale", "rtg_gamma",
+            "state_mean", "state_std"]}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "metadata" not in state:
+            self.load_trajectories()
 
-        observations = data['data'].get('observations')
-        actions = data['data'].get('actions')
-        rewards = data['data'].get('rewards')
-        dones = data['data'].get('dones')
-        truncated = data['data'].get('truncated')
-        infos = data['data'].get('infos')
-
-        observations = np.array(observations)
-        actions = np.array(actions)
-        rewards = np.array(rewards)
-        dones = np.array(dones)
-        infos = np.array(infos, dtype=np.ndarray)
+    def load_trajectories(self) -> None:
+        '''
+        Loads the trajectories of every shard (see get_shard_paths) into one
+        global index. Small fields are concatenated into flat (b t) buffers
+        and every trajectory is described by its shard, start and length.
+        Per-trajectory access (self.states[i] etc.) goes through
+        TrajectorySequence, which only creates views on demand.
+        '''
+        self.shards = [
+            TrajectoryShard(path) for path in get_shard_paths(self.trajectory_path)]
+        self.check_shard_compatibility()
+
+        observation_shape = self.shards[0].observation_shape
 
         # check whether observations are flat or an image
-        if observations.shape[-1] == 3:
-            self.observation_type = 'index'
-        elif observations.shape[-1] == 20:
-            self.observation_type = 'one_hot'
-        else:
+        self.observation_type = get_observation_type(observation_shape)
+        if self.observation_type not in OBSERVATION_DTYPES:
             raise ValueError(
-                "Observations are not flat or images, check the shape of the observations: ", observations.shape)
-
-        if self.observation_type != 'flat':
-            t_observations = rearrange(
-                t.tensor(observations), "t b h w c -> (b t) h w c")
-        else:
-            t_observations = rearrange(
-                t.tensor(observations), "t b f -> (b t) f")
-
-        t_actions = rearrange(t.tensor(actions), "t b -> (b t)")
-        t_rewards = rearrange(t.tensor(rewards), "t b -> (b t)")
-        t_dones = rearrange(t.tensor(dones), "t b -> (b t)")
-        t_truncated = rearrange(t.tensor(truncated), "t b -> (b t)")
-
-        t_done_or_truncated = t.logical_or(t_dones, t_truncated)
-        done_indices = t.where(t_done_or_truncated)[0]
-
-        self.actions = t.tensor_split(t_actions, done_indices + 1)
-        self.rewards = t.tensor_split(t_rewards, done_indices + 1)
-        self.dones = t.tensor_split(t_dones, done_indices + 1)
-        self.truncated = t.tensor_split(t_truncated, done_indices + 1)
-        self.states = t.tensor_split(t_observations, done_indices + 1)
-        self.returns = [r.sum() for r in self.rewards]
-        self.timesteps = [t.arange(len(i)) for i in self.states]
-        self.traj_lens = np.array([len(i) for i in self.states])
-
-        # remove trajs with length 0
-        traj_len_mask = self.traj_lens > 0
-        self.actions = [i for i, m in zip(self.actions, traj_len_mask) if m]
-        self.rewards = [i for i, m in zip(self.rewards, traj_len_mask) if m]
-        self.dones = [i for i, m in zip(self.dones, traj_len_mask) if m]
-        self.truncated = [i for i, m in zip(
-            self.truncated, traj_len_mask) if m]
-        self.states = [i for i, m in zip(self.states, traj_len_mask) if m]
-        self.returns = [i for i, m in zip(self.returns, traj_len_mask) if m]
-        self.timesteps = [i for i, m in zip(
-            self.timesteps, traj_len_mask) if m]
-        self.traj_lens = self.traj_lens[traj_len_mask]
+                "Observations are not flat or images, check the shape of the observations: ", observation_shape)
+
+        def concatenate(arrays):
+            # a single shard is used as is, which keeps memory maps intact
+            return arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
+
+        self.shard_offsets = np.cumsum(
+            [0] + [shard.num_steps for shard in self.shards])[:-1]
+        self.flat_actions = concatenate([shard.actions for shard in self.shards])
+        self.flat_rewards = concatenate([shard.rewards for shard in self.shards])
+        self.flat_dones = concatenate([shard.dones for shard in self.shards])
+        self.flat_truncated = concatenate([shard.truncated for shard in self.shards])
+        self.flat_rtg = concatenate(
+            [shard.load_reward_to_go(self.rtg_gamma) for shard in self.shards])
+
+        # global trajectory index
+        self.traj_shards = concatenate([
+            np.full(len(shard.traj_starts), i) for i, shard in enumerate(self.shards)])
+        self.traj_starts = concatenate([
+            shard.traj_starts + offset for shard, offset in zip(self.shards, self.shard_offsets)])
+        self.traj_lens = concatenate([shard.traj_lens for shard in self.shards])
+        self.returns = concatenate([shard.returns for shard in self.shards])
+
+        num_actions = max(len(shard.action_counts) for shard in self.shards)
+        self.action_counts = sum(
+            np.pad(shard.action_counts, (0, num_actions - len(shard.action_counts)))
+            for shard in self.shards)
+
+        # Observations dominate the dataset size so they are never copied
+        self.observations = ObservationBuffer(self.shards, self.shard_offsets)
+
+        self.states = TrajectorySequence(
+            self.observations, self.traj_starts, self.traj_lens)
+        self.actions = TrajectorySequence(
+            t.from_numpy(self.flat_actions), self.traj_starts, self.traj_lens)
+        self.rewards = TrajectorySequence(
+            t.from_numpy(self.flat_rewards), self.traj_starts, self.traj_lens)
+        self.dones = TrajectorySequence(
+            t.from_numpy(self.flat_dones), self.traj_starts, self.traj_lens)
+        self.truncated = TrajectorySequence(
+            t.from_numpy(self.flat_truncated), self.traj_starts, self.traj_lens)
+        self.rewards_to_go = TrajectorySequence(
+            self.flat_rtg, self.traj_starts, self.traj_lens)
+        # every trajectory's timesteps are a prefix of the same arange
+        self.timesteps = TrajectorySequence(
+            t.arange(self.traj_lens.max()), np.zeros_like(self.traj_starts), self.traj_lens)
 
         self.num_timesteps = sum(self.traj_lens)
-        self.num_trajectories = len(self.states)
+        self.num_trajectories = len(self.traj_lens)
 
-        self.state_dim = list(self.states[0][0].shape)
-        self.act_dim = list(self.actions[0][0].shape)
-        self.max_ep_len = max([len(i) for i in self.states])
-        self.metadata = data['metadata']
+        self.state_dim = list(observation_shape[2:])
+        self.act_dim = list(self.flat_actions.shape[1:])
+        self.max_ep_len = self.traj_lens.max()
+        self.metadata = self.shards[0].metadata
 
         self.indices = self.get_indices_of_top_p_trajectories(self.pct_traj)
         self.sampling_probabilities = self.get_sampling_probabilities()
-
-        if self.normalize_state:
-            self.state_mean, self.state_std = self.get_state_mean_std()
-        else:
-            self.state_mean = 0
-            self.state_std = 1
+        self.alias_table = AliasTable(self.sampling_probabilities)
+
+    def check_shard_compatibility(self):
+        '''
+        All shards must come from the same kind of environment, as parsed by
+        parse_metadata_to_environment_config, and hold observations and
+        actions of the same shape.
+        '''
+        if len(self.shards) == 1:
+            return
+
+        reference = self.shards[0]
+        reference_config = parse_metadata_to_environment_config(
+            reference.metadata['args'])
+        for shard in self.shards[1:]:
+            config = parse_metadata_to_environment_config(shard.metadata['args'])
+            for key in SHARD_COMPATIBILITY_KEYS:
+                if getattr(config, key) != getattr(reference_config, key):
+                    raise ValueError(
+                        f"Shard {shard.path} has {key}={getattr(config, key)} "
+                        f"but {reference.path} has {key}={getattr(reference_config, key)}")
+            if shard.observation_shape[2:] != reference.observation_shape[2:] or \
+                    shard.actions.shape[1:] != reference.actions.shape[1:]:
+                raise ValueError(
+                    f"Shard {shard.path} has observations of shape {shard.observation_shape[2:]} "
+                    f"but {reference.path} has {reference.observation_shape[2:]}")
 
     def get_indices_of_top_p_trajectories(self, pct_traj):
         num_timesteps = max(int(pct_traj * self.num_timesteps), 1)
         sorted_inds = np.argsort(self.returns)
 
-        num_trajectories = 1
-        timesteps = self.traj_lens[sorted_inds[-1]]
-        ind = self.num_trajectories - 1
-
-        while ind >= 0 and timesteps + self.traj_lens[sorted_inds[ind]] < num_timesteps:
-            timesteps += self.traj_lens[sorted_inds[ind]]
-            ind -= 1
-            num_trajectories += 1
+        # Starting from the best trajectory, keep adding trajectories while
+        # the running total stays below num_timesteps. As before, the best
+        # trajectory's length is counted twice in the running total.
+        lens = self.traj_lens[sorted_inds[::-1]]
+        running_total = lens[0] + np.cumsum(lens)
+        num_trajectories = 1 + np.searchsorted(
+            running_total, num_timesteps, side="left")
+        num_trajectories = min(num_trajectories, self.num_trajectories)
 
         sorted_inds = sorted_inds[-num_trajectories:]
 
@@ -168,141 +441,106 @@ class TrajectoryDataset(Dataset):
         return discount_cumsum
 
     def get_state_mean_std(self):
-        # used for input normalization
-        all_states = np.concatenate(self.states, axis=0)
-        state_mean, state_std = np.mean(
-            all_states, axis=0), np.std(all_states, axis=0) + 1e-6
+        # used for input normalization, trajectories cover every step so the
+        # (cached) moments of each shard's observations are merged
+        count, state_mean, m2 = 0, 0.0, 0.0
+        for shard in self.shards:
+            count, state_mean, m2 = merge_moments(
+                count, state_mean, m2, *shard.get_observation_moments())
+
+        state_std = np.sqrt(m2 / count) + 1e-6
         return state_mean, state_std
 
     def get_batch(self, batch_size=256, max_len=100, prob_go_from_end=None):
 
         sorted_inds = self.indices
 
-        batch_inds = np.random.choice(
-            np.arange(len(sorted_inds)),
-            size=batch_size,
-            replace=True,
-            p=self.sampling_probabilities,  # reweights so we sample according to timesteps
-        )
-
-        # initialize np arrays not lists
-        states, actions, rewards, dones, rewards_to_gos, timesteps, mask = [], [], [], [], [], [], []
-        for i in range(batch_size):
+        # reweights so we sample according to timesteps
+        batch_inds = self.alias_table.sample(batch_size)
 
-            # get the trajectory
-            traj_index = sorted_inds[batch_inds[i]]
-
-            s, a, r, d, rtg, ti, m = self.get_traj(
-                traj_index, max_len, prob_go_from_end=prob_go_from_end)
-
-            rewards.append(r)
-            actions.append(a)
-            states.append(s)
-            dones.append(d)
-            rewards_to_gos.append(rtg)
-            mask.append(m)
-            timesteps.append(ti)
-
-        return self.return_tensors(states, actions, rewards, rewards_to_gos, dones, timesteps, mask)
+        return self.get_sequences(
+            sorted_inds[batch_inds], max_len=max_len, prob_go_from_end=prob_go_from_end)
 
     def get_traj(self, traj_index, max_len=100, prob_go_from_end=None):
 
-        traj_rewards = self.rewards[traj_index]
-        traj_states = self.states[traj_index]
-        traj_actions = self.actions[traj_index]
-        traj_dones = self.dones[traj_index]
+        sequences = self.get_sequences(
+            [traj_index], max_len=max_len, prob_go_from_end=prob_go_from_end)
+
+        # squeeze out the batch dimension
+        return tuple(i.squeeze(0) for i in sequences)
+
+    def get_sequences(self, traj_indices, max_len=100, prob_go_from_end=None):
+        '''
+        Assembles one sequence per trajectory index with a few vectorized
+        gathers from the flat buffers.
+
+        Each sequence starts at a random step of its trajectory (or, with
+        probability prob_go_from_end, max_len steps before its end) and
+        sequences shorter than max_len are left padded. The reward-to-go has
+        one more step than the other fields, which is 0 past the end of the
+        trajectory.
+
+        Returns:
+            s, a, r, d, rtg, timesteps, mask, shaped [batch, max_len, ...]
+        '''
+        traj_indices = np.asarray(traj_indices)
+        starts = self.traj_starts[traj_indices]
+        lens = self.traj_lens[traj_indices]
+        batch_size = len(traj_indices)
 
         # start index
-        si = random.randint(0, traj_rewards.shape[0] - 1)
+        si = (np.random.random(batch_size) * lens).astype(np.int64)
         if prob_go_from_end is not None:
-            if random.random() < prob_go_from_end:
-                si = traj_rewards.shape[0] - max_len
-                si = max(0, si)  # make sure it's not negative
-
-        # get sequences from dataset
-        s = traj_states[si:si + max_len].reshape(1, -1, *self.state_dim)
-        a = traj_actions[si:si + max_len].reshape(1, -1, *self.act_dim)
-        r = traj_rewards[si:si + max_len].reshape(1, -1, 1)
-        d = traj_dones[si:si + max_len].reshape(1, -1)
-        rtg = self.discount_cumsum(traj_rewards[si:], gamma=1.)[
-            :s.shape[1] + 1].reshape(1, -1, 1)
-        ti = np.arange(si, si + s.shape[1]).reshape(1, -1)
-
-        # if the trajectory is shorter than max_len, pad it
-        if rtg.shape[1] <= s.shape[1]:
-            rtg = np.concatenate([rtg, np.zeros((1, 1, 1))], axis=1)
+            go_from_end = np.random.random(batch_size) < prob_go_from_end
+            si = np.where(go_from_end, np.maximum(lens - max_len, 0), si)
 
         # sometime the trajectory is shorter than max_len (due to random start index or end of episode)
-        tlen = s.shape[1]
+        tlen = np.minimum(lens - si, max_len)
+        padding = max_len - tlen
+
+        # step within the trajectory of every position, negative for padding
+        steps = si[:, None] + np.arange(max_len + 1)[None, :] - padding[:, None]
+        in_traj = (steps >= si[:, None]) & (steps < lens[:, None])
+        positions = starts[:, None] + np.clip(steps, 0, lens[:, None] - 1)
 
-        # sanity check
-        assert tlen <= max_len, f"tlen: {tlen} max_len: {max_len}"
+        rtg = np.where(in_traj, self.flat_rtg[positions], 0.0)[..., None]
 
-        padding_required = max_len - tlen
-        s = self.add_padding(s, 0, padding_required)
-        a = self.add_padding(a, -10, padding_required)
-        r = self.add_padding(r, 0, padding_required)
-        d = self.add_padding(d, 2, padding_required)
-        rtg = self.add_padding(rtg, 0, padding_required)
-        ti = self.add_padding(ti, 0, padding_required)
-        m = self.add_padding(np.ones((1, tlen)), 0, padding_required)
+        # drop the extra step that only the reward-to-go needs
+        steps, in_traj, positions = steps[:, :-1], in_traj[:, :-1], positions[:, :-1]
+
+        s = self.observations.gather(positions)
+        s[~in_traj] = 0
+        a = np.where(in_traj, self.flat_actions[positions], -10)
+        r = np.where(in_traj, self.flat_rewards[positions], 0.0)[..., None]
+        d = np.where(in_traj, self.flat_dones[positions], True)
+        ti = np.where(in_traj, steps, 0)
 
         # padding and state + reward normalization
         s = (s - self.state_mean) / self.state_std
         rtg = rtg / self.rtg_scale
 
-        return self.return_tensors(s, a, r, rtg, d, ti, m)
-
-    def add_padding(self, tokens, padding_token, padding_required):
-        if padding_required > 0:
-            return np.concatenate([np.ones((1, padding_required, *tokens.shape[2:])) * padding_token, tokens], axis=1)
-        return tokens
-
-    def return_tensors(self, s, a, r, rtg, d, timesteps, mask):
-
-        if isinstance(s, t.Tensor):
-            s = s.to(dtype=t.float32, device=self.device)
-        else:
-            s = t.from_numpy(s).to(dtype=t.float32, device=self.device)
-
-        if isinstance(a, t.Tensor):
-            a = a.to(dtype=t.long, device=self.device)
-        else:
-            a = t.from_numpy(a).to(dtype=t.long, device=self.device)
-
-        if isinstance(r, t.Tensor):
-            r = r.to(dtype=t.float32, device=self.device)
-        else:
-            r = t.from_numpy(r).to(dtype=t.float32, device=self.device)
-
-        if isinstance(rtg, t.Tensor):
-            rtg = rtg.to(dtype=t.float32, device=self.device)
-        else:
-            rtg = t.from_numpy(rtg).to(dtype=t.float32, device=self.device)
-
-        if isinstance(d, t.Tensor):
-            d = d.to(dtype=t.bool, device=self.device)
-        else:
-            d = t.from_numpy(d).to(dtype=t.bool, device=self.device)
-        timesteps = t.from_numpy(timesteps).to(
-            dtype=t.long, device=self.device)
-        mask = t.from_numpy(mask).to(dtype=t.bool, device=self.device)
-
-        # squeeze out the batch dimension
-        s = s.squeeze(0)
-        a = a.squeeze(0)
-        r = r.squeeze(0)
-        rtg = rtg.squeeze(0)
-        d = d.squeeze(0)
-        timesteps = timesteps.squeeze(0)
-        mask = mask.squeeze(0)
-
-        return s, a, r, d, rtg, timesteps, mask
+        return (
+            t.from_numpy(s).to(dtype=t.float32, device=self.device),
+            t.from_numpy(a).to(dtype=t.long, device=self.device),
+            t.from_numpy(r).to(dtype=t.float32, device=self.device),
+            t.from_numpy(d).to(dtype=t.bool, device=self.device),
+            t.from_numpy(rtg).to(dtype=t.float32, device=self.device),
+            t.from_numpy(ti).to(dtype=t.long, device=self.device),
+            t.from_numpy(in_traj).to(dtype=t.bool, device=self.device),
+        )
 
     def __len__(self):
         return len(self.indices)
 
     def __getitem__(self, idx):
+        # batches of indices (see TrajectoryBatchSampler) are assembled at once
+        if np.ndim(idx) > 0:
+            return self.get_sequences(
+                self.indices[np.asarray(idx)],
+                max_len=self.max_len,
+                prob_go_from_end=self.prob_go_from_end
+            )
+
         traj_index = self.indices[idx]
         s, a, r, d, rtg, ti, m = self.get_traj(
             traj_index,
@@ -312,6 +550,140 @@ class TrajectoryDataset(Dataset):
         return s, a, r, d, rtg, ti, m
 
 
+class TrajectorySequence(Sequence):
+    '''
+    List-like access to the trajectories in a flat buffer. Trajectory i is
+    buffer[starts[i]:starts[i] + lens[i]], created only when it is accessed,
+    so datasets hold two int arrays instead of a python object per
+    trajectory. Trajectories are always tensors: those of numpy buffers
+    (read only memory maps) are copied into one.
+    '''
+
+    def __init__(self, buffer, starts, lens):
+        self.buffer = buffer
+        self.starts = starts
+        self.lens = lens
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        start, length = self.starts[index], self.lens[index]
+        trajectory = self.buffer[start:start + length]
+        if isinstance(trajectory, np.ndarray):
+            return t.from_numpy(np.array(trajectory))
+        return trajectory
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class AliasTable():
+    '''
+    Walker's alias method for drawing indices with replacement from a fixed
+    discrete distribution. Building the table is O(n) and done once; every
+    draw after that is O(1), independent of the number of trajectories.
+    '''
+
+    def __init__(self, probabilities):
+        probabilities = np.asarray(probabilities, dtype=np.float64)
+        n = len(probabilities)
+        scaled = probabilities * n / probabilities.sum()
+
+        small = np.flatnonzero(scaled < 1).tolist()
+        large = np.flatnonzero(scaled >= 1).tolist()
+        # python lists are much faster than numpy for the scalar loop below
+        scaled = scaled.tolist()
+        prob = [1.0] * n
+        alias = list(range(n))
+
+        # Vose's algorithm: every under-full column is topped up by one
+        # over-full column, which then becomes under-full or stays over-full.
+        # Columns left over at the end are full up to rounding error.
+        while small and large:
+            s, l = small.pop(), large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            if scaled[l] < 1:
+                small.append(l)
+            else:
+                large.append(l)
+
+        self.prob = np.array(prob)
+        self.alias = np.array(alias, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.prob)
+
+    def sample(self, num_samples):
+        columns = np.random.randint(len(self.prob), size=num_samples)
+        keep = np.random.random(num_samples) < self.prob[columns]
+        return np.where(keep, columns, self.alias[columns])
+
+
+class TrajectoryBatchSampler(Sampler):
+    '''
+    Draws weighted random batches of dataset indices, with replacement, so
+    that TrajectoryDataset can assemble a whole batch in one call:
+
+        sampler = TrajectoryBatchSampler(weights, num_samples, batch_size)
+        dataloader = DataLoader(dataset, batch_size=None, sampler=sampler)
+
+    This is the batched equivalent of a WeightedRandomSampler used with
+    DataLoader(batch_size=batch_size). If indices is given (for example the
+    indices of a random_split subset), weights refer to those indices and
+    the corresponding dataset indices are yielded.
+    '''
+
+    def __init__(self, weights, num_samples, batch_size, indices=None):
+        self.alias_table = AliasTable(weights)
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.indices = np.arange(len(self.alias_table)) if indices is None \
+            else np.asarray(indices)
+
+    def __iter__(self):
+        samples = self.indices[self.alias_table.sample(self.num_samples)]
+        for i in range(0, self.num_samples, self.batch_size):
+            yield samples[i:i + self.batch_size]
+
+    def __len__(self):
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+
+def seed_worker(worker_id):
+    '''
+    DataLoader worker_init_fn. torch seeds every worker differently, but
+    forked workers inherit the parent's random and np.random state and would
+    otherwise all draw the same sequence start indices.
+    '''
+    seed = t.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def get_dataloader_kwargs(num_workers=0, prefetch_factor=2, persistent_workers=False, pin_memory=False):
+    '''
+    Returns DataLoader arguments for assembling batches in worker processes.
+    Worker only options are left out when loading in the main process.
+    '''
+    if num_workers == 0:
+        return {"pin_memory": pin_memory}
+
+    return {
+        "num_workers": num_workers,
+        "prefetch_factor": prefetch_factor,
+        "persistent_workers": persistent_workers,
+        "pin_memory": pin_memory,
+        "worker_init_fn": seed_worker,
+    }
+
+
 class TrajectoryVisualizer:
 
     def __init__(self, trajectory_dataset: TrajectoryDataset):
@@ -320,9 +692,13 @@ class TrajectoryVisualizer:
 
     def plot_reward_over_time(self):
 
-        reward = [i[-1] for i in self.trajectory_loader.rewards if len(i) > 0]
-        timesteps = [i.max()
-                     for i in self.trajectory_loader.timesteps if len(i) > 0]
+        trajectory_loader = self.trajectory_loader
+        traj_lens = trajectory_loader.traj_lens
+        # trajectories are never empty, their last reward and timestep are
+        # read straight from the flat buffers
+        reward = trajectory_loader.flat_rewards[
+            trajectory_loader.traj_starts + traj_lens - 1]
+        timesteps = traj_lens - 1
 
         # create a categorical color array for reward <0, 0, >0
         colors = np.zeros(len(reward))
@@ -350,7 +726,7 @@ class TrajectoryVisualizer:
     def plot_base_action_frequencies(self):
 
         fig = px.bar(
-            y=t.concat(self.trajectory_loader.actions).bincount()
+            y=self.trajectory_loader.action_counts
             # x=[IDX_TO_ACTION[i] for i in range(7)],
             # color=[IDX_TO_ACTION[i] for i in range(7)],
         )
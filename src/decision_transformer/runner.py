@@ -42,7 +42,8 @@ def run_decision_transformer(
         max_len=max_len,
         pct_traj=offline_config.pct_traj,
         prob_go_from_end=offline_config.prob_go_from_end,
-        device=device,
+        # worker processes assemble batches on the cpu, see train
+        device=device if offline_config.num_workers == 0 else "cpu",
     )
 
     # make an environment
@@ -121,7 +122,13 @@ def run_decision_transformer(
         eval_frequency=offline_config.eval_frequency,
         eval_episodes=offline_config.eval_episodes,
         initial_rtg=offline_config.initial_rtg,
-        eval_max_time_steps=offline_config.eval_max_time_steps
+        eval_max_time_steps=offline_config.eval_max_time_steps,
+        eval_vector_env=offline_config.eval_vector_env,
+        num_workers=offline_config.num_workers,
+        prefetch_factor=offline_config.prefetch_factor,
+        persistent_workers=offline_config.persistent_workers,
+        pin_memory=offline_config.pin_memory,
+        precision=offline_config.precision,
     )
 
     if run_config.track:
@@ -1,6 +1,5 @@
 import os
 
-import gymnasium.vector
 import torch as t
 import torch.nn as nn
 from einops import rearrange
@@ -8,11 +7,14 @@ from tqdm import tqdm
 import wandb
 from argparse import Namespace
 from src.models.trajectory_model import TrajectoryTransformer, DecisionTransformer, CloneTransformer
-from .offline_dataset import TrajectoryDataset
-from torch.utils.data.sampler import WeightedRandomSampler
+from .export import ExportedDecisionTransformer
+from .offline_dataset import TrajectoryDataset, TrajectoryBatchSampler, get_dataloader_kwargs
 from torch.utils.data import random_split, DataLoader
 import numpy as np
 from .utils import get_max_len_from_model_type
+from src.rollout_context import RolloutContext
+from src.environments.environments import make_vector_env
+from src.precision import autocast, to_float32
 
 
 def train(
@@ -31,7 +33,18 @@ def train(
         eval_frequency=10,
         eval_episodes=10,
         initial_rtg=[0.0, 1.0],
-        eval_max_time_steps=100):
+        eval_max_time_steps=100,
+        eval_vector_env="sync",
+        num_workers=0,
+        prefetch_factor=2,
+        persistent_workers=False,
+        pin_memory=False,
+        precision="fp32"):
+    '''
+    Trains the model on the trajectories, testing and evaluating it every
+    test_frequency and eval_frequency epochs. With precision "bf16" the
+    forward passes run under bfloat16 autocast (see src/precision.py).
+    '''
     loss_fn = nn.CrossEntropyLoss()
     model = model.to(device)
     optimizer = t.optim.Adam(model.parameters(), lr=lr,
@@ -40,23 +53,33 @@ def train(
     train_dataset, test_dataset = random_split(
         trajectory_data_set, [0.90, 0.10])
 
-    # Create the train DataLoader
-    train_sampler = WeightedRandomSampler(
+    # batches can be assembled in worker processes while the model trains
+    dataloader_kwargs = get_dataloader_kwargs(
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor,
+        persistent_workers=persistent_workers,
+        pin_memory=pin_memory,
+    )
+
+    # Create the train DataLoader, the dataset assembles whole batches at once
+    train_sampler = TrajectoryBatchSampler(
         weights=trajectory_data_set.sampling_probabilities[train_dataset.indices],
         num_samples=len(train_dataset),
-        replacement=True,
+        batch_size=batch_size,
+        indices=train_dataset.indices,
     )
     train_dataloader = DataLoader(
-        train_dataset, batch_size=batch_size, sampler=train_sampler)
+        trajectory_data_set, batch_size=None, sampler=train_sampler, **dataloader_kwargs)
 
     # Create the test DataLoader
-    test_sampler = WeightedRandomSampler(
+    test_sampler = TrajectoryBatchSampler(
         weights=trajectory_data_set.sampling_probabilities[test_dataset.indices],
         num_samples=len(test_dataset),
-        replacement=True,
+        batch_size=batch_size,
+        indices=test_dataset.indices,
     )
     test_dataloader = DataLoader(
-        test_dataset, batch_size=batch_size, sampler=test_sampler)
+        trajectory_data_set, batch_size=None, sampler=test_sampler, **dataloader_kwargs)
 
     train_batches_per_epoch = len(train_dataloader)
     pbar = tqdm(range(train_epochs))
@@ -64,6 +87,10 @@ def train(
         for batch, (s, a, r, d, rtg, ti, m) in (enumerate(train_dataloader)):
             total_batches = epoch * train_batches_per_epoch + batch
 
+            # batches from worker processes arrive on the cpu
+            s, a, rtg, ti = (i.to(device, non_blocking=pin_memory)
+                             for i in (s, a, rtg, ti))
+
             model.train()
 
             if model.transformer_config.time_embedding_type == "linear":
@@ -73,25 +100,27 @@ def train(
 
             optimizer.zero_grad()
 
-            if isinstance(model, DecisionTransformer):
-                action = a[:, :-1].unsqueeze(-1) if a.shape[1] > 1 else None
-                _, action_preds, _ = model.forward(
-                    states=s,
-                    # remove last action
-                    actions=action,
-                    rtgs=rtg[:, :-1],  # remove last rtg
-                    timesteps=ti.unsqueeze(-1)
-                )
-            elif isinstance(model, CloneTransformer):
-                _, action_preds = model.forward(
-                    states=s,
-                    # remove last action
-                    actions=a[:, :- \
-                              1].unsqueeze(-1) if a.shape[1] > 1 else None,
-                    timesteps=ti.unsqueeze(-1)
-                )
-
-            action_preds = rearrange(action_preds, 'b t a -> (b t) a')
+            with autocast(precision, device, model):
+                if isinstance(model, DecisionTransformer):
+                    action = a[:, :-1].unsqueeze(-1) if a.shape[1] > 1 else None
+                    _, action_preds, _ = model.forward(
+                        states=s,
+                        # remove last action
+                        actions=action,
+                        rtgs=rtg[:, :-1],  # remove last rtg
+                        timesteps=ti.unsqueeze(-1)
+                    )
+                elif isinstance(model, CloneTransformer):
+                    _, action_preds = model.forward(
+                        states=s,
+                        # remove last action
+                        actions=a[:, :- \
+                                  1].unsqueeze(-1) if a.shape[1] > 1 else None,
+                        timesteps=ti.unsqueeze(-1)
+                    )
+
+            # the loss is computed in float32
+            action_preds = rearrange(to_float32(action_preds), 'b t a -> (b t) a')
             a_exp = rearrange(a, 'b t -> (b t)').to(t.int64)
 
             # ignore dummy action
@@ -120,7 +149,8 @@ def train(
                 env=env,
                 epochs=test_epochs,
                 track=track,
-                batch_number=total_batches)
+                batch_number=total_batches,
+                precision=precision)
 
         eval_env_func = make_env(
             env_id=env.spec.id,
@@ -148,7 +178,9 @@ def train(
                     track=track,
                     batch_number=total_batches,
                     initial_rtg=float(rtg),
-                    device=device)
+                    device=device,
+                    vector_env=eval_vector_env,
+                    precision=precision)
 
     return model
 
@@ -159,7 +191,8 @@ def test(
         env,
         epochs=10,
         track=False,
-        batch_number=0):
+        batch_number=0,
+        precision="fp32"):
     model.eval()
 
     loss_fn = nn.CrossEntropyLoss()
@@ -170,32 +203,35 @@ def test(
 
     pbar = tqdm(range(epochs))
     test_batches_per_epoch = len(dataloader)
+    device = next(model.parameters()).device
 
     for epoch in pbar:
         for batch, (s, a, r, d, rtg, ti, m) in (enumerate(dataloader)):
+            s, a, rtg, ti = (i.to(device) for i in (s, a, rtg, ti))
             if model.transformer_config.time_embedding_type == "linear":
                 ti = ti.to(t.float32)
 
             a[a == -10] = env.action_space.n
 
-            if isinstance(model, DecisionTransformer):
-                _, action_preds, _ = model.forward(
-                    states=s,
-                    actions=a[:, :-
-                              1].unsqueeze(-1) if a.shape[1] > 1 else None,
-                    rtgs=rtg[:, :-1],
-                    timesteps=ti.unsqueeze(-1)
-                )
-            elif isinstance(model, CloneTransformer):
-                _, action_preds = model.forward(
-                    states=s,
-                    # remove last action
-                    actions=a[:, :- \
-                              1].unsqueeze(-1) if a.shape[1] > 1 else None,
-                    timesteps=ti.unsqueeze(-1)
-                )
-
-            action_preds = rearrange(action_preds, 'b t a -> (b t) a')
+            with autocast(precision, device, model):
+                if isinstance(model, DecisionTransformer):
+                    _, action_preds, _ = model.forward(
+                        states=s,
+                        actions=a[:, :-
+                                  1].unsqueeze(-1) if a.shape[1] > 1 else None,
+                        rtgs=rtg[:, :-1],
+                        timesteps=ti.unsqueeze(-1)
+                    )
+                elif isinstance(model, CloneTransformer):
+                    _, action_preds = model.forward(
+                        states=s,
+                        # remove last action
+                        actions=a[:, :- \
+                                  1].unsqueeze(-1) if a.shape[1] > 1 else None,
+                        timesteps=ti.unsqueeze(-1)
+                    )
+
+            action_preds = rearrange(to_float32(action_preds), 'b t a -> (b t) a')
             a_exp = rearrange(a, 'b t -> (b t)').to(t.int64)
 
             a_hat = t.argmax(action_preds, dim=-1)
@@ -231,13 +267,33 @@ def evaluate_dt_agent(
         initial_rtg=0.98,
         use_tqdm=True,
         device="cpu",
-        num_envs=8):
+        num_envs=8,
+        use_kv_cache=True,
+        vector_env="sync",
+        precision="fp32"):
+    '''
+    Rolls out the model in num_envs environments until the given number of
+    trajectories finished. Decision transformers decode incrementally with
+    a key value cache (see DecisionTransformer.predict_next_action) unless
+    use_kv_cache is False, in which case the whole context window is run
+    through the model at every step. The environments are vectorized with
+    vector_env, see make_vector_env, and the model runs with the given
+    precision, see src/precision.py.
+
+    Models exported with export_decision_transformer run on padded context
+    windows of the length they were exported for, in num_envs environments.
+    '''
     model.eval()
 
-    env = gymnasium.vector.SyncVectorEnv(
-        [env_func for _ in range(num_envs)]
-    )
-    video_path = os.path.join("videos", env.envs[0].run_name)
+    env = make_vector_env(
+        [env_func for _ in range(num_envs)], vector_env=vector_env)
+    video_path = os.path.join("videos", env.get_attr("run_name")[0])
+
+    exported = isinstance(model, ExportedDecisionTransformer)
+    if exported:
+        assert not model.legacy, "Exported legacy models can't be evaluated"
+        assert model.batch_size == num_envs, \
+            f"The model was exported for {model.batch_size} envs, not {num_envs}"
 
     if not hasattr(model, "transformer_config"):
         model.transformer_config = Namespace(
@@ -245,11 +301,14 @@ def evaluate_dt_agent(
             time_embedding_type=model.time_embedding_type,
         )
 
-    max_len = get_max_len_from_model_type(
-        model_type="decision_transformer" if isinstance(
-            model, DecisionTransformer) else "clone_transformer",
-        n_ctx=model.transformer_config.n_ctx,
-    )
+    if exported:
+        max_len = model.context_length
+    else:
+        max_len = get_max_len_from_model_type(
+            model_type="decision_transformer" if isinstance(
+                model, DecisionTransformer) else "clone_transformer",
+            n_ctx=model.transformer_config.n_ctx,
+        )
 
     traj_lengths = []
     rewards = []
@@ -287,61 +346,86 @@ def evaluate_dt_agent(
     if model.transformer_config.time_embedding_type == "linear":
         timesteps = timesteps.to(t.float32)
 
-    # get first action
-    if isinstance(model, DecisionTransformer):
-        state_preds, action_preds, reward_preds = model.forward(
-            states=obs, actions=None, rtgs=rtg, timesteps=timesteps)
-    elif isinstance(model, CloneTransformer):
-        state_preds, action_preds = model.forward(
-            states=obs, actions=None, timesteps=timesteps)
-    else:  # it's probably a legacy model in which case the interface is:
-        state_preds, action_preds, reward_preds = model.forward(
-            states=obs, actions=a, rtgs=rtg, timesteps=timesteps)
-
-    new_action = t.argmax(action_preds, dim=-1).squeeze(-1)
-    new_obs, new_reward, terminated, truncated, info = env.step(new_action)
-
-    current_trajectory_length = t.ones(num_envs, dtype=t.int)
-    while n_terminated + n_truncated < trajectories:
-
-        # concat init obs to new obs
-        obs = t.cat(
-            [obs, t.tensor(new_obs['image']).unsqueeze(1).to(device)], dim=1)
-
-        # add new reward to init reward
-        rtg = t.cat([rtg, rtg[:, -1:, :] -
-                     rearrange(t.tensor(new_reward).to(device), 'e -> e 1 1')], dim=1)
-
-        # add new timesteps
-        timesteps = t.cat([timesteps, rearrange(
-            current_trajectory_length.to(device), 'e -> e 1 1')], dim=1)
-
-        if model.transformer_config.time_embedding_type == "linear":
-            timesteps = timesteps.to(t.float32)
+    use_kv_cache = use_kv_cache and isinstance(model, DecisionTransformer)
+    if not use_kv_cache:
+        # the last max_len timesteps of every env, updated in place, exported
+        # models take windows of a fixed length padded like the training data
+        context = RolloutContext(
+            num_envs, max_len, obs.shape[2:],
+            action_pad_token=env.single_action_space.n if exported else 0,
+            obs_dtype=obs.dtype, timestep_dtype=timesteps.dtype, device=device)
+        context.start(obs[:, 0], rtg=rtg[:, 0], timesteps=timesteps[:, 0], padded=exported)
 
-        a = t.cat([a, rearrange(new_action, 'e -> e 1 1')], dim=1)
-
-        # truncations:
-        obs = obs[:, -max_len:] if obs.shape[1] > max_len else obs
-        actions = a[:, -(obs.shape[1] - 1):] if (a.shape[1]
-                                                 > 1 and max_len > 1) else None
-        timesteps = timesteps[:, -
-                              max_len:] if timesteps.shape[1] > max_len else timesteps
-
-        if isinstance(model, DecisionTransformer):
+    # get first action
+    with autocast(precision, device, model):
+        if use_kv_cache:
+            model.start_episode(batch_size=num_envs)
+            action_preds = model.predict_next_action(
+                states=obs, rtgs=rtg, timesteps=timesteps)
+        elif exported:
+            obs, actions, rtg, timesteps = context.get()
             state_preds, action_preds, reward_preds = model.forward(
                 states=obs, actions=actions, rtgs=rtg, timesteps=timesteps)
+        elif isinstance(model, DecisionTransformer):
+            state_preds, action_preds, reward_preds = model.forward(
+                states=obs, actions=None, rtgs=rtg, timesteps=timesteps)
         elif isinstance(model, CloneTransformer):
             state_preds, action_preds = model.forward(
-                states=obs, actions=actions, timesteps=timesteps)
+                states=obs, actions=None, timesteps=timesteps)
         else:  # it's probably a legacy model in which case the interface is:
-            steps = model.transformer_config.n_ctx // 3
             state_preds, action_preds, reward_preds = model.forward(
-                states=obs[:, -steps:], actions=a[:, -steps:], rtgs=rtg[:, -steps:], timesteps=timesteps[:, -steps:])
+                states=obs, actions=a, rtgs=rtg, timesteps=timesteps)
+
+    new_action = t.argmax(action_preds, dim=-1)
+    if not use_kv_cache:
+        new_action = new_action[:, -1]
+    new_obs, new_reward, terminated, truncated, info = env.step(new_action)
 
-        action = t.argmax(action_preds, dim=-1).squeeze(-1)
-        new_obs, new_reward, terminated, truncated, info = env.step(action)
-        # print(f"took action  {action} at timestep {i} for reward {new_reward}")
+    current_trajectory_length = t.ones(num_envs, dtype=t.int)
+    while n_terminated + n_truncated < trajectories:
+
+        if use_kv_cache:
+            # only the new timestep goes through the model
+            obs = t.tensor(new_obs['image']).unsqueeze(1).to(device)
+            rtg = rtg[:, -1:, :] - \
+                rearrange(t.tensor(new_reward).to(device), 'e -> e 1 1')
+            timesteps = rearrange(current_trajectory_length.to(device), 'e -> e 1 1')
+            if model.transformer_config.time_embedding_type == "linear":
+                timesteps = timesteps.to(t.float32)
+
+            with autocast(precision, device, model):
+                action_preds = model.predict_next_action(
+                    states=obs, rtgs=rtg, timesteps=timesteps,
+                    actions=rearrange(new_action, 'e -> e 1 1').to(device))
+            new_action = t.argmax(action_preds, dim=-1)
+            new_obs, new_reward, terminated, truncated, info = env.step(new_action)
+
+        else:
+            # add the new timestep to the context windows
+            context.append(
+                obs=t.tensor(new_obs['image']).to(device),
+                action=new_action.to(device),
+                rtg=context.rtg[:, context.newest] -
+                rearrange(t.tensor(new_reward).to(device), 'e -> e 1'),
+                timesteps=rearrange(current_trajectory_length.to(device), 'e -> e 1'))
+            obs, actions, rtg, timesteps = context.get()
+
+            with autocast(precision, device, model):
+                if isinstance(model, (DecisionTransformer, ExportedDecisionTransformer)):
+                    state_preds, action_preds, reward_preds = model.forward(
+                        states=obs, actions=actions, rtgs=rtg, timesteps=timesteps)
+                elif isinstance(model, CloneTransformer):
+                    state_preds, action_preds = model.forward(
+                        states=obs, actions=actions, timesteps=timesteps)
+                else:  # it's probably a legacy model in which case the interface is:
+                    steps = min(model.transformer_config.n_ctx // 3, obs.shape[1])
+                    state_preds, action_preds, reward_preds = model.forward(
+                        states=obs[:, -steps:], actions=context.get_previous_actions(steps),
+                        rtgs=rtg[:, -steps:], timesteps=timesteps[:, -steps:])
+
+            # the action is predicted from the last state
+            new_action = t.argmax(action_preds[:, -1], dim=-1)
+            new_obs, new_reward, terminated, truncated, info = env.step(new_action)
 
         n_positive = n_positive + sum(new_reward > 0)
         reward_total += sum(new_reward)
@@ -24,6 +24,7 @@ class DTArgs:
     n_layers: int = 2
     n_ctx: int = 3
     layer_norm: bool = False
+    fast_path: bool = False
     batch_size: int = 64
     train_epochs: int = 10
     test_epochs: int = 3
@@ -43,6 +44,10 @@ class DTArgs:
     prob_go_from_end: float = 0.1
     eval_max_time_steps: int = 1000
     cuda: bool = True
+    num_workers: int = 0
+    prefetch_factor: int = 2
+    persistent_workers: bool = False
+    pin_memory: bool = False
 
 
 def parse_args():
@@ -58,6 +63,8 @@ def parse_args():
     parser.add_argument("--n_layers", type=int, default=2)
     parser.add_argument("--n_ctx", type=int, default=3)
     parser.add_argument("--layer_norm", type=bool, default=False)
+    parser.add_argument("--fast_path", type=bool, default=False,
+                        action=argparse.BooleanOptionalAction)
     parser.add_argument("--batch_size", type=int, default=64)
     parser.add_argument("--train_epochs", type=int, default=10)
     parser.add_argument("--test_epochs", type=int, default=3)
@@ -78,9 +85,19 @@ def parse_args():
                         help='<Required> Set flag', required=False, default=[0, 1])
     parser.add_argument("--prob_go_from_end", type=float, default=0.1)
     parser.add_argument("--eval_max_time_steps", type=int, default=1000)
+    parser.add_argument("--eval_vector_env", type=str, default="sync",
+                        choices=["sync", "async", "async_shared_memory"])
     parser.add_argument("--cuda", action=argparse.BooleanOptionalAction)
     parser.add_argument("--model_type", type=str,
                         default="decision_transformer")
+    parser.add_argument("--num_workers", type=int, default=0)
+    parser.add_argument("--prefetch_factor", type=int, default=2)
+    parser.add_argument("--persistent_workers", type=bool, default=False,
+                        action=argparse.BooleanOptionalAction)
+    parser.add_argument("--pin_memory", type=bool, default=False,
+                        action=argparse.BooleanOptionalAction)
+    parser.add_argument("--precision", type=str, default="fp32",
+                        choices=["fp32", "bf16"])
     args = parser.parse_args()
     return args
 
@@ -1,4 +1,7 @@
 import gymnasium as gym
+import numpy as np
+from gymnasium.vector.utils import batch_space
+from gymnasium.wrappers import FilterObservation
 from .wrappers import RenderResizeWrapper, ViewSizeWrapper
 from minigrid.wrappers import FullyObsWrapper, OneHotPartialObsWrapper
 
@@ -60,3 +63,185 @@ def make_env(
         return env
 
     return thunk
+
+
+def make_env_fns(environment_config, run_name, env_idxs):
+    '''
+    Returns the make_env thunks of the environments with the given indices,
+    as configured by an EnvironmentConfig. Environment i is seeded with
+    environment_config.seed + i and only environment 0 records videos.
+    '''
+    return [make_env(
+        env_id=environment_config.env_id,
+        seed=environment_config.seed + i,
+        idx=i,
+        capture_video=environment_config.capture_video,
+        run_name=run_name,
+        max_steps=environment_config.max_steps,
+        fully_observed=environment_config.fully_observed,
+        flat_one_hot=environment_config.one_hot_obs,
+        agent_view_size=environment_config.view_size,
+        render_mode="rgb_array",
+    ) for i in env_idxs]
+
+
+VECTOR_ENVS = ["sync", "async", "async_shared_memory"]
+
+
+def make_vector_env(env_fns, vector_env="sync", pipelined=False):
+    '''
+    Vectorizes the environment thunks returned by make_env.
+
+    Args:
+        env_fns: the thunks, one per environment.
+        vector_env: how the environments are stepped.
+            - "sync": one after another in this process.
+            - "async": in parallel, one subprocess per environment, with
+                observations sent back through pipes.
+            - "async_shared_memory": like "async", but observations are
+                written to shared memory. Shared memory only holds arrays,
+                so the text mission is dropped from MiniGrid observations.
+        pipelined: if True, the first and second half of the environments
+            are vectorized separately and wrapped in a PipelinedVectorEnv.
+
+    Attributes of the environments, like run_name, are read with
+    envs.get_attr, which works for every vector env.
+    '''
+    assert vector_env in VECTOR_ENVS, f"vector_env must be one of {VECTOR_ENVS}"
+
+    if pipelined:
+        assert len(env_fns) >= 2, "A pipelined vector env needs at least two environments"
+        half = len(env_fns) // 2
+        return PipelinedVectorEnv([
+            make_vector_env(env_fns[:half], vector_env),
+            make_vector_env(env_fns[half:], vector_env)])
+    if vector_env == "sync":
+        return gym.vector.SyncVectorEnv(env_fns)
+    if vector_env == "async":
+        return gym.vector.AsyncVectorEnv(env_fns, shared_memory=False)
+    return gym.vector.AsyncVectorEnv(
+        [without_mission(env_fn) for env_fn in env_fns], shared_memory=True)
+
+
+def without_mission(env_fn):
+    '''
+    Wraps an environment thunk to remove the mission from dict observations.
+    '''
+
+    def thunk():
+        env = env_fn()
+        if isinstance(env.observation_space, gym.spaces.Dict) and \
+                "mission" in env.observation_space.spaces:
+            env = FilterObservation(env, [
+                key for key in env.observation_space.spaces if key != "mission"])
+        return env
+
+    return thunk
+
+
+class PipelinedVectorEnv(gym.vector.VectorEnv):
+    '''
+    Two vector envs, each stepping half of the environments, so that a
+    rollout can run the policy on one half while the other half steps (see
+    PPOAgent.pipelined_rollout). Stepping only overlaps with the policy if
+    the halves are asynchronous, otherwise a half steps in step_wait.
+
+    As a whole it behaves like a vector env of all the environments, with
+    both halves stepping at the same time.
+    '''
+
+    def __init__(self, halves):
+        self.halves = halves
+        self.num_envs = sum(half.num_envs for half in halves)
+        self.env_slices = [slice(0, halves[0].num_envs), slice(halves[0].num_envs, self.num_envs)]
+        self.single_observation_space = halves[0].single_observation_space
+        self.single_action_space = halves[0].single_action_space
+        self.observation_space = batch_space(self.single_observation_space, self.num_envs)
+        self.action_space = batch_space(self.single_action_space, self.num_envs)
+        self.metadata = halves[0].metadata
+        self.render_mode = halves[0].render_mode
+        # the actions of halves without step_async, stepped in step_wait
+        self.actions = [None, None]
+
+    def reset(self, *, seed=None, options=None):
+        if seed is None or isinstance(seed, int):
+            # like the other vector envs, env i is seeded with seed + i
+            seeds = [seed, None if seed is None else seed + self.halves[0].num_envs]
+        else:
+            seeds = [seed[env_slice] for env_slice in self.env_slices]
+        results = [half.reset(seed=half_seed, options=options)
+                   for half, half_seed in zip(self.halves, seeds)]
+        return (concatenate_observations([obs for obs, _ in results]),
+                self.concatenate_infos([info for _, info in results]))
+
+    def step_async(self, half, actions):
+        '''Starts stepping the given half (0 or 1) with its actions.'''
+        if hasattr(self.halves[half], "step_async"):
+            self.halves[half].step_async(actions)
+        else:
+            self.actions[half] = actions
+
+    def step_wait(self, half):
+        '''Returns the results of the step of the given half.'''
+        if hasattr(self.halves[half], "step_wait"):
+            return self.halves[half].step_wait()
+        return self.halves[half].step(self.actions[half])
+
+    def step(self, actions):
+        for half, env_slice in enumerate(self.env_slices):
+            self.step_async(half, actions[env_slice])
+        results = [self.step_wait(half) for half in range(2)]
+        obs, rewards, terminated, truncated, infos = zip(*results)
+        return (concatenate_observations(obs), np.concatenate(rewards),
+                np.concatenate(terminated), np.concatenate(truncated),
+                self.concatenate_infos(infos))
+
+    def concatenate_infos(self, infos):
+        '''Concatenates the infos of the two halves.'''
+        return concatenate_infos(infos, [half.num_envs for half in self.halves])
+
+    def get_attr(self, name):
+        return sum((half.get_attr(name) for half in self.halves), ())
+
+    def close_extras(self, **kwargs):
+        for half in self.halves:
+            half.close(**kwargs)
+
+
+def concatenate_observations(observations):
+    '''
+    Concatenates batched observations (arrays, or dicts and tuples of them)
+    along the environment dimension.
+    '''
+    if isinstance(observations[0], dict):
+        return {key: concatenate_observations([obs[key] for obs in observations])
+                for key in observations[0]}
+    if isinstance(observations[0], tuple):
+        return sum(observations, ())
+    return np.concatenate(observations)
+
+
+def concatenate_infos(infos, num_envs):
+    '''
+    Concatenates vector env infos, in which every value is an array with an
+    entry per environment (or a dict of them), along the environment
+    dimension. Values missing from some of the infos are zero (or None).
+
+    Args:
+        infos: the infos to concatenate.
+        num_envs: the number of environments of each info.
+    '''
+    concatenated = {}
+    for key in {key: None for info in infos for key in info}:
+        values = [info.get(key) for info in infos]
+        example = next(value for value in values if value is not None)
+        if isinstance(example, dict):
+            concatenated[key] = concatenate_infos(
+                [{} if value is None else value for value in values], num_envs)
+            continue
+        concatenated[key] = np.concatenate([
+            value if value is not None else
+            np.full((n, *example.shape[1:]), None, dtype=object) if example.dtype == object else
+            np.zeros((n, *example.shape[1:]), dtype=example.dtype)
+            for value, n in zip(values, num_envs)])
+    return concatenated
@@ -10,6 +10,8 @@ from einops import rearrange
 from gymnasium.spaces import Box, Dict
 from torchtyping import TensorType as TT
 from transformer_lens import HookedTransformer, HookedTransformerConfig
+from transformer_lens.past_key_value_caching import \
+    HookedTransformerKeyValueCache
 
 from src.config import EnvironmentConfig, TransformerModelConfig
 
@@ -47,6 +49,15 @@ class TrajectoryTransformer(nn.Module):
             self.transformer_config.d_model, environment_config.action_space.n)
         self.initialize_state_predictor()
 
+        # see interleave_embeddings
+        self.reuse_token_buffer = False
+        self.token_buffer = None
+
+        # see run_transformer and get_fused_qkv
+        self.fast_path = getattr(transformer_config, "fast_path", False)
+        self.fused_qkv = None
+        self.register_load_state_dict_post_hook(TrajectoryTransformer.clear_fused_qkv)
+
     def get_time_embedding(self, timesteps):
 
         assert timesteps.max(
@@ -97,6 +108,146 @@ class TrajectoryTransformer(nn.Module):
             action_embeddings, '(batch block) n_embd -> batch block n_embd', block=block_size)
         return action_embeddings
 
+    def interleave_embeddings(self, embeddings, trajectory_length):
+        '''
+        Interleaves one (batch, block, d_model) embedding per token type into
+        token embeddings (batch, trajectory_length, d_model), so that token
+        i * len(embeddings) + j is embeddings[j][:, i]. This takes a single
+        stack, the reshape and slice are views.
+
+        With reuse_token_buffer set and gradients disabled the stack writes
+        into a buffer kept between calls, so the returned embeddings are
+        only valid until the next call.
+        '''
+        batch, block, d_model = embeddings[0].shape
+        shape = (batch, block, len(embeddings), d_model)
+
+        if getattr(self, "reuse_token_buffer", False) and not torch.is_grad_enabled():
+            buffer = getattr(self, "token_buffer", None)
+            if buffer is None or buffer.numel() < np.prod(shape) or \
+                    buffer.device != embeddings[0].device or buffer.dtype != embeddings[0].dtype:
+                buffer = torch.empty(
+                    int(np.prod(shape)), dtype=embeddings[0].dtype, device=embeddings[0].device)
+                self.token_buffer = buffer
+            tokens = torch.stack(
+                embeddings, dim=2, out=buffer[:int(np.prod(shape))].view(shape))
+        else:
+            tokens = torch.stack(embeddings, dim=2)
+
+        return tokens.reshape(batch, -1, d_model)[:, :trajectory_length]
+
+    def start_episode(self, batch_size=1, window_stride=1):
+        '''
+        Starts incremental decoding of a batch of rollouts, see step.
+
+        Args:
+            batch_size: number of rollouts decoded together
+            window_stride: number of timesteps the context window slides by
+                once it is full. 1 reproduces a forward pass over the last
+                n_ctx tokens exactly, larger strides re-encode the window
+                less often at the cost of a shorter context after a slide.
+        '''
+        self.episode_cache = EpisodeCache(
+            self.transformer.cfg, batch_size,
+            device=next(self.parameters()).device,
+            window_stride=window_stride)
+        return self.episode_cache
+
+    @property
+    def tokens_per_timestep(self):
+        return 2
+
+    def step(self, new_tokens):
+        '''
+        Runs new token embeddings (batch, new_tokens, d_model) through the
+        transformer, attending to the tokens of earlier steps through their
+        cached keys and values rather than recomputing them.
+
+        Position embeddings are absolute, so once the window exceeds n_ctx
+        the cached keys and values of the tokens that remain no longer match
+        their new positions. The oldest timesteps (whole ones, so the window
+        starts at a timestep boundary) are then dropped and the rest of the
+        window is re-encoded from position 0, starting from the cached token
+        embeddings.
+
+        Returns:
+            x: the residual stream of the new tokens (batch, new_tokens, d_model)
+        '''
+        cache = self.episode_cache
+        n_ctx = self.transformer_config.n_ctx
+        num_new = new_tokens.shape[1]
+        total = cache.length + num_new
+
+        if total > n_ctx:
+            # the window always starts at the first token of a timestep,
+            # like the context of a full forward pass
+            timestep = self.tokens_per_timestep
+            min_dropped = -(-(total - n_ctx) // timestep) * timestep
+            num_dropped = min_dropped + (cache.window_stride - 1) * timestep
+            num_dropped = min(num_dropped, max(
+                min_dropped, (total - num_new) // timestep * timestep))
+            window = torch.cat(
+                [cache.tokens[:, :cache.length], new_tokens], dim=1)[:, num_dropped:]
+            cache.reset()
+            new_tokens = window
+
+        num_new = new_tokens.shape[1]
+        cache.tokens[:, cache.length:cache.length + num_new] = new_tokens
+        x = self.run_cached(new_tokens, cache.kv_cache, cache.length)
+        cache.length += num_new
+        return x[:, -num_new:]
+
+    def run_cached(self, tokens, kv_cache, pos_offset):
+        '''
+        The forward pass of the HookedTransformer for token embeddings
+        starting at pos_offset, with the keys and values of the earlier
+        positions taken from (and appended to) kv_cache.
+        '''
+        transformer = self.transformer
+        residual = transformer.hook_embed(transformer.embed(tokens)) + \
+            transformer.hook_pos_embed(transformer.pos_embed(tokens, pos_offset))
+        for block, kv_cache_entry in zip(transformer.blocks, kv_cache.entries):
+            residual = block(residual, past_kv_cache_entry=kv_cache_entry)
+        if transformer.cfg.normalization_type is not None:
+            residual = transformer.ln_final(residual)
+        return transformer.unembed(residual)
+
+    def run_transformer(self, tokens):
+        '''
+        Runs token embeddings (batch, position, d_model) through the
+        transformer. With fast_path set this skips the hook points of the
+        HookedTransformer, see fast_forward, which is numerically the same
+        (up to float rounding) with the same parameters. Set fast_path to
+        False to run (and hook) the HookedTransformer, e.g. for analysis.
+        '''
+        if self.fast_path:
+            return fast_forward(self.transformer, tokens, self.get_fused_qkv())
+        return self.transformer(tokens)
+
+    def get_fused_qkv(self):
+        '''
+        The query, key and value weights and biases of every block of the
+        transformer fused for fast_forward, see fuse_qkv. When no gradients
+        are needed (rollouts, evaluation) they are cached, until
+        load_state_dict or an in place update of the weights (such as an
+        optimizer step) changes them.
+        '''
+        attns = [block.attn for block in self.transformer.blocks]
+        weights = [W for attn in attns
+                   for W in (attn.W_Q, attn.W_K, attn.W_V, attn.b_Q, attn.b_K, attn.b_V)]
+        if torch.is_grad_enabled() and any(W.requires_grad for W in weights):
+            return [fuse_qkv(attn) for attn in attns]
+
+        key = [(W.data_ptr(), W._version, W.dtype) for W in weights]
+        if self.fused_qkv is None or self.fused_qkv[0] != key:
+            with torch.no_grad():
+                self.fused_qkv = (key, [fuse_qkv(attn) for attn in attns])
+        return self.fused_qkv[1]
+
+    def clear_fused_qkv(self, *args):
+        '''Clears the cache of get_fused_qkv (a load_state_dict post hook).'''
+        self.fused_qkv = None
+
     def predict_states(self, x):
         return self.state_predictor(x)
 
@@ -228,6 +379,45 @@ class DecisionTransformer(TrajectoryTransformer):
     def predict_rewards(self, x):
         return self.reward_predictor(x)
 
+    @property
+    def tokens_per_timestep(self):
+        return 3
+
+    def predict_next_action(self, states, rtgs, timesteps, actions=None):
+        '''
+        Incremental version of get_action for rollouts: embeds a single new
+        timestep and runs its tokens through step, so every env step costs
+        the same however long the episode is. Call start_episode first.
+
+        Args:
+            states: (batch, 1, ...) the new state
+            rtgs: (batch, 1, 1) the new reward to go
+            timesteps: (batch, 1, 1) the new timestep
+            actions: (batch, 1, 1) the action taken at the previous timestep,
+                None for the first timestep of an episode
+
+        Returns:
+            action_preds: (batch, n_actions)
+        '''
+        cache = self.episode_cache
+        time_embeddings = self.get_time_embedding(timesteps)
+        new_tokens = [
+            self.get_reward_embedding(rtgs) + time_embeddings,
+            self.get_state_embedding(states) + time_embeddings]
+
+        if actions is not None:
+            if cache.previous_time_embeddings is None:
+                raise ValueError("There is no previous timestep to take actions at")
+            # the action belongs to (and is timed as) the previous timestep
+            new_tokens.insert(
+                0, self.get_action_embedding(actions) + cache.previous_time_embeddings)
+        cache.previous_time_embeddings = time_embeddings
+
+        x = self.step(torch.cat(new_tokens, dim=1))
+
+        # predict next action given state and RTG
+        return self.predict_actions(x[:, -1])
+
     def get_token_embeddings(self,
                              state_embeddings,
                              time_embeddings,
@@ -251,7 +441,6 @@ class DecisionTransformer(TrajectoryTransformer):
         1.1 and 2.1 are the same, but we need to handle the target as the initial reward.
 
         '''
-        batches = state_embeddings.shape[0]
         timesteps = time_embeddings.shape[1]
 
         reward_embeddings = reward_embeddings + time_embeddings
@@ -273,18 +462,15 @@ class DecisionTransformer(TrajectoryTransformer):
         if targets:
             targets = targets + time_embeddings
 
-        # create the token embeddings
-        token_embeddings = torch.zeros(
-            (batches, trajectory_length, self.transformer_config.d_model),
-            dtype=torch.float32, device=state_embeddings.device)  # batches, blocksize, n_embd
-
         if action_embeddings is not None:
-            token_embeddings[:, ::3, :] = reward_embeddings
-            token_embeddings[:, 1::3, :] = state_embeddings
-            token_embeddings[:, 2::3, :] = action_embeddings
+            if action_embeddings.shape[1] < timesteps:
+                # the missing action's slot is cut off after interleaving
+                action_embeddings = F.pad(action_embeddings, (0, 0, 0, 1))
+            token_embeddings = self.interleave_embeddings(
+                [reward_embeddings, state_embeddings, action_embeddings], trajectory_length)
         else:
-            token_embeddings[:, 0, :] = reward_embeddings[:, 0, :]
-            token_embeddings[:, 1, :] = state_embeddings[:, 0, :]
+            token_embeddings = self.interleave_embeddings(
+                [reward_embeddings[:, :1], state_embeddings[:, :1]], trajectory_length)
 
         if targets is not None:
             target_embedding = self.reward_embedding(targets)
@@ -334,20 +520,19 @@ class DecisionTransformer(TrajectoryTransformer):
     def get_logits(self, x, batch_size, seq_length, no_actions: bool):
 
         if no_actions is False:
-            # TODO replace with einsum
+            # strided views of the state and action positions
+            x_state = x[:, 1::3]
+            x_action = x[:, 2::3]
             if (x.shape[1] % 3 != 0) and ((x.shape[1] + 1) % 3 == 0):
-                x = torch.concat((x, x[:, -2].unsqueeze(1)), dim=1)
-
-            x = x.reshape(batch_size, seq_length, 3,
-                          self.transformer_config.d_model)
-            x = x.permute(0, 2, 1, 3)
+                # the last timestep has no action, predict from its state
+                x_action = torch.concat((x_action, x[:, -2:-1]), dim=1)
 
             # predict next return given state and action
-            reward_preds = self.predict_rewards(x[:, 2])
+            reward_preds = self.predict_rewards(x_action)
             # predict next state given state and action
-            state_preds = self.predict_states(x[:, 2])
+            state_preds = self.predict_states(x_action)
             # predict next action given state and RTG
-            action_preds = self.predict_actions(x[:, 1])
+            action_preds = self.predict_actions(x_state)
             return state_preds, action_preds, reward_preds
 
         else:
@@ -387,7 +572,7 @@ class DecisionTransformer(TrajectoryTransformer):
 
         # embed states and recast back to (batch, block_size, n_embd)
         token_embeddings = self.to_tokens(states, actions, rtgs, timesteps)
-        x = self.transformer(token_embeddings)
+        x = self.run_transformer(token_embeddings)
         state_preds, action_preds, reward_preds = self.get_logits(
             x, batch_size, seq_length, no_actions=no_actions)
 
@@ -428,7 +613,6 @@ class CloneTransformer(TrajectoryTransformer):
         Returns:
             token_embeddings: (batch, position, n_embd)
         '''
-        batches = state_embeddings.shape[0]
         timesteps = time_embeddings.shape[1]
 
         state_embeddings = state_embeddings + time_embeddings
@@ -437,29 +621,20 @@ class CloneTransformer(TrajectoryTransformer):
             if action_embeddings.shape[1] == time_embeddings.shape[1] - 1:
                 # missing action for last t-step.
                 action_embeddings = action_embeddings + time_embeddings[:, :-1]
-                # repeat the last action embedding for the last timestep
-                action_embeddings = torch.cat(
-                    [action_embeddings, action_embeddings[:, -1, :].unsqueeze(1)], dim=1)
+                # repeat the last action embedding for the last timestep by
+                # indexing rather than concatenating
+                repeat_last = torch.arange(timesteps, device=action_embeddings.device)
+                action_embeddings = action_embeddings[:, repeat_last.clamp(max=timesteps - 2)]
                 # now the last action and second last are duplicates but we can fix this later. (TODO)
                 trajectory_length = timesteps * 2
             else:
                 action_embeddings = action_embeddings + time_embeddings
                 trajectory_length = timesteps * 2
-        else:
-            trajectory_length = 1  # one timestep, no action yet
+            return self.interleave_embeddings(
+                [state_embeddings, action_embeddings], trajectory_length)
 
-        # create the token embeddings
-        token_embeddings = torch.zeros(
-            (batches, trajectory_length, self.transformer_config.d_model),
-            dtype=torch.float32, device=state_embeddings.device)  # batches, blocksize, n_embd
-
-        if action_embeddings is not None:
-            token_embeddings[:, 0::2, :] = state_embeddings
-            token_embeddings[:, 1::2, :] = action_embeddings
-        else:
-            token_embeddings[:, 0, :] = state_embeddings[:, 0, :]
-
-        return token_embeddings
+        # one timestep, no action yet
+        return self.interleave_embeddings([state_embeddings[:, :1]], 1)
 
     def to_tokens(self, states, actions, timesteps):
 
@@ -515,18 +690,18 @@ class CloneTransformer(TrajectoryTransformer):
 
         if actions is not None:
             if actions.shape[1] == states.shape[1] - 1:
-                x = self.transformer(token_embeddings[:, :-1])
+                x = self.run_transformer(token_embeddings[:, :-1])
                 # concat last action embedding to the end of the transformer output x[:,-2].unsqueeze(1)
                 x = torch.cat(
                     [x, token_embeddings[:, -2, :].unsqueeze(1)], dim=1)
                 state_preds, action_preds = self.get_logits(
                     x, batch_size, seq_length, no_actions=no_actions)
             else:
-                x = self.transformer(token_embeddings)
+                x = self.run_transformer(token_embeddings)
                 state_preds, action_preds = self.get_logits(
                     x, batch_size, seq_length, no_actions=no_actions)
         else:
-            x = self.transformer(token_embeddings)
+            x = self.run_transformer(token_embeddings)
             state_preds, action_preds = self.get_logits(
                 x, batch_size, seq_length, no_actions=no_actions)
 
@@ -629,6 +804,52 @@ class CriticTransfomer(CloneTransformer):
         return self.value_predictor(x)
 
 
+class ActorCriticTransformer(CloneTransformer):
+    '''
+    A clone transformer with both an action and a value head on the same
+    trunk, so one forward pass returns the action predictions and the values.
+
+    The value loss reaches the trunk scaled by value_trunk_weight (the value
+    head is trained with the full loss), to weigh it against the policy
+    loss in the shared parameters.
+    '''
+
+    def __init__(
+        self,
+        transformer_config: TransformerModelConfig,
+        environment_config: EnvironmentConfig,
+        value_trunk_weight: float = 1.0
+    ):
+        super().__init__(transformer_config, environment_config)
+        self.value_predictor = nn.Linear(
+            transformer_config.d_model, 1, bias=True
+        )
+        self.value_trunk_weight = value_trunk_weight
+
+    def forward(self,
+                # has variable shape, starting with batch, position
+                states: TT[...],
+                actions: TT["batch", "position"],  # noqa: F821
+                timesteps: TT["batch", "position"],  # noqa: F821
+                pad_action: bool = True
+                ) -> Tuple[TT["batch", "position"], TT[...]]:  # noqa: F821
+
+        _, preds = super().forward(
+            states, actions, timesteps, pad_action=pad_action)
+
+        return preds[..., :-1], preds[..., -1:]
+
+    # the action and value predictions from the same state tokens, split in forward
+    def predict_actions(self, x):
+        if self.value_trunk_weight != 1.0:
+            # same values, but the gradient into the trunk is scaled
+            w = self.value_trunk_weight
+            value_x = x * w + x.detach() * (1 - w)
+        else:
+            value_x = x
+        return torch.cat([self.action_predictor(x), self.value_predictor(value_x)], dim=-1)
+
+
 class StateEncoder(nn.Module):
     def __init__(self, n_embed):
         super(StateEncoder, self).__init__()
@@ -651,6 +872,72 @@ class StateEncoder(nn.Module):
         return x
 
 
+def fuse_qkv(attn):
+    '''
+    Returns the query, key and value weights (d_model, 3 * n_heads * d_head)
+    and biases (3 * n_heads * d_head,) of an attention layer of a
+    HookedTransformer, concatenated for a single matmul.
+    '''
+    W_QKV = torch.cat([W.permute(1, 0, 2).flatten(1)
+                       for W in (attn.W_Q, attn.W_K, attn.W_V)], dim=1)
+    b_QKV = torch.cat([attn.b_Q.flatten(), attn.b_K.flatten(), attn.b_V.flatten()])
+    return W_QKV, b_QKV
+
+
+def fast_forward(transformer: HookedTransformer, tokens, fused_qkv=None):
+    '''
+    The forward pass of a HookedTransformer over token embeddings (as set up
+    by TrajectoryTransformer.initialize_easy_transformer) with its own
+    parameters, but without its hook points and string einsums: one matmul
+    for the queries, keys and values of all heads (fused_qkv, see fuse_qkv,
+    computed here if not given), causal scaled_dot_product_attention and
+    plain matmuls for the rest. Hooks on the transformer are not run.
+
+    Under bfloat16 autocast the attention runs in float32, as the attention
+    softmax of the hooked transformer does with src.precision.autocast.
+    '''
+    cfg = transformer.cfg
+    assert cfg.positional_embedding_type == "standard" and not cfg.use_split_qkv_input \
+        and not cfg.parallel_attn_mlp and not cfg.act_fn.endswith("_ln") \
+        and cfg.normalization_type in [None, "LN"], \
+        "The fast path only supports the transformers of trajectory models"
+    batch, position, d_model = tokens.shape
+    if fused_qkv is None:
+        fused_qkv = [fuse_qkv(block.attn) for block in transformer.blocks]
+    device_type = tokens.device.type
+    bf16 = torch.is_autocast_enabled(device_type) and \
+        torch.get_autocast_dtype(device_type) == torch.bfloat16
+
+    def normalize(ln, x):
+        if cfg.normalization_type is None:
+            return x
+        return F.layer_norm(x, (d_model,), ln.w, ln.b, eps=cfg.eps)
+
+    residual = tokens + transformer.pos_embed.W_pos[:position]
+    for block, (W_QKV, b_QKV) in zip(transformer.blocks, fused_qkv):
+        attn = block.attn
+        x = normalize(block.ln1, residual)
+        qkv = (x @ W_QKV + b_QKV).view(batch, position, 3, cfg.n_heads, cfg.d_head)
+        # (batch, n_heads, position, d_head) each
+        q, k, v = qkv.permute(2, 0, 3, 1, 4).unbind(0)
+        if bf16:
+            with torch.autocast(device_type, enabled=False):
+                z = F.scaled_dot_product_attention(
+                    q.float(), k.float(), v.float(), is_causal=True, scale=1 / attn.attn_scale)
+        else:
+            z = F.scaled_dot_product_attention(q, k, v, is_causal=True, scale=1 / attn.attn_scale)
+        z = z.transpose(1, 2).reshape(batch, position, cfg.n_heads * cfg.d_head)
+        residual = residual + z @ attn.W_O.flatten(0, 1) + attn.b_O
+        if not cfg.attn_only:
+            mlp = block.mlp
+            x = normalize(block.ln2, residual)
+            residual = residual + mlp.act_fn(x @ mlp.W_in + mlp.b_in) @ mlp.W_out + mlp.b_out
+
+    if cfg.normalization_type is not None:
+        residual = normalize(transformer.ln_final, residual)
+    return residual
+
+
 class PosEmbedTokens(nn.Module):
     def __init__(self, cfg: Union[Dict, HookedTransformerConfig]):
         super().__init__()
@@ -667,8 +954,38 @@ class PosEmbedTokens(nn.Module):
         Output shape [pos, d_model] - will be broadcast along batch dim"""
 
         tokens_length = tokens.size(-2)
-        pos_embed = self.W_pos[:tokens_length, :]  # [pos, d_model]
+        pos_embed = self.W_pos[past_kv_pos_offset:past_kv_pos_offset +
+                               tokens_length, :]  # [pos, d_model]
         broadcast_pos_embed = einops.repeat(
             pos_embed, "pos d_model -> batch pos d_model", batch=tokens.size(0)
         )  # [batch, pos, d_model]
         return broadcast_pos_embed
+
+
+class EpisodeCache():
+    '''
+    The inference state of a trajectory transformer during a batch of
+    rollouts: the keys and values of every layer for the tokens in the
+    context window, and the token embeddings themselves so that the window
+    can be re-encoded when it slides.
+    '''
+
+    def __init__(self, cfg: HookedTransformerConfig, batch_size, device, window_stride=1):
+        assert window_stride >= 1, "The window must slide by at least one timestep"
+        self.cfg = cfg
+        self.batch_size = batch_size
+        self.device = device
+        self.window_stride = window_stride
+        self.tokens = torch.zeros(
+            (batch_size, cfg.n_ctx, cfg.d_model), dtype=torch.float32, device=device)
+        self.previous_time_embeddings = None
+        self.reset()
+
+    def reset(self):
+        '''
+        Empties the key value cache, the token embeddings are overwritten as
+        the window is refilled.
+        '''
+        self.kv_cache = HookedTransformerKeyValueCache.init_cache(
+            self.cfg, self.device, self.batch_size)
+        self.length = 0
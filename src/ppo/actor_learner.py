@@ -0,0 +1,377 @@
+'''
+Decoupled actor/learner PPO.
+
+Rollout workers, each in its own process with its own envs and a CPU copy
+of the policy, roll out with PPOAgent.rollout and write every rollout into
+shared memory slots. The learner concatenates one rollout per worker into
+its Memory, learns on it and broadcasts its new weights to the workers.
+
+A worker has two slots, so it rolls out the next batch while the learner
+learns on the last one, with weights up to one update old. Rollouts older
+than online_config.max_policy_lag updates are dropped, and the lag of the
+others can be corrected for (see correct_rollout).
+'''
+import os
+import queue
+from dataclasses import dataclass
+from typing import List, Optional
+
+import numpy as np
+import torch as t
+import torch.multiprocessing as mp
+from gymnasium.vector import VectorEnv
+from torch.distributions.categorical import Categorical
+from tqdm.autonotebook import tqdm
+
+from src.config import (EnvironmentConfig, OnlineTrainConfig, RunConfig,
+                        TransformerModelConfig)
+from src.environments.environments import make_env_fns, make_vector_env
+from src.utils import TrajectoryWriter
+
+from .agent import FCAgent, PPOAgent
+from .compute_adv_vectorized import compute_vtrace
+from .memory import Memory
+from .train import (check_and_upload_new_video, device, get_agent,
+                    prepare_video_dir)
+
+SLOTS_PER_WORKER = 2
+# workers are forked where possible, so they don't import everything again
+START_METHOD = "fork" if "fork" in mp.get_all_start_methods() else "spawn"
+
+
+@dataclass
+class Rollout:
+    '''
+    A rollout of a worker, in one of its shared memory slots.
+
+    tensors are the (obs, done, action, logprob, value, reward) buffers of
+    shape [num_steps, num_envs, ...] followed by next_obs, next_done and
+    next_value. version is the version of the weights it was collected with.
+    '''
+    worker_idx: int
+    slot: int
+    version: int
+    tensors: List[t.Tensor]
+    episode_lengths: list
+    episode_returns: list
+    global_steps: int
+
+
+class SharedPolicy():
+    '''
+    The weights of the learner's policy in shared memory, with the number
+    of times they have been updated as their version.
+    '''
+
+    def __init__(self, agent: PPOAgent, ctx):
+        self.state_dict = {name: tensor.detach().cpu().clone().share_memory_()
+                           for name, tensor in agent.state_dict().items()}
+        self.version = ctx.Value("i", 0, lock=False)
+        self.lock = ctx.Lock()
+
+    def publish(self, agent: PPOAgent) -> None:
+        '''Copies the weights of agent into shared memory as a new version.'''
+        with self.lock:
+            for name, tensor in agent.state_dict().items():
+                self.state_dict[name].copy_(tensor)
+            self.version.value += 1
+
+    def load(self, agent: PPOAgent) -> int:
+        '''Copies the latest weights into agent and returns their version.'''
+        with self.lock:
+            agent.load_state_dict(self.state_dict)
+            return self.version.value
+
+
+def get_worker_trajectory_path(path: str, worker_idx: int) -> str:
+    '''Returns the path the trajectories of a worker are written to.'''
+    root, extension = os.path.splitext(path.rstrip("/"))
+    return f"{root}_worker{worker_idx}{extension}"
+
+
+def rollout_worker(
+        worker_idx: int,
+        env_idxs: List[int],
+        run_config: RunConfig,
+        online_config: OnlineTrainConfig,
+        environment_config: EnvironmentConfig,
+        transformer_model_config: Optional[TransformerModelConfig],
+        policy: SharedPolicy,
+        rollouts,
+        free_slots,
+        stop,
+        trajectory_writer: Optional[TrajectoryWriter] = None):
+    '''
+    The loop of a rollout worker process. Until stop is set, rolls out
+    online_config.num_steps steps of its envs with the latest weights of
+    policy, waits for a free slot and puts the rollout in it.
+    '''
+    t.set_num_threads(1)
+    t.manual_seed(run_config.seed + 1 + worker_idx)
+
+    envs = make_vector_env(
+        make_env_fns(environment_config, run_config.run_name, env_idxs),
+        vector_env=environment_config.vector_env,
+        pipelined=online_config.pipelined_rollout)
+    agent = get_agent(transformer_model_config, envs, environment_config,
+                      online_config, device=t.device("cpu"))
+    memory = Memory(envs, online_config, t.device("cpu"))
+
+    slots = None
+    while not stop.is_set():
+        version = policy.load(agent)
+        global_step = memory.global_step
+        agent.rollout(memory, online_config.num_steps, envs, trajectory_writer)
+
+        tensors = [*memory.get_buffers(), memory.next_obs, memory.next_done, memory.next_value]
+        if slots is None:
+            slots = [[tensor.clone().share_memory_() for tensor in tensors]
+                     for _ in range(SLOTS_PER_WORKER)]
+        slot = None
+        while slot is None and not stop.is_set():
+            try:
+                slot = free_slots.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        if slot is None:
+            break
+
+        for shared_tensor, tensor in zip(slots[slot], tensors):
+            shared_tensor.copy_(tensor)
+        rollouts.put(Rollout(
+            worker_idx, slot, version, slots[slot],
+            memory.episode_lengths, memory.episode_returns,
+            memory.global_step - global_step))
+        memory.reset()
+
+    if trajectory_writer is not None:
+        trajectory_writer.tag_terminated_trajectories()
+        trajectory_writer.write()
+    envs.close()
+
+
+class RolloutWorkerPool():
+    '''
+    Starts online_config.num_workers rollout worker processes, which split
+    the online_config.num_envs envs between them, and hands out their
+    rollouts.
+
+    If a trajectory writer is given, every worker writes its trajectories
+    with a copy of it, to the path given by get_worker_trajectory_path.
+    '''
+
+    def __init__(self,
+                 agent: PPOAgent,
+                 run_config: RunConfig,
+                 online_config: OnlineTrainConfig,
+                 environment_config: EnvironmentConfig,
+                 transformer_model_config: Optional[TransformerModelConfig],
+                 trajectory_writer: Optional[TrajectoryWriter] = None):
+        ctx = mp.get_context(START_METHOD)
+        self.policy = SharedPolicy(agent, ctx)
+        self.rollouts = ctx.Queue()
+        self.stop = ctx.Event()
+        self.free_slots = []
+        self.workers = []
+        # rollouts of workers that were ahead, see get_batch
+        self.held = []
+
+        num_workers = online_config.num_workers
+        envs_per_worker = online_config.num_envs // num_workers
+        for worker_idx in range(num_workers):
+            free_slots = ctx.Queue()
+            for slot in range(SLOTS_PER_WORKER):
+                free_slots.put(slot)
+
+            worker_trajectory_writer = None
+            if trajectory_writer is not None:
+                worker_trajectory_writer = TrajectoryWriter(
+                    get_worker_trajectory_path(trajectory_writer.path, worker_idx),
+                    run_config=run_config,
+                    environment_config=environment_config,
+                    online_config=online_config,
+                    transformer_model_config=transformer_model_config,
+                    chunk_size=trajectory_writer.chunk_size,
+                    stream=trajectory_writer.streaming)
+
+            env_idxs = list(range(worker_idx * envs_per_worker, (worker_idx + 1) * envs_per_worker))
+            worker = ctx.Process(
+                target=rollout_worker,
+                args=(worker_idx, env_idxs, run_config, online_config, environment_config,
+                      transformer_model_config, self.policy, self.rollouts, free_slots,
+                      self.stop, worker_trajectory_writer),
+                daemon=True)
+            worker.start()
+            self.free_slots.append(free_slots)
+            self.workers.append(worker)
+
+    def get(self) -> Rollout:
+        '''Returns the next rollout of any worker from the queue.'''
+        while True:
+            try:
+                return self.rollouts.get(timeout=1)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError("A rollout worker exited unexpectedly")
+
+    def get_batch(self, max_policy_lag: int) -> List[Rollout]:
+        '''
+        Returns one rollout of every worker, in worker order, dropping those
+        collected more than max_policy_lag updates ago. The rollouts of a
+        worker that is ahead of the others are held (in their slots) for
+        the next batches, oldest first.
+        '''
+        batch = {}
+        rollouts, self.held = self.held, []
+        while len(batch) < len(self.workers):
+            rollout = rollouts.pop(0) if rollouts else self.get()
+            if self.policy.version.value - rollout.version > max_policy_lag:
+                self.release([rollout])
+            elif rollout.worker_idx in batch:
+                self.held.append(rollout)
+            else:
+                batch[rollout.worker_idx] = rollout
+        self.held = sorted(self.held + rollouts, key=lambda rollout: rollout.version)
+        return [batch[worker_idx] for worker_idx in sorted(batch)]
+
+    def release(self, rollouts: List[Rollout]) -> None:
+        '''Frees the slots of rollouts, once they have been copied.'''
+        for rollout in rollouts:
+            self.free_slots[rollout.worker_idx].put(rollout.slot)
+
+    def broadcast(self, agent: PPOAgent) -> None:
+        '''Makes the weights of agent the ones the workers roll out with.'''
+        self.policy.publish(agent)
+
+    def close(self) -> None:
+        '''Stops the workers, once they have written their trajectories.'''
+        self.stop.set()
+        # queued rollouts have to be read for the workers to exit. Those of
+        # workers that already exited can't be rebuilt (their shared memory
+        # is passed through the worker), they are discarded anyway.
+        while any(worker.is_alive() for worker in self.workers):
+            try:
+                self.rollouts.get(timeout=0.1)
+            except (queue.Empty, OSError, EOFError):
+                pass
+        for worker in self.workers:
+            worker.join()
+
+
+def correct_rollout(agent: PPOAgent, memory: Memory, online_config: OnlineTrainConfig) -> None:
+    '''
+    Corrects the rollout in memory for the lag of the policy it was collected
+    with, the behaviour policy mu, behind the learner's policy pi.
+
+    The logprobs and values are recomputed with pi, so PPO clips the ratio to
+    pi instead of mu, and the advantages are weighted by the importance
+    ratios pi / mu truncated at online_config.importance_clip:
+        - "ratio": the GAE advantages are multiplied by the ratios.
+        - "vtrace": the advantages and value targets are V-trace's (see
+            compute_vtrace).
+    Only FCAgents, whose policy does not depend on earlier steps, are supported.
+    '''
+    assert isinstance(agent, FCAgent), "Off-policy correction requires an FCAgent"
+    obs, dones, actions, logprobs, values, rewards = memory.get_buffers()
+
+    with t.inference_mode():
+        logits, new_values = agent.get_logits_and_values(obs.flatten(0, 1))
+        new_logprobs = Categorical(logits=logits).log_prob(actions.flatten(0, 1))
+        new_values = new_values.flatten()
+        next_value = agent.get_values(memory.next_obs).flatten()
+    log_rhos = new_logprobs.view_as(logprobs) - logprobs
+    logprobs.copy_(new_logprobs.view_as(logprobs))
+    values.copy_(new_values.view_as(values))
+    memory.next_value = next_value.clone()
+    memory.advantages = {}
+
+    if online_config.off_policy_correction == "ratio":
+        advantages = memory.get_advantages(online_config.gae_lambda)
+        rhos = log_rhos.exp().clamp(max=online_config.importance_clip)
+        memory.set_advantages(
+            online_config.gae_lambda, rhos * advantages, advantages + values)
+    elif online_config.off_policy_correction == "vtrace":
+        vs, advantages = compute_vtrace(
+            memory.next_value, memory.next_done, rewards, values, dones, log_rhos,
+            online_config.gamma, online_config.importance_clip, online_config.importance_clip)
+        memory.set_advantages(online_config.gae_lambda, advantages, vs)
+
+
+def add_episode_statistics(memory: Memory, rollouts: List[Rollout]) -> None:
+    '''Adds the finished episodes and steps of the rollouts to memory's logs.'''
+    for rollout in rollouts:
+        memory.global_step += rollout.global_steps
+        for length, episode_return in zip(rollout.episode_lengths, rollout.episode_returns):
+            memory.episode_lengths.append(length)
+            memory.episode_returns.append(episode_return)
+            memory.add_vars_to_log(episode_length=length, episode_return=episode_return)
+
+
+def train_ppo_actor_learner(
+        run_config: RunConfig,
+        online_config: OnlineTrainConfig,
+        environment_config: EnvironmentConfig,
+        transformer_model_config: Optional[TransformerModelConfig],
+        envs: VectorEnv,
+        trajectory_writer=None):
+    """
+    Trains a PPO agent like train_ppo, but with the rollouts collected by
+    online_config.num_workers rollout worker processes.
+
+    Args:
+    - envs: only used for the observation and action spaces, the workers make their own
+    - trajectory_writer: an optional object, copies of which write the trajectories of each worker
+    """
+    memory = Memory(envs, online_config, device)
+    agent = get_agent(transformer_model_config, envs,
+                      environment_config, online_config)
+    num_updates = online_config.total_timesteps // online_config.batch_size
+
+    optimizer, scheduler = agent.make_optimizer(
+        num_updates=num_updates,
+        initial_lr=online_config.learning_rate,
+        end_lr=online_config.learning_rate if not online_config.decay_lr else 0.0)
+
+    if run_config.track:
+        video_path = os.path.join("videos", run_config.run_name)
+        prepare_video_dir(video_path)
+        videos = []
+
+    workers = RolloutWorkerPool(
+        agent, run_config, online_config, environment_config,
+        transformer_model_config, trajectory_writer)
+
+    try:
+        progress_bar = tqdm(range(num_updates), position=0, leave=True)
+        for _ in progress_bar:
+
+            rollouts = workers.get_batch(online_config.max_policy_lag)
+            memory.add_rollout(
+                [t.cat(buffers, dim=1) for buffers in zip(*[rollout.tensors[:6] for rollout in rollouts])],
+                *[t.cat(tensors) for tensors in zip(*[rollout.tensors[6:] for rollout in rollouts])])
+            workers.release(rollouts)
+            add_episode_statistics(memory, rollouts)
+            memory.add_vars_to_log(policy_lag=np.mean(
+                [workers.policy.version.value - rollout.version for rollout in rollouts]))
+
+            if online_config.off_policy_correction != "none":
+                correct_rollout(agent, memory, online_config)
+            agent.learn(memory, online_config, optimizer,
+                        scheduler, run_config.track)
+            workers.broadcast(agent)
+
+            if run_config.track:
+                memory.log()
+                videos = check_and_upload_new_video(
+                    video_path=video_path, videos=videos, step=memory.global_step)
+
+            output = memory.get_printable_output()
+            progress_bar.set_description(output)
+
+            memory.reset()
+    finally:
+        workers.close()
+
+    envs.close()
+
+    return agent
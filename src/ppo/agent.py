@@ -1,5 +1,6 @@
 import abc
-from typing import Tuple
+from dataclasses import dataclass
+from typing import NamedTuple, Tuple
 
 import gymnasium as gym
 import numpy as np
@@ -12,7 +13,10 @@ from .memory import Memory
 from .utils import get_obs_shape
 from .loss_functions import calc_clipped_surrogate_objective, calc_value_function_loss, calc_entropy_bonus
 
-from src.models.trajectory_model import ActorTransformer, CriticTransfomer
+from src.environments.environments import PipelinedVectorEnv
+from src.precision import autocast, to_float32
+from src.models.trajectory_model import ActorCriticTransformer, ActorTransformer, CriticTransfomer
+from src.rollout_context import RolloutContext
 from src.config import TransformerModelConfig, EnvironmentConfig, OnlineTrainConfig
 
 
@@ -50,10 +54,11 @@ class PPOAgent(nn.Module):
     actor: nn.Module
 
     @abc.abstractmethod
-    def __init__(self, envs: gym.vector.SyncVectorEnv, device):
+    def __init__(self, envs: gym.vector.VectorEnv, device, precision: str = "fp32"):
         super().__init__()
         self.envs = envs
         self.device = device
+        self.precision = precision
 
         self.critic = nn.Sequential()
         self.actor = nn.Sequential()
@@ -77,10 +82,142 @@ class PPOAgent(nn.Module):
         scheduler = PPOScheduler(optimizer, initial_lr, end_lr, num_updates)
         return (optimizer, scheduler)
 
+    def autocast(self):
+        """Returns the context the agent's forward passes run in, see src/precision.py."""
+        return autocast(self.precision, self.device, self)
+
+    def rollout(self,
+                memory: Memory,
+                num_steps: int,
+                envs: gym.vector.VectorEnv,
+                trajectory_writer=None) -> None:
+        """Performs the rollout phase of the PPO algorithm, collecting experience by interacting with the environment.
+
+        Every step the policy acts (act), the envs step and the state of the
+        rollout is updated (observe) before the step is stored (record_step).
+        A PipelinedVectorEnv is rolled out with pipelined_rollout.
+
+        Args:
+            memory (Memory): The replay buffer to store the experiences.
+            num_steps (int): The number of steps to collect.
+            envs (gym.vector.VectorEnv): The vectorized environment to interact with.
+            trajectory_writer (TrajectoryWriter, optional): The writer to log the
+                collected trajectories. Defaults to None.
+        """
+        if isinstance(envs, PipelinedVectorEnv):
+            return self.pipelined_rollout(memory, num_steps, envs, trajectory_writer)
+
+        state = self.start_rollout(memory, memory.next_obs, memory.next_done)
+        for _ in range(num_steps):
+            policy_output = self.act(state)
+            step_output = envs.step(policy_output[0].cpu().numpy())
+            transition = self.observe(state, memory, policy_output, step_output)
+            self.record_step(memory, transition, trajectory_writer)
+
+        # Store last (obs, done, value) tuple, since we need it to compute advantages
+        memory.next_obs = state.obs
+        memory.next_done = state.done
+        memory.next_value = self.finish_rollout(state)
+
+    def pipelined_rollout(self,
+                          memory: Memory,
+                          num_steps: int,
+                          envs: PipelinedVectorEnv,
+                          trajectory_writer=None) -> None:
+        """Performs the rollout phase like rollout, but the policy acts for one
+        half of the envs while the other half steps.
+
+        Each step, the policy acts for the first half, which starts stepping,
+        while the second half finishes its previous step. Then the policy acts
+        for the second half, which starts stepping, while the first half
+        finishes. With asynchronous halves, stepping overlaps with inference.
+
+        Args:
+            memory (Memory): The replay buffer to store the experiences.
+            num_steps (int): The number of steps to collect.
+            envs (PipelinedVectorEnv): The two halves of the envs.
+            trajectory_writer (TrajectoryWriter, optional): The writer to log the
+                collected trajectories. Defaults to None.
+        """
+        states = [
+            self.start_rollout(memory, memory.next_obs[env_slice], memory.next_done[env_slice])
+            for env_slice in envs.env_slices]
+        policy_outputs = [None, None]
+        transitions = [None, None]
+
+        def observe(half):
+            transitions[half] = self.observe(
+                states[half], memory, policy_outputs[half], envs.step_wait(half))
+
+        for step in range(num_steps):
+            policy_outputs[0] = self.act(states[0])
+            envs.step_async(0, policy_outputs[0][0].cpu().numpy())
+            if step > 0:
+                observe(1)
+                # both halves of the previous step are done
+                self.record_step(memory, Transition.concatenate(
+                    transitions, envs), trajectory_writer)
+
+            policy_outputs[1] = self.act(states[1])
+            envs.step_async(1, policy_outputs[1][0].cpu().numpy())
+            observe(0)
+
+        observe(1)
+        self.record_step(memory, Transition.concatenate(transitions, envs), trajectory_writer)
+
+        memory.next_obs = t.cat([state.obs for state in states])
+        memory.next_done = t.cat([state.done for state in states])
+        memory.next_value = t.cat([self.finish_rollout(state) for state in states])
+
+    @abc.abstractmethod
+    def start_rollout(self, memory: Memory, obs: t.Tensor, done: t.Tensor) -> "RolloutState":
+        """Returns the state of a rollout of the envs starting at obs."""
+        pass
+
+    @abc.abstractmethod
+    def act(self, state: "RolloutState") -> Tuple[t.Tensor, t.Tensor, t.Tensor]:
+        """Samples the actions for the current observations of state.
+
+        Returns:
+            Tuple[t.Tensor, t.Tensor, t.Tensor]: the actions, their log probabilities and the values.
+        """
+        pass
+
+    @abc.abstractmethod
+    def observe(self, state: "RolloutState", memory: Memory, policy_output, step_output) -> "Transition":
+        """Moves state to the observations after a step of the envs.
+
+        Args:
+            state (RolloutState): The state of the rollout, updated in place.
+            memory (Memory): The replay buffer, whose obs_preprocessor is applied.
+            policy_output: The (action, logprob, value) returned by act.
+            step_output: The (next_obs, reward, next_done, next_truncated, info) of the envs.
+
+        Returns:
+            Transition: the step to store.
+        """
+        pass
+
     @abc.abstractmethod
-    def rollout(self, memory, args, envs, trajectory_writer) -> None:
+    def finish_rollout(self, state: "RolloutState") -> t.Tensor:
+        """Returns the values of the last observations of state."""
         pass
 
+    def record_step(self, memory: Memory, transition: "Transition", trajectory_writer=None) -> None:
+        """Writes a step to the trajectory writer and stores it in memory."""
+        if trajectory_writer is not None:
+            trajectory_writer.accumulate_trajectory(
+                next_obs=transition.obs.detach().cpu().numpy(),
+                reward=transition.reward.detach().cpu().numpy(),
+                action=transition.action.detach().cpu().numpy(),
+                done=transition.next_done,
+                truncated=transition.next_truncated,
+                info=transition.info
+            )
+        # Store (s_t, d_t, a_t, logpi(a_t|s_t), v(s_t), r_t+1)
+        memory.add(transition.info, transition.obs, transition.done, transition.action,
+                   transition.logprob, transition.value, transition.reward)
+
     @abc.abstractmethod
     def learn(self, memory, args, optimizer, scheduler) -> None:
         pass
@@ -107,16 +244,18 @@ class FCAgent(PPOAgent):
     critic: nn.Sequential
     actor: nn.Sequential
 
-    def __init__(self, envs: gym.vector.SyncVectorEnv, device: t.device = t.device('cpu'), hidden_dim: int = 64):
+    def __init__(self, envs: gym.vector.VectorEnv, device: t.device = t.device('cpu'), hidden_dim: int = 64,
+                 precision: str = "fp32"):
         '''
         An agent for a Proximal Policy Optimization (PPO) algorithm.
 
         Args:
-        - envs (gym.vector.SyncVectorEnv): the environment(s) to interact with.
+        - envs (gym.vector.VectorEnv): the environment(s) to interact with.
         - device (t.device): the device on which to run the agent.
         - hidden_dim (int): the number of neurons in the hidden layer.
+        - precision (str): "fp32", or "bf16" for bfloat16 autocast forward passes.
         '''
-        super().__init__(envs=envs, device=device)
+        super().__init__(envs=envs, device=device, precision=precision)
 
         self.obs_shape = get_obs_shape(envs.single_observation_space)
         self.num_obs = np.array(self.obs_shape).prod()
@@ -142,56 +281,45 @@ class FCAgent(PPOAgent):
         self.device = device
         self.to(device)
 
-    def rollout(self, memory: Memory, num_steps: int, envs: gym.vector.SyncVectorEnv, trajectory_writer=None) -> None:
-        """Performs the rollout phase of the PPO algorithm, collecting experience by interacting with the environment.
-
-        Args:
-            memory (Memory): The replay buffer to store the experiences.
-            num_steps (int): The number of steps to collect.
-            envs (gym.vector.SyncVectorEnv): The vectorized environment to interact with.
-            trajectory_writer (TrajectoryWriter, optional): The writer to log the
-                collected trajectories. Defaults to None.
-        """
+    def get_logits_and_values(self, obs) -> Tuple[t.Tensor, t.Tensor]:
+        """Returns the action logits and values (of shape (batch, 1)) in float32."""
+        with self.autocast():
+            logits, values = self.actor(obs), self.critic(obs)
+        return to_float32(logits, values)
 
-        device = memory.device
-        cuda = device.type == "cuda"
-        obs = memory.next_obs
-        done = memory.next_done
+    def get_values(self, obs) -> t.Tensor:
+        """Returns the values, of shape (batch, 1), in float32."""
+        with self.autocast():
+            return to_float32(self.critic(obs))
 
-        for _ in range(num_steps):
-            with t.inference_mode():
-                logits = self.actor(obs)
-                value = self.critic(obs).flatten()
-            probs = Categorical(logits=logits)
-            action = probs.sample()
-            logprob = probs.log_prob(action)
-            next_obs, reward, next_done, next_truncated, info = envs.step(
-                action.cpu().numpy())
-            next_obs = memory.obs_preprocessor(next_obs)
-            reward = t.from_numpy(reward).to(device)
-
-            if trajectory_writer is not None:
-                obs_np = obs.detach().cpu().numpy() if cuda else obs.detach().numpy()
-                reward_np = reward.detach().cpu().numpy() if cuda else reward.detach().numpy()
-                action_np = action.detach().cpu().numpy() if cuda else action.detach().numpy()
-                trajectory_writer.accumulate_trajectory(
-                    next_obs=obs_np,
-                    reward=reward_np,
-                    action=action_np,
-                    done=next_done,
-                    truncated=next_truncated,
-                    info=info
-                )
-            # Store (s_t, d_t, a_t, logpi(a_t|s_t), v(s_t), r_t+1)
-            memory.add(info, obs, done, action, logprob, value, reward)
-            obs = t.from_numpy(next_obs).to(device)
-            done = t.from_numpy(next_done).to(device, dtype=t.float)
+    def start_rollout(self, memory: Memory, obs: t.Tensor, done: t.Tensor) -> "RolloutState":
+        return RolloutState(obs=obs, done=done)
 
-        # Store last (obs, done, value) tuple, since we need it to compute advantages
-        memory.next_obs = obs
-        memory.next_done = done
+    def act(self, state: "RolloutState") -> Tuple[t.Tensor, t.Tensor, t.Tensor]:
+        with t.inference_mode():
+            logits, value = self.get_logits_and_values(state.obs)
+            value = value.flatten()
+        probs = Categorical(logits=logits)
+        action = probs.sample()
+        logprob = probs.log_prob(action)
+        return action, logprob, value
+
+    def observe(self, state: "RolloutState", memory: Memory, policy_output, step_output) -> "Transition":
+        action, logprob, value = policy_output
+        next_obs, reward, next_done, next_truncated, info = step_output
+        next_obs = memory.obs_preprocessor(next_obs)
+        device = state.obs.device
+        transition = Transition(
+            info, state.obs, state.done, action, logprob, value,
+            t.from_numpy(reward).to(device), next_done, next_truncated)
+
+        state.obs = t.from_numpy(next_obs).to(device)
+        state.done = t.from_numpy(next_done).to(device, dtype=t.float)
+        return transition
+
+    def finish_rollout(self, state: "RolloutState") -> t.Tensor:
         with t.inference_mode():
-            memory.next_value = self.critic(obs).flatten()
+            return self.get_values(state.obs).flatten()
 
     def learn(self,
               memory: Memory,
@@ -213,9 +341,9 @@ class FCAgent(PPOAgent):
             minibatches = memory.get_minibatches()
             # Compute loss on each minibatch, and step the optimizer
             for mb in minibatches:
-                logits = self.actor(mb.obs)
+                logits, values = self.get_logits_and_values(mb.obs)
                 probs = Categorical(logits=logits)
-                values = self.critic(mb.obs).squeeze()
+                values = values.squeeze()
                 clipped_surrogate_objective = calc_clipped_surrogate_objective(
                     probs, mb.actions, mb.advantages, mb.logprobs, args.clip_coef)
                 value_loss = calc_value_function_loss(
@@ -252,172 +380,150 @@ class FCAgent(PPOAgent):
 
 class TrajPPOAgent(PPOAgent):
     def __init__(self,
-                 envs: gym.vector.SyncVectorEnv,
+                 envs: gym.vector.VectorEnv,
                  environment_config: EnvironmentConfig,
                  transformer_model_config: TransformerModelConfig,
-                 device: t.device = t.device("cpu")
+                 device: t.device = t.device("cpu"),
+                 precision: str = "fp32"
                  ):
         '''
         An agent for a Proximal Policy Optimization (PPO) algorithm.
 
         Args:
-        - envs (gym.vector.SyncVectorEnv): the environment(s) to interact with.
+        - envs (gym.vector.VectorEnv): the environment(s) to interact with.
         - device (t.device): the device on which to run the agent.
         - environment_config (EnvironmentConfig): the configuration for the environment.
         - transformer_model_config (TransformerModelConfig): the configuration for the transformer model.
         - device (t.device): the device on which to run the agent.
+        - precision (str): "fp32", or "bf16" for bfloat16 autocast forward passes.
         '''
-        super().__init__(envs=envs, device=device)
+        super().__init__(envs=envs, device=device, precision=precision)
         self.environment_config = environment_config
         self.transformer_model_config = transformer_model_config
         self.obs_shape = get_obs_shape(envs.single_observation_space)
         self.num_obs = np.array(self.obs_shape).prod()
         self.num_actions = envs.single_action_space.n
         self.hidden_dim = transformer_model_config.d_model
-        self.critic = CriticTransfomer(
-            transformer_config=transformer_model_config,
-            environment_config=environment_config,
-        )
-        self.layer_init(self.critic.value_predictor, std=0.01)
-        self.actor = ActorTransformer(
-            transformer_config=transformer_model_config,
-            environment_config=environment_config,
-        )
-        self.layer_init(self.actor.action_predictor, std=0.01)
+        self.shared_trunk = getattr(transformer_model_config, "shared_trunk", False)
+        if self.shared_trunk:
+            # one forward for the logits and values, see get_logits_and_values
+            self.actor = self.critic = None
+            self.actor_critic = ActorCriticTransformer(
+                transformer_config=transformer_model_config,
+                environment_config=environment_config,
+                value_trunk_weight=transformer_model_config.value_trunk_weight,
+            )
+            self.layer_init(self.actor_critic.action_predictor, std=0.01)
+            self.layer_init(self.actor_critic.value_predictor, std=0.01)
+        else:
+            self.critic = CriticTransfomer(
+                transformer_config=transformer_model_config,
+                environment_config=environment_config,
+            )
+            self.layer_init(self.critic.value_predictor, std=0.01)
+            self.actor = ActorTransformer(
+                transformer_config=transformer_model_config,
+                environment_config=environment_config,
+            )
+            self.layer_init(self.actor.action_predictor, std=0.01)
         self.device = device
         self.to(device)
 
-    def rollout(self,
-                memory: Memory,
-                num_steps: int,
-                envs: gym.vector.SyncVectorEnv,
-                trajectory_writer=None) -> None:
-        """Performs the rollout phase of the PPO algorithm, collecting experience by interacting with the environment.
-
-        Args:
-            memory (Memory): The replay buffer to store the experiences.
-            num_steps (int): The number of steps to collect.
-            envs (gym.vector.SyncVectorEnv): The vectorized environment to interact with.
-            trajectory_writer (TrajectoryWriter, optional): The writer to
-                log the collected trajectories. Defaults to None.
+    def get_logits_and_values(self, obss, acts, timesteps) -> Tuple[t.Tensor, t.Tensor]:
+        """Returns the action logits and values of every timestep in float32,
+        with one forward of the shared trunk or one of each of the actor and critic.
         """
-
-        device = memory.device
-        obs = memory.next_obs
-        action = None  # will be set before used
-        done = memory.next_done
-        truncated = memory.next_done  # mem done represents done | truncated
-        context_window_size = self.actor.transformer_config.n_ctx
+        with self.autocast():
+            if self.shared_trunk:
+                logits, values = self.actor_critic(obss, acts, timesteps)
+            else:
+                logits = self.actor(obss, acts, timesteps)
+                values = self.critic(obss, acts, timesteps)
+        return to_float32(logits, values)
+
+    def get_values(self, obss, acts, timesteps) -> t.Tensor:
+        """Returns the values of every timestep in float32."""
+        with self.autocast():
+            if self.shared_trunk:
+                return to_float32(self.actor_critic(obss, acts, timesteps)[1])
+            return to_float32(self.critic(obss, acts, timesteps))
+
+    def start_rollout(self, memory: Memory, obs: t.Tensor, done: t.Tensor) -> "RolloutState":
+        context_window_size = self.transformer_model_config.n_ctx
         obs_timesteps = (context_window_size - 1) // 2 + 1  # (the current obs)
-        actions_timesteps = obs_timesteps - 1
-        action_pad_token = self.actor.environment_config.action_space.n
-        n_envs = envs.num_envs
-        if isinstance(device, str):
-            device = t.device(device)
-        cuda = device.type == "cuda"
-
-        obss = t.zeros((n_envs, obs_timesteps, *obs.shape[1:]), device=device)
-        acts = t.ones((n_envs, actions_timesteps, 1),
-                      device=device).to(t.long) * action_pad_token
-        timesteps = t.zeros((n_envs, obs_timesteps, 1),
-                            device=device).to(t.long)
-        obss[:, -1] = obs
-        for step in range(num_steps):
-
-            if len(memory.experiences) == 0:
-                with t.inference_mode():
-                    logits = self.actor(obss[:, -1:], None, timesteps[:, -1:])
-                    values = self.critic(obss[:, -1:], None, timesteps[:, -1:])
-                    value = values[:, -1].squeeze(-1)  # value is scalar
+        action_pad_token = self.environment_config.action_space.n
+
+        context = RolloutContext(
+            obs.shape[0], obs_timesteps, obs.shape[1:],
+            action_pad_token=action_pad_token, device=obs.device)
+        context.start(obs, padded=True)
+        # mem done represents done | truncated
+        return RolloutState(obs=obs, done=done, truncated=done, context=context,
+                            first=len(memory) == 0)
+
+    def act(self, state: "RolloutState") -> Tuple[t.Tensor, t.Tensor, t.Tensor]:
+        context = state.context
+        if state.first:
+            state.first = False
+            obss, _, _, timesteps = context.get(1)
+            with t.inference_mode():
+                logits, values = self.get_logits_and_values(obss, None, timesteps)
+                value = values[:, -1].squeeze(-1)  # value is scalar
+        else:
+            if context.max_len - 1 == 0:
+                # just the current obs, timesteps aren't tracked
+                context.append(state.obs, state.action, timesteps=0)
             else:
-                # temporarily making this code worse, refactor soon.
-                if obs_timesteps - 1 == 0:
-                    obss = obs.unsqueeze(1)  # just add the current obs
-                    acts = None
-                else:
-                    # obss
-                    obss = t.cat((obss, obs.unsqueeze(1)),
-                                 dim=1)  # add current obs
-                    obss = obss[:, -obs_timesteps:]  # truncate
-                    # acts
-                    # add current action
-                    acts = t.cat(
-                        (acts, action.unsqueeze(1).unsqueeze(-1)), dim=1)
-                    acts = acts[:, -actions_timesteps:]  # truncate
-                    # timesteps
-                    # add current timestep
-                    timesteps = t.cat(
-                        (timesteps, timesteps[:, -1:] + 1), dim=1)
-                    if timesteps.max() > self.environment_config.max_steps:
-                        assert False
-                    timesteps = timesteps[:, -obs_timesteps:]  # truncate
-
-                # Generate the next set of new experiences (one for each env)
-                with t.inference_mode():
-                    # Our actor generates logits over actions which we can then sample from
-                    logits = self.actor(obss, acts, timesteps)
-                    # Our critic generates a value function (which we use in the value loss, and to estimate advantages)
-                    values = self.critic(obss, acts, timesteps)
-                    values = values[:, -1].squeeze(-1)  # value is scalar
-
-            # get the last state action prediction
-            probs = Categorical(logits=logits[:, -1])
-            action = probs.sample()
-            logprob = probs.log_prob(action)
-            next_obs, reward, next_done, next_truncated, info = envs.step(
-                action.cpu().numpy())
-            next_obs = memory.obs_preprocessor(next_obs)
-            reward = t.from_numpy(reward).to(device)
-
-            # in each case where an episode is done, we need to reset the context window
-            # this is done by setting the last obs to the current obs and the rest to 0
-            # all the actions are set to zero
-            # timesteps are also reset
-            next_done_or_truncated = next_done | next_truncated
-            for i, d in enumerate(next_done_or_truncated):
-                if d:
-                    obss[i, -1] = obs[i]
-                    obss[i, :-1] = 0
-                    if acts is not None:
-                        acts[i] = action_pad_token
-                    timesteps[i] = 0
-
-            if trajectory_writer is not None:
-                obs_np = obs.detach().cpu().numpy() if cuda else obs.detach().numpy()
-                reward_np = reward.detach().cpu().numpy() if cuda else reward.detach().numpy()
-                action_np = action.detach().cpu().numpy() if cuda else action.detach().numpy()
-                trajectory_writer.accumulate_trajectory(
-                    next_obs=obs_np,
-                    reward=reward_np,
-                    action=action_np,
-                    done=next_done,
-                    truncated=next_truncated,
-                    info=info
-                )
-
-            # Store (s_t, d_t, a_t, logpi(a_t|s_t), v(s_t), r_t+1)
-            mem_done = (done.to(bool) | truncated.to(bool)).to(float)
-            memory.add(info, obs, mem_done, action, logprob, value, reward)
-            obs = t.from_numpy(next_obs).to(device)
-            done = t.from_numpy(next_done).to(device, dtype=t.float)
-            truncated = t.from_numpy(next_truncated).to(device, dtype=t.float)
+                # add the current obs, the action taken before it and its timestep
+                context.append(state.obs, state.action)
+                if context.timesteps.max() > self.environment_config.max_steps:
+                    assert False
+            obss, acts, _, timesteps = context.get()
 
-        # Store last (obs, done, value) tuple, since we need it to compute advantages
-        memory.next_obs = obs
-        memory.next_done = done
+            # Generate the next set of new experiences (one for each env)
+            with t.inference_mode():
+                # Our actor generates logits over actions which we can then sample from
+                # Our critic generates a value function (which we use in the value loss, and to estimate advantages)
+                logits, values = self.get_logits_and_values(obss, acts, timesteps)
+                value = values[:, -1].squeeze(-1)  # value is scalar
+
+        # get the last state action prediction
+        probs = Categorical(logits=logits[:, -1])
+        action = probs.sample()
+        logprob = probs.log_prob(action)
+        state.action = action
+        return action, logprob, value
+
+    def observe(self, state: "RolloutState", memory: Memory, policy_output, step_output) -> "Transition":
+        action, logprob, value = policy_output
+        next_obs, reward, next_done, next_truncated, info = step_output
+        next_obs = memory.obs_preprocessor(next_obs)
+        device = state.obs.device
+
+        # in each case where an episode is done, we need to reset the context window
+        # this is done by keeping the current obs and setting the rest to 0
+        # all the actions are set to the pad token and timesteps are reset
+        state.context.reset(next_done | next_truncated, state.obs)
+
+        mem_done = (state.done.to(bool) | state.truncated.to(bool)).to(float)
+        transition = Transition(
+            info, state.obs, mem_done, action, logprob, value,
+            t.from_numpy(reward).to(device), next_done, next_truncated)
+
+        state.obs = t.from_numpy(next_obs).to(device)
+        state.done = t.from_numpy(next_done).to(device, dtype=t.float)
+        state.truncated = t.from_numpy(next_truncated).to(device, dtype=t.float)
+        return transition
+
+    def finish_rollout(self, state: "RolloutState") -> t.Tensor:
+        context = state.context
         with t.inference_mode():
+            context.append(state.obs, state.action,
+                           timesteps=0 if context.max_len == 1 else None)
+            obss, actions, _, timesteps = context.get()
 
-            obss = t.cat((obss, obs.unsqueeze(1)), dim=1)
-            acts = t.cat((acts, action.unsqueeze(1).unsqueeze(-1)),
-                         dim=1) if acts is not None else None
-
-            obss = obss[:, -obs_timesteps:]
-            actions = acts[:, -
-                           actions_timesteps:] if acts is not None else None
-            timesteps = timesteps[:, -obs_timesteps:]
-
-            values = self.critic(obss, actions, timesteps)
-            memory.next_value = values[:, -1].squeeze(-1)
+            values = self.get_values(obss, actions, timesteps)
+            return values[:, -1].squeeze(-1)
 
     def learn(self,
               memory: Memory,
@@ -437,7 +543,7 @@ class TrajPPOAgent(PPOAgent):
         """
 
         for _ in range(args.update_epochs):
-            n_timesteps = (self.actor.transformer_config.n_ctx - 1) // 2 + 1
+            n_timesteps = (self.transformer_model_config.n_ctx - 1) // 2 + 1
             minibatches = memory.get_trajectory_minibatches(
                 n_timesteps, args.prob_go_from_end)
 
@@ -448,8 +554,7 @@ class TrajPPOAgent(PPOAgent):
                     int) if mb.obs.shape[1] > 1 else None
                 timesteps = mb.timesteps.unsqueeze(-1).to(int)
 
-                logits = self.actor(obs, actions, timesteps)
-                values = self.critic(obs, actions, timesteps)
+                logits, values = self.get_logits_and_values(obs, actions, timesteps)
                 values = values[:, -1].squeeze(-1)
 
                 probs = Categorical(logits=logits[:, -1])
@@ -491,3 +596,44 @@ class TrajPPOAgent(PPOAgent):
                 approx_kl=approx_kl,
                 clipfrac=np.mean(clipfracs)
             )
+
+
+@dataclass
+class RolloutState:
+    '''
+    The state of a rollout of some envs between steps: their current
+    observations and whether their episodes just ended, and for trajectory
+    models the context windows and the last actions.
+    '''
+    obs: t.Tensor
+    done: t.Tensor
+    truncated: t.Tensor = None
+    context: RolloutContext = None
+    action: t.Tensor = None
+    first: bool = False
+
+
+class Transition(NamedTuple):
+    '''
+    A step of the envs, as stored in memory, (info, s_t, d_t, a_t,
+    logpi(a_t|s_t), v(s_t), r_t+1), and written by the trajectory writer.
+    '''
+    info: dict
+    obs: t.Tensor
+    done: t.Tensor
+    action: t.Tensor
+    logprob: t.Tensor
+    value: t.Tensor
+    reward: t.Tensor
+    next_done: np.ndarray
+    next_truncated: np.ndarray
+
+    @staticmethod
+    def concatenate(transitions, envs: PipelinedVectorEnv) -> "Transition":
+        '''Concatenates the transitions of the halves of envs.'''
+        info, *tensors, next_done, next_truncated = zip(*transitions)
+        return Transition(
+            envs.concatenate_infos(info),
+            *[t.cat(tensor) for tensor in tensors],
+            np.concatenate(next_done),
+            np.concatenate(next_truncated))
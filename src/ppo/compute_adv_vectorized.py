@@ -1,3 +1,5 @@
+from typing import Tuple
+
 import torch as t
 from einops import rearrange, repeat
 from torchtyping import TensorType as TT
@@ -84,3 +86,145 @@ def compute_advantages_vectorized(
 
     advantages = (discount_factors_shifted * deltas_masked).sum(dim=1)
     return advantages
+
+
+def compute_advantages_loop(
+    next_value: TT["env"],  # noqa: F821
+    next_done: TT["env"],  # noqa: F821
+    rewards: TT["T", "env"],  # noqa: F821
+    values: TT["T", "env"],  # noqa: F821
+    dones: TT["T", "env"],  # noqa: F821
+    device: t.device,
+    gamma: float,
+    gae_lambda: float
+) -> TT["T", "env"]:  # noqa: F821
+    """
+    Computes the GAE advantages with a Python loop over the timesteps,
+    backwards from the last one. Takes the same arguments as
+    compute_advantages_vectorized.
+    """
+    T = values.shape[0]
+    next_values = t.concat([values[1:], next_value.unsqueeze(0)])
+    next_dones = t.concat([dones[1:], next_done.unsqueeze(0)])
+    deltas = rewards + gamma * next_values * (1.0 - next_dones) - values
+    advantages = t.zeros_like(deltas).to(device)
+    advantages[-1] = deltas[-1]
+    for t_ in reversed(range(1, T)):
+        advantages[t_ - 1] = deltas[t_ - 1] + gamma * \
+            gae_lambda * (1.0 - dones[t_]) * advantages[t_]
+    return advantages
+
+
+def compute_advantages_scan(
+    next_value: TT["env"],  # noqa: F821
+    next_done: TT["env"],  # noqa: F821
+    rewards: TT["T", "env"],  # noqa: F821
+    values: TT["T", "env"],  # noqa: F821
+    dones: TT["T", "env"],  # noqa: F821
+    device: t.device,
+    gamma: float,
+    gae_lambda: float
+) -> TT["T", "env"]:  # noqa: F821
+    """
+    Computes the GAE advantages with an associative scan. Takes the same
+    arguments as compute_advantages_vectorized.
+
+    The advantages solve the linear recurrence
+        advantages[t] = deltas[t] + coefs[t] * advantages[t + 1]
+    with coefs[t] = gamma * gae_lambda * (1 - next_dones[t]). Every pass of
+    the scan folds in the terms 2^i steps ahead, so it takes log2(T) passes
+    with O(T) memory, instead of the O(T^2) matrices of
+    compute_advantages_vectorized.
+    """
+    T = values.shape[0]
+    next_values = t.concat([values[1:], next_value.unsqueeze(0)])
+    next_dones = t.concat([dones[1:], next_done.unsqueeze(0)])
+    deltas = rewards + gamma * next_values * (1.0 - next_dones) - values
+
+    advantages = deltas.to(device)
+    coefs = (gamma * gae_lambda * (1.0 - next_dones)).to(device)
+    offset = 1
+    while offset < T:
+        # the terms up to 2 * offset steps ahead, applied in place of the
+        # ones up to offset steps ahead
+        advantages = t.concat([
+            advantages[:-offset] + coefs[:-offset] * advantages[offset:],
+            advantages[-offset:]])
+        coefs = t.concat([
+            coefs[:-offset] * coefs[offset:],
+            t.zeros_like(coefs[-offset:])])
+        offset *= 2
+    return advantages
+
+
+ADVANTAGE_METHODS = {
+    "loop": compute_advantages_loop,
+    "vectorized": compute_advantages_vectorized,
+    "scan": compute_advantages_scan,
+}
+
+
+def get_advantage_method(method: str) -> callable:
+    """
+    Returns the function computing the advantages with the given method,
+    one of ADVANTAGE_METHODS or "auto".
+
+    "auto" is the scan, which was the fastest at every rollout length and
+    number of environments in python -m src.benchmarks.advantages, and
+    unlike the vectorized form does not need O(T^2) memory.
+    """
+    if method == "auto":
+        method = "scan"
+    assert method in ADVANTAGE_METHODS, \
+        f"method must be one of {list(ADVANTAGE_METHODS)} or auto"
+    return ADVANTAGE_METHODS[method]
+
+
+def compute_vtrace(
+    next_value: TT["env"],  # noqa: F821
+    next_done: TT["env"],  # noqa: F821
+    rewards: TT["T", "env"],  # noqa: F821
+    values: TT["T", "env"],  # noqa: F821
+    dones: TT["T", "env"],  # noqa: F821
+    log_rhos: TT["T", "env"],  # noqa: F821
+    gamma: float,
+    rho_bar: float = 1.0,
+    c_bar: float = 1.0
+) -> Tuple[TT["T", "env"], TT["T", "env"]]:  # noqa: F821
+    """
+    Computes the V-trace value targets and advantages (Espeholt et al.,
+    2018) of a rollout collected by a behaviour policy lagging behind the
+    policy being trained. Takes the same arguments as
+    compute_advantages_vectorized, except for:
+
+        log_rhos (torch.Tensor): log(pi(a|s) / mu(a|s)), the log importance
+            ratios of the trained policy pi to the behaviour policy mu.
+        rho_bar (float): the truncation of the importance ratios of the TD errors.
+        c_bar (float): the truncation of the importance ratios of the traces.
+
+    With a behaviour policy equal to pi (and rho_bar, c_bar >= 1) the
+    advantages are the GAE advantages with gae_lambda = 1.
+
+    Returns:
+        vs (torch.Tensor): the value targets, of shape (timesteps, num_envs).
+        advantages (torch.Tensor): the advantages, of shape (timesteps, num_envs).
+    """
+    T = values.shape[0]
+    next_values = t.concat([values[1:], next_value.unsqueeze(0)])
+    next_nonterminal = 1.0 - t.concat([dones[1:], next_done.unsqueeze(0)])
+    rhos = log_rhos.exp()
+    clipped_rhos = rhos.clamp(max=rho_bar)
+    cs = rhos.clamp(max=c_bar)
+    deltas = clipped_rhos * (rewards + gamma * next_values * next_nonterminal - values)
+
+    # vs[t] - values[t] = deltas[t] + gamma * c[t] * (vs[t + 1] - values[t + 1])
+    vs_minus_values = t.zeros_like(deltas)
+    vs_minus_values[-1] = deltas[-1]
+    for t_ in reversed(range(T - 1)):
+        vs_minus_values[t_] = deltas[t_] + gamma * next_nonterminal[t_] * \
+            cs[t_] * vs_minus_values[t_ + 1]
+    vs = vs_minus_values + values
+
+    next_vs = t.concat([vs[1:], next_value.unsqueeze(0)])
+    advantages = clipped_rhos * (rewards + gamma * next_vs * next_nonterminal - values)
+    return vs, advantages
@@ -1,4 +1,3 @@
-import random
 from collections import defaultdict
 from dataclasses import dataclass
 from typing import List, Any
@@ -11,8 +10,8 @@ from torchtyping import TensorType as TT
 
 import wandb
 from src.config import OnlineTrainConfig
-from src.utils import pad_tensor
 
+from .compute_adv_vectorized import get_advantage_method
 from .utils import PPOArgs, get_obs_preprocessor
 
 
@@ -48,12 +47,17 @@ class TrajectoryMinibatch:
 class Memory():
     '''
     A memory buffer for storing experiences during the rollout phase.
+
+    Experiences are written by index into tensors of shape
+    [num_steps, num_envs, ...] on the memory's device, allocated at the
+    first add and reused by every later rollout. Advantages are computed
+    once per rollout and cached until the next add or reset.
     '''
 
-    def __init__(self, envs: gym.vector.SyncVectorEnv, args: OnlineTrainConfig, device: t.device = t.device("cpu")):
+    def __init__(self, envs: gym.vector.VectorEnv, args: OnlineTrainConfig, device: t.device = t.device("cpu")):
         """Initializes the memory buffer.
 
-        envs: A SyncVectorEnv object.
+        envs: A vector env, see make_vector_env.
         args: A PPOArgs object containing the PPO training hyperparameters.
         device: The device to store the tensors on, either "cpu" or "cuda".
         """
@@ -65,8 +69,71 @@ class Memory():
         self.device = device
         self.global_step = 0
         self.obs_preprocessor = get_obs_preprocessor(envs.observation_space)
+        # (obs, done, action, logprob, value, reward) buffers
+        self.buffers = None
         self.reset()
 
+    def __len__(self) -> int:
+        '''The number of experiences added since the last reset.'''
+        return self.n_experiences
+
+    @property
+    def experiences(self) -> List[tuple]:
+        '''The experiences added since the last reset, as (obs, done, action,
+        logprob, value, reward) tuples of views into the buffers.
+        '''
+        if self.buffers is None:
+            return []
+        return list(zip(*self.get_buffers()))
+
+    def get_buffers(self) -> List[t.Tensor]:
+        '''Returns views of the filled part of the (obs, done, action, logprob,
+        value, reward) buffers, each of shape [n_experiences, num_envs, ...].
+        '''
+        return [buffer[:self.n_experiences] for buffer in self.buffers]
+
+    def allocate(self, experiences) -> None:
+        '''Allocates buffers for args.num_steps experiences shaped like the
+        given one, or doubles the size of the buffers if they are full.
+        '''
+        if self.buffers is None:
+            num_steps = getattr(self.args, "num_steps", 1)
+            self.buffers = [
+                t.empty((num_steps, *experience.shape),
+                        dtype=experience.dtype, device=self.device)
+                for experience in experiences]
+        else:
+            self.buffers = [t.cat([buffer, t.empty_like(buffer)])
+                            for buffer in self.buffers]
+
+    def add_rollout(self, buffers: List[t.Tensor], next_obs: t.Tensor,
+                    next_done: t.Tensor, next_value: t.Tensor) -> None:
+        '''Replaces the experiences with a whole rollout collected elsewhere,
+        e.g. by the rollout workers of src/ppo/actor_learner.py.
+
+        buffers: the (obs, done, action, logprob, value, reward) tensors, each of shape [num_steps, num_envs, ...].
+        next_obs, next_done, next_value: the last (obs, done, value) of the rollout.
+        '''
+        if self.buffers is None:
+            self.allocate([buffer[0] for buffer in buffers])
+        while len(self.buffers[0]) < len(buffers[0]):
+            self.allocate(None)
+        for own_buffer, buffer in zip(self.buffers, buffers):
+            own_buffer[:len(buffer)].copy_(buffer)
+        self.n_experiences = len(buffers[0])
+        self.advantages = {}
+        self.returns = {}
+        self.next_obs = next_obs.to(self.device)
+        self.next_done = next_done.to(self.device)
+        self.next_value = next_value.to(self.device)
+
+    def set_advantages(self, gae_lambda: float, advantages: t.Tensor, returns: t.Tensor) -> None:
+        '''Overrides the advantages and value targets used for gae_lambda, e.g.
+        with off-policy corrected ones, until the next add or reset.
+        '''
+        self.advantages[gae_lambda] = advantages
+        self.returns[gae_lambda] = returns
+
     def add(self, *data: t.Tensor):
         """
         Adds an experience to storage. Called during the rollout phase.
@@ -75,7 +142,13 @@ class Memory():
         """
         info = data[0]
         experiences = data[1:]
-        self.experiences.append(experiences)
+        if self.buffers is None or self.n_experiences == len(self.buffers[0]):
+            self.allocate(experiences)
+        for buffer, experience in zip(self.buffers, experiences):
+            buffer[self.n_experiences] = experience
+        self.n_experiences += 1
+        self.advantages = {}
+        self.returns = {}
         if info and isinstance(info, dict):
             if "final_info" in info.keys():
 
@@ -137,7 +210,8 @@ class Memory():
         dones: TT["T", "env"],  # noqa: F821
         device: t.device,
         gamma: float,
-        gae_lambda: float
+        gae_lambda: float,
+        method: str = None
     ) -> TT["T", "env"]:  # noqa: F821
         '''
         Compute advantages using Generalized Advantage Estimation.
@@ -156,20 +230,34 @@ class Memory():
         - device (torch.device): the device to store the tensors on.
         - gamma (float): the discount factor.
         - gae_lambda (float): the GAE lambda parameter.
+        - method (str): loop, vectorized, scan or auto (see
+            compute_adv_vectorized.py), args.advantage_method by default.
 
         Returns:
         - advantages (Tensor): the advantages of the states.
         '''
-        T = values.shape[0]
-        next_values = t.concat([values[1:], next_value.unsqueeze(0)])
-        next_dones = t.concat([dones[1:], next_done.unsqueeze(0)])
-        deltas = rewards + gamma * next_values * (1.0 - next_dones) - values
-        advantages = t.zeros_like(deltas).to(device)
-        advantages[-1] = deltas[-1]
-        for t_ in reversed(range(1, T)):
-            advantages[t_ - 1] = deltas[t_ - 1] + gamma * \
-                gae_lambda * (1.0 - dones[t_]) * advantages[t_]
-        return advantages
+        compute_advantages = get_advantage_method(
+            method or getattr(self.args, "advantage_method", "auto"))
+        return compute_advantages(
+            next_value, next_done, rewards, values, dones, device, gamma, gae_lambda)
+
+    def get_advantages(self, gae_lambda: float) -> TT["T", "env"]:  # noqa: F821
+        '''Returns the advantages of the experiences since the last reset,
+        computing them only the first time they are asked for with gae_lambda.
+        '''
+        if gae_lambda not in self.advantages:
+            _, dones, _, _, values, rewards = self.get_buffers()
+            self.advantages[gae_lambda] = self.compute_advantages(
+                self.next_value,
+                self.next_done,
+                rewards,
+                values,
+                dones,
+                self.device,
+                self.args.gamma,
+                gae_lambda
+            )
+        return self.advantages[gae_lambda]
 
     def get_minibatches(self) -> List[Minibatch]:
         '''Return a list of length (batch_size // minibatch_size)
@@ -182,50 +270,46 @@ class Memory():
         Returns:
         - List[MiniBatch]: a list of minibatches.
         '''
-        obs, dones, actions, logprobs, values, rewards = [
-            t.stack(arr) for arr in zip(*self.experiences)]
-        advantages = self.compute_advantages(
-            self.next_value,
-            self.next_done,
-            rewards,
-            values,
-            dones,
-            self.device,
-            self.args.gamma,
-            self.args.gae_lambda
-        )
-        returns = advantages + values
+        obs, dones, actions, logprobs, values, rewards = self.get_buffers()
+        advantages = self.get_advantages(self.args.gae_lambda)
+        returns = self.returns.get(self.args.gae_lambda)
+        if returns is None:
+            returns = advantages + values
         indexes = self.get_minibatch_indexes(
             self.args.batch_size, self.args.minibatch_size)
 
+        flat_arrs = [arr.flatten(0, 1) for arr in [
+            obs, actions, logprobs, advantages, values, returns]]
         minibatches = []
         for ind in indexes:
-            batch = []
-            for arr in [obs, actions, logprobs, advantages, values, returns]:
-                flat_arr = arr.flatten(0, 1)
-                batch.append(flat_arr[ind])
-            minibatches.append(Minibatch(*batch))
+            ind = t.as_tensor(ind, device=obs.device)
+            minibatches.append(Minibatch(*[flat_arr[ind] for flat_arr in flat_arrs]))
 
         return minibatches
 
     def get_trajectory_minibatches(self, timesteps: int, prob_go_from_end: float = 0.1) -> List[TrajectoryMinibatch]:
         '''Return a list of trajectory minibatches, where each minibatch contains
-        experiences from a single trajectory.
+        windows of the last timesteps steps of randomly sampled trajectories.
 
         Args:
         - timesteps (int): the number of timesteps to include in each minibatch.
+        - prob_go_from_end (float): the probability of a window ending at the
+            end of its trajectory, see sample_trajectory_windows.
 
         Returns:
         - List[TrajectoryMinibatch]: a list of minibatches.
         '''
-        obs, dones, actions, logprobs, values, rewards = [
-            t.stack(arr) for arr in zip(*self.experiences)]
+        obs, dones, actions, logprobs, values, rewards = self.get_buffers()
 
-        next_values = t.cat([values[1:], self.next_value.unsqueeze(0)])
-        next_dones = t.cat([dones[1:], self.next_done.unsqueeze(0)])
+        # Only the last step of each window is trained on, and its advantage
+        # used to be computed with the window as the whole horizon. That is
+        # the one step TD error, i.e. GAE with lambda = 0, so compute it for
+        # the whole rollout at once.
+        advantages = self.get_advantages(0.0)
+        returns = advantages + values
 
-        # px.imshow(obs[:,1,:,:,0].transpose(-1,-2), animation_frame = 0, range_color = [0,10]).show()
-        # set last value of dones to 1
+        # set last value of dones to 1, without changing the buffer
+        dones = dones.clone()
         dones[-1] = t.ones(dones.shape[-1])
 
         # hack for now.
@@ -236,177 +320,92 @@ class Memory():
         # rearrange to flatten out the env dimension (2nd dimension)
         obs = rearrange(obs, "T E ... -> (E T) ...")
         dones = rearrange(dones, "T E -> (E T)")
-        next_dones = rearrange(next_dones, "T E -> (E T)")
         actions = rearrange(actions, "T E ... -> (E T) ...")
         logprobs = rearrange(logprobs, "T E -> (E T)")
         values = rearrange(values, "T E -> (E T)")
-        next_values = rearrange(next_values, "T E -> (E T)")
         rewards = rearrange(rewards, "T E -> (E T)")
+        advantages = rearrange(advantages, "T E -> (E T)")
+        returns = rearrange(returns, "T E -> (E T)")
+
+        # split the rollout into trajectories on the dones,
+        # dropping trajectories of length 0
+        traj_end_idxs = t.where(dones)[0].cpu().numpy()
+        traj_starts = np.concatenate([[0], traj_end_idxs])
+        trajectory_lengths = np.concatenate([traj_end_idxs, [len(dones)]]) - traj_starts
+        traj_starts = traj_starts[trajectory_lengths > 0]
+        trajectory_lengths = trajectory_lengths[trajectory_lengths > 0]
+
+        traj_idxs, end_idxs = self.sample_trajectory_windows(
+            trajectory_lengths,
+            self.args.num_minibatches * self.args.minibatch_size,
+            timesteps,
+            prob_go_from_end)
+
+        # the steps of each window in its trajectory, negative ones are left padding
+        window_steps = t.tensor(end_idxs[:, None] - timesteps + np.arange(timesteps))
+        padding = (window_steps < 0).to(self.device)
+        window_steps = window_steps.clamp(min=0).to(self.device)
+        window_idxs = t.tensor(traj_starts[traj_idxs], device=self.device)[:, None] + window_steps
+        last_idxs = window_idxs[:, -1]
+
+        def pad(windows):
+            return windows.masked_fill(
+                padding.view(*padding.shape, *[1] * (windows.ndim - 2)), 0)
+
+        window_obs = pad(obs[window_idxs])
+        window_actions = pad(actions[window_idxs])
+        window_timesteps = window_steps.masked_fill(padding, 0)
 
-        # find the indices of the end of each trajectory
-        traj_end_idxs = (t.where(dones)[0]).tolist()
-
-        # split these trajectories on the dones
-        traj_obs = t.tensor_split(obs, traj_end_idxs)
-        traj_actions = t.tensor_split(actions, traj_end_idxs)
-        traj_logprobs = t.tensor_split(logprobs, traj_end_idxs)
-        traj_values = t.tensor_split(values, traj_end_idxs)
-        traj_rewards = t.tensor_split(rewards, traj_end_idxs)
-        traj_dones = t.tensor_split(dones, traj_end_idxs)
-        traj_next_values = t.tensor_split(next_values, traj_end_idxs)
-        traj_next_dones = t.tensor_split(next_dones, traj_end_idxs)
-        print([i for i, (next_val, obs) in enumerate(
-            zip(traj_next_values, traj_obs)) if len(next_val) != len(obs)])
-        # px.imshow(traj_obs[0][:,:,:,0].transpose(-1,-2), animation_frame = 0, range_color = [0,10]).show()
-
-        # so now we have lists of trajectories, what we want is to split each trajectory
-        # so for each trajectory, sample an index and go n_steps back from that.
-        # since we're encoding  states and actions, we want to go context_length//2 back
-        # if that happens to go off the end, then we
         minibatches = []
-
-        # remove trajectories of length 0
-        traj_obs = [traj for traj in traj_obs if len(traj) > 0]
-        traj_actions = [traj for traj in traj_actions if len(traj) > 0]
-        traj_logprobs = [traj for traj in traj_logprobs if len(traj) > 0]
-        traj_values = [traj for traj in traj_values if len(traj) > 0]
-        traj_rewards = [traj for traj in traj_rewards if len(traj) > 0]
-        traj_dones = [traj for traj in traj_dones if len(traj) > 0]
-        traj_next_values = [traj for traj in traj_next_values if len(traj) > 0]
-        traj_next_dones = [traj for traj in traj_next_dones if len(traj) > 0]
-
-        n_trajectories = len(traj_obs)
-        trajectory_lengths = [len(traj) for traj in traj_obs]
-
-        for _ in range(self.args.num_minibatches):
-
-            minibatch_obs = []
-            minibatch_actions = []
-            minibatch_logprobs = []
-            minibatch_advantages = []
-            minibatch_values = []
-            minibatch_returns = []
-            minibatch_timesteps = []
-            minibatch_rewards = []
-
-            for _ in range(self.args.minibatch_size):
-
-                # randomly select a trajectory
-                traj_idx = np.random.randint(n_trajectories)
-
-                # randomly select an end index from the trajectory
-                # TODO later add a hyperparameter to oversample last step
-                traj_len = trajectory_lengths[traj_idx]
-
-                if traj_len <= timesteps:
-                    end_idx = traj_len
-                    start_idx = 0
-                else:
-                    if prob_go_from_end is not None:
-                        if random.random() < prob_go_from_end:
-                            end_idx = traj_len
-                            start_idx = end_idx - timesteps
-                        else:
-                            end_idx = np.random.randint(timesteps, traj_len)
-                            start_idx = end_idx - timesteps
-                    else:
-                        end_idx = np.random.randint(timesteps, traj_len)
-                        start_idx = end_idx - timesteps
-
-                # print('end_idx:', end_idx)
-                # print('traj_len:', traj_len)
-                # print('len(traj_next_values[traj_idx]):', len(traj_next_values[traj_idx]))
-                # if len(traj_next_values[traj_idx]) != traj_len:
-                #     print("uh oh")
-
-                # get the trajectory
-                current_traj_obs = traj_obs[traj_idx][start_idx:end_idx]
-                current_traj_actions = traj_actions[traj_idx][start_idx:end_idx]
-                current_traj_logprobs = traj_logprobs[traj_idx][start_idx:end_idx]
-                current_traj_values = traj_values[traj_idx][start_idx:end_idx]
-                current_traj_dones = traj_dones[traj_idx][start_idx:end_idx]
-                current_traj_rewards = traj_rewards[traj_idx][start_idx:end_idx]
-                current_traj_next_value = traj_next_values[traj_idx][end_idx - 1]
-                current_traj_next_done = traj_next_dones[traj_idx][end_idx - 1]
-
-                # make timesteps
-                current_traj_timesteps = t.arange(start_idx, end_idx)
-
-                # Compute the advantages and returns for this trajectory.
-                current_traj_advantages = self.compute_advantages(
-                    current_traj_next_value,
-                    current_traj_next_done,
-                    current_traj_rewards,
-                    current_traj_values,
-                    current_traj_dones,
-                    self.device,
-                    self.args.gamma,
-                    self.args.gae_lambda
-                )
-
-                current_traj_returns = current_traj_advantages + current_traj_values
-
-                # we need to pad current_traj_obs and current_traj_actions
-                current_traj_obs = pad_tensor(
-                    current_traj_obs,
-                    timesteps,
-                    ignore_first_dim=False,
-                    pad_token=0,
-                    pad_left=True
-                )
-
-                current_traj_actions = pad_tensor(
-                    current_traj_actions,
-                    timesteps,
-                    ignore_first_dim=False,
-                    pad_token=0,
-                    pad_left=True
-                )
-
-                current_traj_timesteps = pad_tensor(
-                    current_traj_timesteps,
-                    timesteps,
-                    ignore_first_dim=False,
-                    pad_token=0,
-                    pad_left=True
-                )
-                # print([i for i, (next_val, obs) in enumerate(zip(traj_next_values, traj_obs)) if len(next_val) != len(obs)])
-                # add to minibatch
-                minibatch_obs.append(current_traj_obs)
-                minibatch_actions.append(current_traj_actions)
-                minibatch_logprobs.append(current_traj_logprobs[-1])
-                minibatch_advantages.append(current_traj_advantages[-1])
-                minibatch_values.append(current_traj_values[-1])
-                minibatch_returns.append(current_traj_returns[-1])
-                minibatch_rewards.append(current_traj_rewards[-1])
-                minibatch_timesteps.append(current_traj_timesteps)
-
-            # stack the minibatch
-            minibatch_obs = t.stack(minibatch_obs)
-            minibatch_actions = t.stack(minibatch_actions)
-
-            # only take the last values of the logprob, advantage,
-            # value and return (relevant to the last step of each trajectory)
-            minibatch_logprobs = t.stack(minibatch_logprobs)
-            minibatch_advantages = t.stack(minibatch_advantages)
-            minibatch_values = t.stack(minibatch_values)
-            minibatch_returns = t.stack(minibatch_returns)
-            minibatch_timesteps = t.stack(minibatch_timesteps)
-            minibatch_rewards = t.stack(minibatch_rewards)
-
+        for ind in np.split(np.arange(len(traj_idxs)), self.args.num_minibatches):
+            ind = t.tensor(ind, device=self.device)
             minibatches.append(TrajectoryMinibatch(
-                obs=minibatch_obs,
-                actions=minibatch_actions,
-                logprobs=minibatch_logprobs,
-                advantages=minibatch_advantages,
-                values=minibatch_values,
-                returns=minibatch_returns,
-                timesteps=minibatch_timesteps,
-                rewards=minibatch_rewards
+                obs=window_obs[ind],
+                actions=window_actions[ind],
+                logprobs=logprobs[last_idxs[ind]],
+                advantages=advantages[last_idxs[ind]],
+                values=values[last_idxs[ind]],
+                returns=returns[last_idxs[ind]],
+                timesteps=window_timesteps[ind],
+                rewards=rewards[last_idxs[ind]]
             ))
 
         return minibatches
 
+    def sample_trajectory_windows(
+            self,
+            trajectory_lengths: np.ndarray,
+            n_windows: int,
+            timesteps: int,
+            prob_go_from_end: float = 0.1):
+        '''Samples windows of at most timesteps steps from the trajectories.
+
+        Each window is in a uniformly sampled trajectory. Trajectories of at
+        most timesteps steps are taken whole. Windows in longer trajectories
+        end at the end of the trajectory with probability prob_go_from_end,
+        otherwise at a uniformly sampled step, at least timesteps steps in.
+
+        Args:
+        - trajectory_lengths (np.ndarray): the length of every trajectory.
+        - n_windows (int): the number of windows to sample.
+        - timesteps (int): the maximum length of a window.
+        - prob_go_from_end (float): the probability of ending at the end.
+
+        Returns:
+        - traj_idxs (np.ndarray): the trajectory of each window.
+        - end_idxs (np.ndarray): the (exclusive) end index of each window in its trajectory.
+        '''
+        traj_idxs = np.random.randint(len(trajectory_lengths), size=n_windows)
+        traj_lens = trajectory_lengths[traj_idxs]
+
+        end_idxs = np.random.randint(timesteps, np.maximum(traj_lens, timesteps + 1))
+        if prob_go_from_end is not None:
+            go_from_end = np.random.random(n_windows) < prob_go_from_end
+            end_idxs[go_from_end] = traj_lens[go_from_end]
+        end_idxs[traj_lens <= timesteps] = traj_lens[traj_lens <= timesteps]
+
+        return traj_idxs, end_idxs
+
     def get_printable_output(self) -> str:
         '''Sets a new progress bar description, if any episodes have terminated.
         If not, then the bar's description won't change.
@@ -421,7 +420,9 @@ class Memory():
         '''Function to be called at the end of each rollout period, to make
         space for new experiences to be generated.
         '''
-        self.experiences = []
+        self.n_experiences = 0
+        self.advantages = {}
+        self.returns = {}
         self.vars_to_log = defaultdict(dict)
         self.episode_lengths = []
         self.episode_returns = []
@@ -9,9 +9,10 @@ from typing import Optional
 
 from src.config import RunConfig, TransformerModelConfig, EnvironmentConfig, OnlineTrainConfig
 from src.ppo.utils import set_global_seeds
+from src.ppo.actor_learner import train_ppo_actor_learner
 from src.ppo.train import train_ppo
 from src.utils import TrajectoryWriter
-from src.environments.environments import make_env
+from src.environments.environments import make_env_fns, make_vector_env
 from src.environments.registration import register_envs
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -40,6 +41,7 @@ def ppo_runner(
             environment_config=environment_config,
             online_config=online_config,
             transformer_model_config=transformer_model_config,
+            stream=online_config.stream_trajectories,
         )
     else:
         trajectory_writer = None
@@ -68,22 +70,21 @@ def ppo_runner(
     # make envs
     set_global_seeds(run_config.seed)
 
-    envs = gym.vector.SyncVectorEnv(
-        [make_env(
-            env_id=environment_config.env_id,
-            seed=environment_config.seed + i,
-            idx=i,
-            capture_video=environment_config.capture_video,
-            run_name=run_name,
-            max_steps=environment_config.max_steps,
-            fully_observed=environment_config.fully_observed,
-            flat_one_hot=environment_config.one_hot_obs,
-            agent_view_size=environment_config.view_size,
-            render_mode="rgb_array",
-        ) for i in range(online_config.num_envs)]
-    )
+    if online_config.num_workers > 0:
+        # the workers make their own envs, this one only gives the spaces
+        # (and isn't env 0, which records the videos)
+        envs = make_vector_env(make_env_fns(
+            environment_config, run_name, [online_config.num_envs]))
+        train = train_ppo_actor_learner
+    else:
+        envs = make_vector_env(
+            make_env_fns(environment_config, run_name, range(online_config.num_envs)),
+            vector_env=environment_config.vector_env,
+            pipelined=online_config.pipelined_rollout,
+        )
+        train = train_ppo
 
-    agent = train_ppo(
+    agent = train(
         run_config=run_config,
         online_config=online_config,
         environment_config=environment_config,
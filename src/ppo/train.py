@@ -2,7 +2,7 @@ import os
 from typing import Optional
 
 import torch as t
-from gymnasium.vector import SyncVectorEnv
+from gymnasium.vector import VectorEnv
 from tqdm.autonotebook import tqdm
 
 import wandb
@@ -20,7 +20,7 @@ def train_ppo(
         online_config: OnlineTrainConfig,
         environment_config: EnvironmentConfig,
         transformer_model_config: Optional[TransformerModelConfig],
-        envs: SyncVectorEnv,
+        envs: VectorEnv,
         trajectory_writer=None):
     """
     Trains a PPO agent on a given environment.
@@ -115,9 +115,10 @@ def prepare_video_dir(video_path):
 
 def get_agent(
         transformer_model_config: TransformerModelConfig,
-        envs: SyncVectorEnv,
+        envs: VectorEnv,
         environment_config: EnvironmentConfig,
-        online_config) -> PPOAgent:
+        online_config,
+        device: t.device = device) -> PPOAgent:
     """
     Returns an agent based on the given configuration.
 
@@ -126,6 +127,7 @@ def get_agent(
     - envs: The environment to train on.
     - environment_config: The configuration for the environment.
     - online_config: The configuration for online training.
+    - device: The device to put the agent on.
 
     Returns:
     - An agent.
@@ -134,7 +136,8 @@ def get_agent(
         agent = FCAgent(
             envs,
             device=device,
-            hidden_dim=online_config.hidden_size
+            hidden_dim=online_config.hidden_size,
+            precision=getattr(online_config, "precision", "fp32"),
         )
     else:
         agent = TrajPPOAgent(
@@ -142,6 +145,7 @@ def get_agent(
             transformer_model_config=transformer_model_config,
             environment_config=environment_config,
             device=device,
+            precision=getattr(online_config, "precision", "fp32"),
         )
 
     return agent
@@ -125,6 +125,9 @@ def parse_args():
                         help='the discount factor gamma')
     parser.add_argument('--gae_lambda', type=float, default=0.95,
                         help='the lambda for the general advantage estimation')
+    parser.add_argument('--advantage_method', type=str, default='auto',
+                        choices=['auto', 'loop', 'vectorized', 'scan'],
+                        help='how GAE is computed, see src/ppo/compute_adv_vectorized.py')
     parser.add_argument('--num_minibatches', type=int, default=4,
                         help='the number of mini batches')
     parser.add_argument('--update_epochs', type=int, default=4,
@@ -141,10 +144,28 @@ def parse_args():
                         help='the maximum number of steps total')
     parser.add_argument('--trajectory_path', type=str, default=None,
                         help='the path to the trajectory file')
+    parser.add_argument('--stream_trajectories', action='store_true', default=False,
+                        help='if toggled, trajectories are written to disk during training (requires a .traj path)')
     parser.add_argument('--fully_observed', action='store_true', default=False,
                         help='if toggled, the environment will be fully observed')
     parser.add_argument('--one_hot_obs', action='store_true', default=False,
                         help='if toggled, the environment will be partially observed one hot encoded')
+    parser.add_argument('--vector_env', type=str, default='sync',
+                        choices=['sync', 'async', 'async_shared_memory'],
+                        help='how the environments are stepped, in this process or in subprocesses')
+    parser.add_argument('--pipelined_rollout', action='store_true', default=False,
+                        help='if toggled, the policy acts for half of the envs while the other half steps')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='the number of rollout worker processes, 0 to roll out in the learner')
+    parser.add_argument('--max_policy_lag', type=int, default=1,
+                        help='rollouts collected more updates ago than this are dropped')
+    parser.add_argument('--off_policy_correction', type=str, default='none',
+                        choices=['none', 'ratio', 'vtrace'],
+                        help='how rollouts of lagging workers are corrected, see src/ppo/actor_learner.py')
+    parser.add_argument('--importance_clip', type=float, default=1.0,
+                        help='the truncation of the importance ratios of the off-policy correction')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'],
+                        help='bf16 runs the forward passes under bfloat16 autocast, see src/precision.py')
 
     args = parser.parse_args()
     return args
@@ -169,6 +190,7 @@ class PPOArgs:
     num_steps: int = 128
     gamma: float = 0.99
     gae_lambda: float = 0.95
+    advantage_method: str = 'auto'
     num_minibatches: int = 4
     update_epochs: int = 4
     clip_coef: float = 0.4
@@ -203,6 +225,7 @@ arg_help_strings = dict(
     num_steps="number of steps taken in the rollout phase",
     gamma="the discount factor gamma",
     gae_lambda="the discount factor used in our GAE estimation",
+    advantage_method="how GAE is computed: loop, vectorized, scan or auto",
     update_epochs="how many times you loop through the data generated in rollout",
     clip_coef="the epsilon term used in the policy loss function",
     ent_coef="coefficient of entropy bonus term",
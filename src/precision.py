@@ -0,0 +1,50 @@
+'''
+Mixed precision for the trajectory models and PPO agents.
+
+With precision "bf16", forward passes run under autocast to bfloat16, so
+matmuls and linear layers use the bf16 kernels of CPUs with AVX512-BF16 or
+AMX (and of GPUs). The weights, gradients and optimizer state stay in
+float32, so no loss scaling is needed. The attention scores are cast to
+float32 before their softmax, and model outputs are cast back to float32
+with to_float32 before the softmaxes of losses, sampling and advantages.
+'''
+import contextlib
+
+import torch as t
+from torch import nn
+
+PRECISIONS = ["fp32", "bf16"]
+
+
+def attention_scores_to_float32(module, input, output):
+    return output.float()
+
+
+@contextlib.contextmanager
+def autocast(precision: str = "fp32", device="cpu", model: nn.Module = None):
+    '''
+    The context forward passes run in: autocast to bfloat16 on the type of
+    device for "bf16", nothing for "fp32". When the model is given, its
+    attention softmaxes run in float32, with forward hooks on its
+    hook_attn_scores that are removed on exit.
+    '''
+    assert precision in PRECISIONS, f"precision must be one of {PRECISIONS}"
+    if precision == "fp32":
+        yield
+        return
+
+    handles = [] if model is None else [
+        module.register_forward_hook(attention_scores_to_float32)
+        for name, module in model.named_modules() if name.endswith("hook_attn_scores")]
+    try:
+        with t.autocast(device_type=t.device(device).type, dtype=t.bfloat16):
+            yield
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
+def to_float32(*tensors):
+    '''Casts model outputs (None is passed through) to float32.'''
+    tensors = tuple(None if tensor is None else tensor.float() for tensor in tensors)
+    return tensors if len(tensors) > 1 else tensors[0]
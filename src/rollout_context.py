@@ -0,0 +1,147 @@
+'''
+Fixed size context windows for batched rollouts of trajectory models.
+
+Trajectory models predict from the last few timesteps of every env, so a
+rollout has to keep a sliding window of observations, actions, RTGs and
+timesteps per env. RolloutContext preallocates these windows once and
+updates them in place, so the step loop of a rollout does not allocate.
+'''
+import numpy as np
+import torch as t
+
+
+class RolloutContext():
+    '''
+    Sliding windows over the last max_len timesteps of num_envs rollouts.
+
+    Every buffer is twice as long as the window and every timestep is written
+    to two slots, i and i + max_len. The window then is always the contiguous
+    slice ending at the newest timestep, without rolling any memory.
+
+    Actions are stored at the timestep they were taken at, so the action of
+    the newest timestep is a pad token until the next timestep is appended.
+    Windows can be padded (always max_len long, padded with zero observations
+    and pad actions) or grow from a single timestep up to max_len.
+    '''
+
+    def __init__(self,
+                 num_envs: int,
+                 max_len: int,
+                 obs_shape,
+                 action_pad_token: int = 0,
+                 obs_dtype: t.dtype = t.float32,
+                 timestep_dtype: t.dtype = t.long,
+                 device: t.device = t.device("cpu")):
+        self.num_envs = num_envs
+        self.max_len = max_len
+        self.action_pad_token = action_pad_token
+
+        self.obs = t.zeros(
+            (num_envs, 2 * max_len, *obs_shape), dtype=obs_dtype, device=device)
+        self.actions = t.full(
+            (num_envs, 2 * max_len, 1), action_pad_token, dtype=t.long, device=device)
+        self.rtg = t.zeros((num_envs, 2 * max_len, 1), dtype=t.float32, device=device)
+        self.timesteps = t.zeros(
+            (num_envs, 2 * max_len, 1), dtype=timestep_dtype, device=device)
+
+        # the newest timestep is in slots newest and newest + max_len
+        self.newest = max_len - 1
+        self.length = 0
+
+    def start(self, obs, rtg=None, timesteps=0, padded=False):
+        '''
+        Starts the windows of every env at obs (num_envs, ...).
+        '''
+        self.obs.zero_()
+        self.actions.fill_(self.action_pad_token)
+        self.rtg.zero_()
+        self.timesteps.zero_()
+        self.newest = self.max_len - 1
+        self.length = self.max_len if padded else 1
+        self.write(obs, rtg, timesteps)
+
+    def append(self, obs, action, rtg=None, timesteps=None):
+        '''
+        Slides the windows by one timestep.
+
+        Args:
+            obs: (num_envs, ...) the new observations
+            action: (num_envs,) the actions taken at the previous timestep
+            rtg: (num_envs, 1) the new RTGs, zero if not given
+            timesteps: (num_envs, 1) the new timesteps (or a scalar), one
+                more than the previous timesteps if not given
+        '''
+        self.write_slot(self.actions, action.reshape(-1, 1))
+
+        previous = self.newest
+        self.newest = (self.newest + 1) % self.max_len
+        self.length = min(self.length + 1, self.max_len)
+
+        self.write_slot(self.actions, self.action_pad_token)
+        if timesteps is None:
+            # in place, the newest slots are free now
+            timesteps = self.timesteps[:, self.newest].copy_(
+                self.timesteps[:, previous]).add_(1)
+        self.write(obs, rtg, timesteps)
+
+    def write(self, obs, rtg=None, timesteps=0):
+        '''
+        Overwrites the newest timestep of every env.
+        '''
+        self.write_slot(self.obs, obs)
+        self.write_slot(self.rtg, 0 if rtg is None else rtg)
+        self.write_slot(self.timesteps, timesteps)
+
+    def write_slot(self, buffer, value):
+        buffer[:, self.newest] = value
+        buffer[:, self.newest + self.max_len] = value
+
+    def reset(self, mask, obs):
+        '''
+        Restarts the windows of the envs in mask (num_envs,) from obs, their
+        newest observations: earlier observations are zeroed, actions padded
+        and every timestep set to 0. Only padded windows can be reset.
+
+        Only the rows of the envs in mask are written, with one indexed fill
+        per buffer, and nothing is done if mask is empty. The indices are
+        found on the host, so a numpy mask (as returned by vector envs)
+        doesn't synchronize with the device.
+        '''
+        if isinstance(mask, t.Tensor):
+            mask = mask.cpu().numpy()
+        env_idxs = np.flatnonzero(mask)
+        if len(env_idxs) == 0:
+            return
+        env_idxs = t.from_numpy(env_idxs).to(self.obs.device)
+
+        self.obs.index_fill_(0, env_idxs, 0)
+        self.actions.index_fill_(0, env_idxs, self.action_pad_token)
+        self.rtg.index_fill_(0, env_idxs, 0)
+        self.timesteps.index_fill_(0, env_idxs, 0)
+        # the other envs already hold obs as their newest observation
+        obs = obs[env_idxs]
+        self.obs[env_idxs, self.newest] = obs
+        self.obs[env_idxs, self.newest + self.max_len] = obs
+
+    def get(self, length=None):
+        '''
+        Returns views of the last length (by default all) timesteps in the
+        windows as (obs, actions, rtg, timesteps). Actions only cover the
+        timesteps before the newest one and are None for a single timestep.
+        '''
+        length = self.length if length is None else min(length, self.length)
+        end = self.newest + self.max_len + 1
+        start = end - length
+        actions = self.actions[:, start:end - 1] if length > 1 else None
+        return (self.obs[:, start:end], actions,
+                self.rtg[:, start:end], self.timesteps[:, start:end])
+
+    def get_previous_actions(self, length):
+        '''
+        Returns a view of the actions taken before each of the last length
+        timesteps, the pad token before the first one. Only the actions of
+        the window are kept, so length must be less than max_len.
+        '''
+        assert length < self.max_len, "The action before the window is not kept"
+        end = self.newest + self.max_len
+        return self.actions[:, end - length:end]
@@ -34,6 +34,11 @@ if __name__ == "__main__":
                         default=0.1, help="Step size for initial RTG")
     parser.add_argument("--num_envs", type=int,
                         default=8, help="How many environments to run in parallel")
+    parser.add_argument("--sequential", action="store_true",
+                        help="Evaluate one initial RTG at a time instead of the whole range in one batch")
+    parser.add_argument("--vector_env", type=str, default="sync",
+                        choices=["sync", "async", "async_shared_memory"],
+                        help="How the environments are stepped, see make_vector_env")
     args = parser.parse_args()
 
     logger.info(f"Loading model from {args.model_path}")
@@ -93,7 +98,9 @@ if __name__ == "__main__":
         initial_rtg_range=np.linspace(args.initial_rtg_min, args.initial_rtg_max, int(
             (args.initial_rtg_max - args.initial_rtg_min) / args.initial_rtg_step)),
         trajectories=args.n_trajectories,
-        num_envs=args.num_envs
+        num_envs=args.num_envs,
+        batched=not args.sequential,
+        vector_env=args.vector_env
     )
 
     fig = plot_calibration_statistics(statistics, show_spread=True, CI=0.95)
@@ -0,0 +1,27 @@
+'''
+This file is the entry point for converting legacy (.pkl/.gz/.xz) trajectory
+files to the chunked, memory mapped columnar format.
+'''
+import argparse
+import os
+
+from .trajectory_store import COLUMNAR_SUFFIX, DEFAULT_CHUNK_SIZE, convert_to_columnar
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Convert Trajectories",
+        description="Convert a pickled trajectory file to a columnar trajectory store.")
+    parser.add_argument("--trajectory_path", type=str, required=True,
+                        help="Path to the legacy .pkl/.gz/.xz trajectory file")
+    parser.add_argument("--output_path", type=str, default=None,
+                        help="Path of the columnar store, defaults to the input path with a .traj suffix")
+    parser.add_argument("--chunk_size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Number of timesteps written per chunk")
+    args = parser.parse_args()
+
+    output_path = args.output_path or \
+        os.path.splitext(args.trajectory_path)[0] + COLUMNAR_SUFFIX
+
+    convert_to_columnar(args.trajectory_path, output_path,
+                        chunk_size=args.chunk_size)
+    print(f"Trajectories converted to {output_path}")
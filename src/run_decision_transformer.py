@@ -32,6 +32,7 @@ if __name__ == "__main__":
         layer_norm=args.layer_norm,
         time_embedding_type=TIME_EMBEDDING_TYPE,
         n_ctx=args.n_ctx,
+        fast_path=args.fast_path,
         device='cuda' if args.cuda and t.cuda.is_available() else 'cpu'
     )
 
@@ -49,7 +50,13 @@ if __name__ == "__main__":
         eval_episodes=args.eval_episodes,
         initial_rtg=args.initial_rtg,
         prob_go_from_end=args.prob_go_from_end,
-        eval_max_time_steps=args.eval_max_time_steps
+        eval_max_time_steps=args.eval_max_time_steps,
+        eval_vector_env=args.eval_vector_env,
+        num_workers=args.num_workers,
+        prefetch_factor=args.prefetch_factor,
+        persistent_workers=args.persistent_workers,
+        pin_memory=args.pin_memory,
+        precision=args.precision,
     )
 
     run_decision_transformer(
@@ -22,6 +22,7 @@ if __name__ == "__main__":
         max_steps=args.max_steps,
         capture_video=args.capture_video,
         view_size=args.view_size,
+        vector_env=args.vector_env,
     )
 
     online_config = OnlineTrainConfig(
@@ -33,6 +34,7 @@ if __name__ == "__main__":
         num_steps=args.num_steps,
         gamma=args.gamma,
         gae_lambda=args.gae_lambda,
+        advantage_method=args.advantage_method,
         num_minibatches=args.num_minibatches,
         update_epochs=args.update_epochs,
         clip_coef=args.clip_coef,
@@ -40,7 +42,14 @@ if __name__ == "__main__":
         vf_coef=args.vf_coef,
         max_grad_norm=args.max_grad_norm,
         trajectory_path=args.trajectory_path,
+        stream_trajectories=args.stream_trajectories,
         fully_observed=args.fully_observed,
+        pipelined_rollout=args.pipelined_rollout,
+        num_workers=args.num_workers,
+        max_policy_lag=args.max_policy_lag,
+        off_policy_correction=args.off_policy_correction,
+        importance_clip=args.importance_clip,
+        precision=args.precision,
     )
 
     transformer_config = None  # TransformerModelConfig()
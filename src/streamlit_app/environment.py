@@ -5,6 +5,7 @@ import gymnasium as gym
 import minigrid
 import math
 
+from src.decision_transformer.export import export_decision_transformer
 from src.decision_transformer.utils import load_decision_transformer
 from src.environments.environments import make_env
 from src.utils import pad_tensor
@@ -66,6 +67,17 @@ def get_env_and_dt(model_path):
     return env, dt
 
 
+@st.cache(allow_output_mutation=True)
+def get_exported_dt(model_path, batch_size=1):
+    '''
+    The playground's model exported to TorchScript, see
+    export_decision_transformer. It only predicts actions and has no hooks,
+    so use it where no activations are needed.
+    '''
+    env, dt = get_env_and_dt(model_path)
+    return export_decision_transformer(dt, batch_size=batch_size)
+
+
 def get_action_preds(dt):
     max_len = dt.n_ctx // 3
 
@@ -0,0 +1,536 @@
+'''
+On-disk columnar storage for trajectories.
+
+A columnar trajectory store is a directory (by convention ending in ".traj")
+holding one raw array file per field plus a JSON metadata sidecar:
+
+    trajectories.traj/
+        metadata.json
+        observations.bin
+        actions.bin
+        rewards.bin
+        dones.bin
+        truncated.bin
+
+Every field is laid out exactly like the arrays in the legacy pickle format,
+that is (time, env, ...), and is written in fixed-size chunks of timesteps so
+that neither the writer nor the converter ever needs the whole dataset in
+memory. The reader opens every field with np.memmap, so loading is
+effectively free and the OS page cache takes care of the rest.
+
+StreamingTrajectoryStore builds on this to write trajectories while they are
+being collected: steps are copied into preallocated chunks which are appended
+to the store by a background thread, and the sidecar is rewritten after every
+chunk so that an interrupted run can still be read up to its last flush.
+'''
+import dataclasses
+import hashlib
+import json
+import os
+import queue
+import shutil
+import threading
+import warnings
+
+import numpy as np
+
+COLUMNAR_SUFFIX = ".traj"
+METADATA_FILE = "metadata.json"
+CACHE_DIR = "cache"
+STATS_FILE = "stats.npz"
+STATS_SUFFIX = ".stats.npz"
+# bump when the content of the statistics cache changes
+STATS_VERSION = 1
+FORMAT_VERSION = 1
+DEFAULT_CHUNK_SIZE = 1024
+
+COLUMNAR_FIELDS = ("observations", "actions", "rewards", "dones", "truncated")
+
+# MiniGrid image observations are small integer codes (object, color, state)
+# or 0/1 (one hot), so they fit in a byte. Anything else is stored as float32.
+OBSERVATION_DTYPES = {
+    "index": np.uint8,
+    "one_hot": np.uint8,
+}
+
+
+def get_observation_type(observation_shape) -> str:
+    '''
+    Returns "index" or "one_hot" for MiniGrid image observations
+    (3 and 20 channels respectively) and "flat" for anything else.
+    '''
+    if observation_shape[-1] == 3:
+        return "index"
+    elif observation_shape[-1] == 20:
+        return "one_hot"
+    return "flat"
+
+
+def get_observation_dtype(observations) -> np.dtype:
+    '''
+    Returns the most compact dtype that stores the observations without loss.
+    Image observations are only narrowed to uint8 if they hold integers in
+    range, so continuous observations with 3 or 20 features stay float32.
+    '''
+    observations = np.asarray(observations)
+    dtype = OBSERVATION_DTYPES.get(
+        get_observation_type(observations.shape), np.float32)
+    if dtype == np.uint8 and observations.size > 0:
+        info = np.iinfo(dtype)
+        if not (np.all(observations == np.round(observations))
+                and observations.min() >= info.min and observations.max() <= info.max):
+            return np.dtype(np.float32)
+    return np.dtype(dtype)
+
+
+def is_columnar_path(path: str) -> bool:
+    '''
+    Returns true if the path points at a columnar trajectory store.
+    '''
+    path = path.rstrip("/")
+    return path.endswith(COLUMNAR_SUFFIX) or os.path.isfile(
+        os.path.join(path, METADATA_FILE))
+
+
+def _json_default(obj):
+    '''
+    Makes run metadata JSON serializable. Numpy scalars and arrays are
+    converted to python types and dataclasses to dicts. Anything else (such
+    as gym spaces) is stored as its string representation with a warning,
+    since it will not round trip to its original type.
+    '''
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if dataclasses.is_dataclass(obj):
+        return dataclasses.asdict(obj)
+    warnings.warn(
+        f"Metadata value of type {type(obj).__name__} is not JSON serializable, "
+        f"storing its string representation instead: {obj!r}")
+    return str(obj)
+
+
+class ColumnarTrajectoryStore():
+    '''
+    Writes trajectories to a columnar store one chunk of timesteps at a time.
+
+    Usage:
+        store = ColumnarTrajectoryStore(path, chunk_size=1024)
+        store.append_chunk(observations=..., actions=..., ...)
+        store.finalize(metadata)
+    '''
+
+    def __init__(self, path: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.path = path.rstrip("/")
+        self.chunk_size = chunk_size
+        self.num_steps = 0
+        self.fields = {}
+
+        os.makedirs(self.path, exist_ok=True)
+        # remove the old sidecar first so that a store being rewritten (or left
+        # behind by a crashed writer) is never read against truncated fields
+        if os.path.exists(os.path.join(self.path, METADATA_FILE)):
+            os.remove(os.path.join(self.path, METADATA_FILE))
+        # arrays derived from the old content are no longer valid
+        shutil.rmtree(os.path.join(self.path, CACHE_DIR), ignore_errors=True)
+        # truncate any previous content so that appending starts from scratch
+        for field in COLUMNAR_FIELDS:
+            open(self.field_path(field), "wb").close()
+
+    def field_path(self, field: str) -> str:
+        return os.path.join(self.path, field + ".bin")
+
+    def append_chunk(self, **arrays: np.ndarray) -> None:
+        '''
+        Appends a chunk of timesteps, each array shaped (time, env, ...).
+        All fields must be provided and share the same number of timesteps.
+        '''
+        assert set(arrays.keys()) == set(COLUMNAR_FIELDS), \
+            f"Expected fields {COLUMNAR_FIELDS}, got {tuple(arrays.keys())}"
+
+        n_steps = {len(array) for array in arrays.values()}
+        assert len(n_steps) == 1, "All fields must have the same number of timesteps"
+        n_steps = n_steps.pop()
+
+        for field, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            if field not in self.fields:
+                self.fields[field] = {
+                    "dtype": array.dtype.str,
+                    "shape": list(array.shape[1:]),
+                }
+            assert list(array.shape[1:]) == self.fields[field]["shape"], \
+                f"Shape mismatch for {field}: {array.shape[1:]} vs {self.fields[field]['shape']}"
+            array = array.astype(np.dtype(self.fields[field]["dtype"]), copy=False)
+            with open(self.field_path(field), "ab") as f:
+                array.tofile(f)
+
+        self.num_steps += n_steps
+
+    def write_metadata(self, metadata: dict) -> None:
+        '''
+        Writes the JSON sidecar describing the store. The sidecar is written
+        to a temporary file and moved into place so that readers never see
+        a partially written file.
+        '''
+        sidecar = {
+            "format_version": FORMAT_VERSION,
+            "chunk_size": self.chunk_size,
+            "num_steps": self.num_steps,
+            "fields": {
+                field: {
+                    "dtype": spec["dtype"],
+                    "shape": [self.num_steps] + spec["shape"],
+                } for field, spec in self.fields.items()
+            },
+            "metadata": metadata,
+        }
+
+        tmp_path = os.path.join(self.path, METADATA_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(sidecar, f, default=_json_default)
+        os.replace(tmp_path, os.path.join(self.path, METADATA_FILE))
+
+    def finalize(self, metadata: dict) -> None:
+        self.write_metadata(metadata)
+
+
+class StreamingTrajectoryStore():
+    '''
+    Streams single timesteps into a columnar store.
+
+    Steps are written into a small ring of preallocated chunks (each chunk
+    holds chunk_size timesteps of every field). Full chunks are handed to a
+    background thread which appends them to the store, so memory use is
+    bounded by num_chunks * chunk_size steps no matter how long the run is.
+    A full chunk is only handed off once the next step arrives, so the most
+    recent step can still be modified (see last_step) until close is called.
+
+    Usage:
+        stream = StreamingTrajectoryStore(path, chunk_size=1024)
+        stream.append_step(observations=..., actions=..., ...)
+        stream.close(metadata)
+    '''
+
+    def __init__(self,
+                 path: str,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 num_chunks: int = 2,
+                 dtypes: dict = None,
+                 metadata: dict = None):
+        assert num_chunks >= 2, "At least two chunks are needed to write in the background"
+        self.store = ColumnarTrajectoryStore(path, chunk_size=chunk_size)
+        self.chunk_size = chunk_size
+        self.num_chunks = num_chunks
+        self.dtypes = dtypes or {}
+        self.metadata = metadata or {}
+
+        self.chunk = None
+        self.position = 0
+        self.free_chunks = queue.Queue()
+        self.full_chunks = queue.Queue()
+        self.error = None
+        self.closed = False
+
+        self.thread = threading.Thread(target=self._flush_chunks, daemon=True)
+        self.thread.start()
+
+    def _allocate_chunks(self, step: dict) -> None:
+        for _ in range(self.num_chunks):
+            self.free_chunks.put({
+                field: np.empty(
+                    (self.chunk_size, *np.shape(step[field])),
+                    dtype=self.dtypes.get(field, np.asarray(step[field]).dtype))
+                for field in COLUMNAR_FIELDS
+            })
+
+    def _flush_chunks(self) -> None:
+        while True:
+            item = self.full_chunks.get()
+            if item is None:
+                return
+            chunk, n_steps = item
+            try:
+                if self.error is None:
+                    self.store.append_chunk(
+                        **{field: array[:n_steps] for field, array in chunk.items()})
+                    self.store.write_metadata(self.metadata)
+            except Exception as e:
+                self.error = e
+            self.free_chunks.put(chunk)
+
+    def _raise_if_failed(self) -> None:
+        if self.error is not None:
+            raise RuntimeError(
+                f"Writing trajectories to {self.store.path} failed") from self.error
+
+    def append_step(self, **step: np.ndarray) -> None:
+        '''
+        Appends a single timestep, each array shaped (env, ...).
+        Blocks if every chunk is still waiting to be written to disk.
+        '''
+        assert not self.closed, "Cannot append to a closed stream"
+        assert set(step.keys()) == set(COLUMNAR_FIELDS), \
+            f"Expected fields {COLUMNAR_FIELDS}, got {tuple(step.keys())}"
+        self._raise_if_failed()
+
+        if self.chunk is None:
+            self._allocate_chunks(step)
+            self.chunk = self.free_chunks.get()
+        elif self.position == self.chunk_size:
+            self.full_chunks.put((self.chunk, self.position))
+            self.chunk = self.free_chunks.get()
+            self.position = 0
+
+        for field in COLUMNAR_FIELDS:
+            self.chunk[field][self.position] = step[field]
+        self.position += 1
+
+    def last_step(self) -> dict:
+        '''
+        Returns writable views of the most recently appended step.
+        '''
+        assert self.chunk is not None and self.position > 0, "No steps have been appended"
+        return {field: array[self.position - 1] for field, array in self.chunk.items()}
+
+    def close(self, metadata: dict = None) -> None:
+        '''
+        Writes the remaining steps, waits for the background thread and
+        finalizes the store.
+        '''
+        if self.closed:
+            return
+        if self.chunk is not None and self.position > 0:
+            self.full_chunks.put((self.chunk, self.position))
+        self.chunk = None
+        self.full_chunks.put(None)
+        self.thread.join()
+        self.closed = True
+
+        self._raise_if_failed()
+        if metadata is not None:
+            self.metadata = metadata
+        self.store.finalize(self.metadata)
+
+
+def write_columnar(path: str,
+                   data: dict,
+                   metadata: dict,
+                   chunk_size: int = DEFAULT_CHUNK_SIZE,
+                   dtypes: dict = None) -> None:
+    '''
+    Writes a dictionary of (time, env, ...) arrays or per-step lists
+    to a columnar store in chunks of chunk_size timesteps.
+
+    dtypes optionally maps field names to the dtype they are stored as.
+    '''
+    dtypes = dtypes or {}
+    store = ColumnarTrajectoryStore(path, chunk_size=chunk_size)
+    num_steps = len(data["observations"])
+    for start in range(0, num_steps, chunk_size):
+        store.append_chunk(**{
+            field: np.asarray(
+                data[field][start:start + chunk_size], dtype=dtypes.get(field))
+            for field in COLUMNAR_FIELDS
+        })
+    store.finalize(metadata)
+
+
+def read_columnar(path: str, mode: str = "r") -> dict:
+    '''
+    Opens a columnar store, memory mapping every field.
+
+    Returns a dictionary in the same layout as the legacy pickle format:
+        {"data": {"observations": ..., ...}, "metadata": {...}}
+    '''
+    path = path.rstrip("/")
+    with open(os.path.join(path, METADATA_FILE), "r") as f:
+        sidecar = json.load(f)
+
+    if sidecar["format_version"] > FORMAT_VERSION:
+        raise ValueError(
+            f"Trajectory store {path} has format version {sidecar['format_version']}, "
+            f"but only versions up to {FORMAT_VERSION} are supported.")
+
+    data = {}
+    for field, spec in sidecar["fields"].items():
+        shape = tuple(spec["shape"])
+        if shape[0] == 0:
+            data[field] = np.zeros(shape, dtype=np.dtype(spec["dtype"]))
+            continue
+        data[field] = np.memmap(
+            os.path.join(path, field + ".bin"),
+            dtype=np.dtype(spec["dtype"]),
+            mode=mode,
+            shape=shape,
+        )
+
+    return {
+        "data": data,
+        "metadata": sidecar["metadata"],
+    }
+
+
+def read_cached_array(path: str, name: str, dtype, shape: tuple):
+    '''
+    Memory maps an array previously cached in a columnar store with
+    write_cached_array. Returns None if the store has no such cache or its
+    shape does not match (for example because a stream has grown since).
+    '''
+    cache_path = os.path.join(path.rstrip("/"), CACHE_DIR, name + ".bin")
+    if not is_columnar_path(path) or not os.path.isfile(cache_path):
+        return None
+    if os.path.getsize(cache_path) != np.dtype(dtype).itemsize * int(np.prod(shape)):
+        return None
+    if int(np.prod(shape)) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(cache_path, dtype=dtype, mode="r", shape=shape)
+
+
+def write_cached_array(path: str, name: str, array: np.ndarray) -> None:
+    '''
+    Caches an array derived from the store's content (such as the
+    reward-to-go) next to its fields so later runs can skip computing it.
+    The cache is cleared whenever the store is rewritten. Stores that are
+    not writable are left untouched with a warning.
+    '''
+    cache_dir = os.path.join(path.rstrip("/"), CACHE_DIR)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = os.path.join(cache_dir, name + ".bin.tmp")
+        np.ascontiguousarray(array).tofile(tmp_path)
+        os.replace(tmp_path, os.path.join(cache_dir, name + ".bin"))
+    except OSError as e:
+        warnings.warn(f"Could not cache {name} in {path}: {e}")
+
+
+def get_content_hash(path: str) -> str:
+    '''
+    Returns a hash identifying the content of a trajectory file or store.
+
+    Files are hashed in full. For columnar stores every field but the
+    observations is hashed together with the metadata sidecar, and the
+    observations by their size and modification time, so a rewrite of the
+    observations alone also changes the hash. This keeps warm starts from
+    reading the bulk of the data just to validate a cache.
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    if is_columnar_path(path):
+        names = [METADATA_FILE] + [
+            field + ".bin" for field in COLUMNAR_FIELDS if field != "observations"]
+        paths = [os.path.join(path.rstrip("/"), name) for name in names]
+        observations_path = os.path.join(path.rstrip("/"), "observations.bin")
+        if os.path.exists(observations_path):
+            stat = os.stat(observations_path)
+            digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    else:
+        paths = [path]
+
+    for file_path in paths:
+        if not os.path.exists(file_path):
+            continue
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def get_stats_path(path: str) -> str:
+    '''
+    Columnar stores keep their statistics cache with their other caches,
+    trajectory files in a sidecar next to them.
+    '''
+    if is_columnar_path(path):
+        return os.path.join(path.rstrip("/"), CACHE_DIR, STATS_FILE)
+    return path + STATS_SUFFIX
+
+
+def read_stats_cache(path: str, key: str):
+    '''
+    Returns the cached statistics of a trajectory file or store as a
+    dictionary of arrays, or None if there is no cache for this key.
+    '''
+    stats_path = get_stats_path(path)
+    if not os.path.isfile(stats_path):
+        return None
+    with np.load(stats_path) as cached:
+        if str(cached["key"]) != key or int(cached["version"]) != STATS_VERSION:
+            return None
+        return {name: cached[name] for name in cached.files if name not in ("key", "version")}
+
+
+def write_stats_cache(path: str, key: str, stats: dict) -> None:
+    '''
+    Writes the statistics of a trajectory file or store to its cache.
+    Locations that are not writable are left untouched with a warning.
+    '''
+    stats_path = get_stats_path(path)
+    try:
+        os.makedirs(os.path.dirname(stats_path) or ".", exist_ok=True)
+        tmp_path = stats_path + ".tmp.npz"
+        np.savez(tmp_path, key=key, version=STATS_VERSION, **stats)
+        os.replace(tmp_path, stats_path)
+    except OSError as e:
+        warnings.warn(f"Could not cache statistics of {path}: {e}")
+
+
+def get_observation_moments(observations: np.ndarray, chunk_size: int = 256):
+    '''
+    Returns the count, mean and sum of squared deviations (M2) of
+    observations shaped (env, time, ...), streaming over chunk_size steps at
+    a time and merging the chunks with Chan et al.'s parallel variant of
+    Welford's algorithm. Only one chunk is ever widened to float64.
+    '''
+    count = 0
+    mean = np.zeros(observations.shape[2:], dtype=np.float64)
+    m2 = np.zeros(observations.shape[2:], dtype=np.float64)
+    for start in range(0, observations.shape[1], chunk_size):
+        chunk = np.asarray(observations[:, start:start + chunk_size], dtype=np.float64)
+        chunk = chunk.reshape(-1, *observations.shape[2:])
+        count, mean, m2 = merge_moments(
+            count, mean, m2,
+            len(chunk), chunk.mean(axis=0), ((chunk - chunk.mean(axis=0)) ** 2).sum(axis=0))
+    return count, mean, m2
+
+
+def merge_moments(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+    '''
+    Merges the count, mean and M2 of two sets of samples.
+    '''
+    count = count_a + count_b
+    if count == 0:
+        return count, mean_a, m2_a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    m2 = m2_a + m2_b + delta ** 2 * count_a * count_b / count
+    return count, mean, m2
+
+
+def convert_to_columnar(source_path: str, target_path: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+    '''
+    Converts a legacy .pkl/.gz/.xz trajectory file to a columnar store.
+    Infos are not carried over since they are not used for training.
+    Observations and rewards are narrowed to compact dtypes on the way.
+    '''
+    # imported here to avoid a circular import with the decision transformer package
+    from src.decision_transformer.offline_dataset import TrajectoryReader
+
+    data = TrajectoryReader(source_path).read()
+    dtypes = {
+        "observations": get_observation_dtype(data["data"]["observations"]),
+        "actions": np.dtype(np.int64),
+        "rewards": np.dtype(np.float32),
+        "dones": np.dtype(bool),
+        "truncated": np.dtype(bool),
+    }
+    metadata = dict(data["metadata"])
+    metadata["dtypes"] = {field: dtype.name for field, dtype in dtypes.items()}
+
+    write_columnar(
+        target_path,
+        data=data["data"],
+        metadata=metadata,
+        chunk_size=chunk_size,
+        dtypes=dtypes,
+    )
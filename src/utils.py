@@ -12,6 +12,10 @@ import torch as t
 from typeguard import typechecked
 
 import wandb
+from src.trajectory_store import (COLUMNAR_SUFFIX, DEFAULT_CHUNK_SIZE,
+                                  StreamingTrajectoryStore,
+                                  get_observation_dtype, is_columnar_path,
+                                  write_columnar)
 
 
 class TrajectoryWriter():
@@ -24,9 +28,22 @@ class TrajectoryWriter():
         - the dones
         - the infos
     And store them in a set of lists, indexed by batch b and time t.
+
+    Paths ending in .xz or .gz are written as compressed pickles, paths
+    ending in .traj as a chunked columnar store (see src/trajectory_store.py)
+    and anything else as a plain pickle.
+
+    With stream=True (columnar paths only) nothing is kept in these lists.
+    Steps are instead written to disk chunk by chunk while training runs,
+    and write() only flushes the last chunk and finalizes the metadata.
+    Infos are not stored when streaming.
+
+    Fields are stored with compact dtypes (see get_dtypes) and recorded in
+    the metadata under "dtypes". Readers widen them when batches are built.
     '''
 
-    def __init__(self, path, run_config, environment_config, online_config, transformer_model_config=None):
+    def __init__(self, path, run_config, environment_config, online_config, transformer_model_config=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE, stream=False):
         self.observations = []
         self.actions = []
         self.rewards = []
@@ -34,6 +51,7 @@ class TrajectoryWriter():
         self.truncated = []
         self.infos = []
         self.path = path
+        self.chunk_size = chunk_size
 
         args = run_config.__dict__ | environment_config.__dict__ | online_config.__dict__
         if transformer_model_config is not None:
@@ -41,6 +59,28 @@ class TrajectoryWriter():
 
         self.args = args
 
+        # the stream is opened on the first step, once the observations are known
+        self.streaming = stream
+        self.stream = None
+        self.dtypes = None
+        if stream and not is_columnar_path(path):
+            raise ValueError(
+                f"Streaming requires a columnar ({COLUMNAR_SUFFIX}) trajectory path, got {path}")
+
+    def get_dtypes(self, observations):
+        '''
+        Returns the dtypes each field is stored with. Observations are
+        narrowed according to their type (see get_observation_dtype) and
+        rewards are stored as float32.
+        '''
+        return {
+            'observations': get_observation_dtype(observations),
+            'actions': np.dtype(np.int64),
+            'rewards': np.dtype(np.float32),
+            'dones': np.dtype(bool),
+            'truncated': np.dtype(bool),
+        }
+
     @typechecked
     def accumulate_trajectory(self,
                               next_obs: np.ndarray,
@@ -49,6 +89,23 @@ class TrajectoryWriter():
                               truncated: np.ndarray,
                               action: np.ndarray,
                               info: Dict):
+        if self.streaming:
+            if self.stream is None:
+                self.dtypes = self.get_dtypes(next_obs)
+                self.stream = StreamingTrajectoryStore(
+                    self.path,
+                    chunk_size=self.chunk_size,
+                    dtypes=self.dtypes,
+                    metadata=self.get_metadata())
+            self.stream.append_step(
+                observations=next_obs,
+                actions=action,
+                rewards=reward,
+                dones=done,
+                truncated=truncated,
+            )
+            return
+
         self.observations.append(next_obs)
         self.actions.append(action)
         self.rewards.append(reward)
@@ -65,20 +122,16 @@ class TrajectoryWriter():
 
         I don't love this solution, but it will do for now.
         '''
+        if self.stream is not None:
+            self.stream.last_step()['truncated'][:] = True
+            return
+
         n_envs = len(self.dones[-1])
         for i in range(n_envs):
             self.truncated[-1][i] = True
 
-    def write(self, upload_to_wandb: bool = False):
+    def get_metadata(self):
 
-        data = {
-            'observations': np.array(self.observations, dtype=np.float64),
-            'actions': np.array(self.actions, dtype=np.int64),
-            'rewards': np.array(self.rewards, dtype=np.float64),
-            'dones': np.array(self.dones, dtype=bool),
-            'truncated': np.array(self.truncated, dtype=bool),
-            'infos': np.array(self.infos, dtype=object)
-        }
         if dataclasses.is_dataclass(self.args):
             metadata = {
                 "args": asdict(self.args),  # Args such as ppo args
@@ -90,9 +143,55 @@ class TrajectoryWriter():
                 "time": time.time()  # Time of writing
             }
 
+        if self.dtypes is not None:
+            metadata["dtypes"] = {
+                field: np.dtype(dtype).name for field, dtype in self.dtypes.items()}
+
+        return metadata
+
+    def write(self, upload_to_wandb: bool = False):
+
+        if self.stream is None:
+            self.dtypes = self.get_dtypes(self.observations)
+        metadata = self.get_metadata()
+
+        # streamed steps are already on disk
+        if self.stream is not None:
+            print(f"Finalizing {self.path}, using columnar format")
+            self.stream.close(metadata)
+            self.upload(upload_to_wandb)
+            return
+
         if not os.path.exists(os.path.dirname(self.path)):
             os.makedirs(os.path.dirname(self.path))
 
+        # columnar stores are written chunk by chunk straight from the buffers
+        if is_columnar_path(self.path):
+            print(f"Writing to {self.path}, using columnar format")
+            write_columnar(
+                self.path,
+                data={
+                    'observations': self.observations,
+                    'actions': self.actions,
+                    'rewards': self.rewards,
+                    'dones': self.dones,
+                    'truncated': self.truncated,
+                },
+                metadata=metadata,
+                chunk_size=self.chunk_size,
+                dtypes=self.dtypes)
+            self.upload(upload_to_wandb)
+            return
+
+        data = {
+            'observations': np.array(self.observations, dtype=self.dtypes['observations']),
+            'actions': np.array(self.actions, dtype=self.dtypes['actions']),
+            'rewards': np.array(self.rewards, dtype=self.dtypes['rewards']),
+            'dones': np.array(self.dones, dtype=self.dtypes['dones']),
+            'truncated': np.array(self.truncated, dtype=self.dtypes['truncated']),
+            'infos': np.array(self.infos, dtype=object)
+        }
+
         # use lzma to compress the file
         if self.path.endswith(".xz"):
             print(f"Writing to {self.path}, using lzma compression")
@@ -116,10 +215,17 @@ class TrajectoryWriter():
                     'metadata': metadata
                 }, f)
 
+        self.upload(upload_to_wandb)
+
+    def upload(self, upload_to_wandb: bool = False):
+
         if upload_to_wandb:
             artifact = wandb.Artifact(
-                self.path.split("/")[-1], type="trajectory")
-            artifact.add_file(self.path)
+                self.path.rstrip("/").split("/")[-1], type="trajectory")
+            if os.path.isdir(self.path):
+                artifact.add_dir(self.path)
+            else:
+                artifact.add_file(self.path)
             wandb.log_artifact(artifact)
 
         print(f"Trajectory written to {self.path}")
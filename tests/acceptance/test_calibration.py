@@ -5,7 +5,10 @@ import torch as t
 import numpy as np
 from src.environments.environments import make_env
 from src.decision_transformer.utils import load_decision_transformer
-from src.decision_transformer.calibration import calibration_statistics, plot_calibration_statistics
+from src.config import EnvironmentConfig, TransformerModelConfig
+from src.models.trajectory_model import DecisionTransformer
+from src.decision_transformer.calibration import (batched_calibration_statistics, calibration_statistics,
+                                                  plot_calibration_statistics)
 
 
 def test_calibration_end_to_end():
@@ -74,3 +77,69 @@ def test_calibration_end_to_end_one_hot_model():
     fig = plot_calibration_statistics(statistics)
 
     assert fig is not None
+
+
+def test_batched_calibration_matches_single_rtg_rollouts():
+
+    env_id = "MiniGrid-Dynamic-Obstacles-8x8-v0"
+    env_func = make_env(
+        env_id, seed=1, idx=0,
+        capture_video=False, run_name="dev",
+        fully_observed=False, flat_one_hot=False, max_steps=20)
+
+    t.manual_seed(1)
+    dt = DecisionTransformer(
+        environment_config=EnvironmentConfig(
+            env_id=env_id,
+            view_size=7,
+            fully_observed=False,
+            capture_video=False,
+            render_mode='rgb_array',
+            max_steps=20),
+        transformer_config=TransformerModelConfig(
+            d_model=32,
+            n_heads=2,
+            d_mlp=64,
+            n_layers=2,
+            state_embedding_type="grid",
+            n_ctx=5,
+            device="cpu",
+        ))
+
+    statistics = batched_calibration_statistics(
+        dt, env_func, initial_rtg_range=[0., 1., 1.], trajectories=5, num_envs=2, use_tqdm=False)
+
+    assert [s["initial_rtg"] for s in statistics] == [0., 1., 1.]
+    assert all(len(s["traj_lengths"]) == 5 for s in statistics)
+    # every initial RTG is rolled out independently from the same starting states
+    assert statistics[1] == statistics[2]
+    for initial_rtg, batched in zip([0., 1.], statistics):
+        single = batched_calibration_statistics(
+            dt, env_func, initial_rtg_range=[initial_rtg], trajectories=5, num_envs=2, use_tqdm=False)
+        assert single[0] == batched
+
+
+@pytest.mark.parametrize("batched", [True, False])
+def test_calibration_counts_every_truncation(batched):
+
+    env_id = "MiniGrid-Dynamic-Obstacles-8x8-v0"
+    env_func = make_env(
+        env_id, seed=1, idx=0,
+        capture_video=False, run_name="dev",
+        fully_observed=False, flat_one_hot=False, max_steps=1)
+
+    t.manual_seed(1)
+    dt = DecisionTransformer(
+        environment_config=EnvironmentConfig(
+            env_id=env_id, view_size=7, fully_observed=False,
+            capture_video=False, render_mode='rgb_array', max_steps=10),
+        transformer_config=TransformerModelConfig(
+            d_model=32, n_heads=2, d_mlp=64, n_layers=1, n_ctx=2, device="cpu"))
+
+    # every episode is truncated after one step (some also terminate), the
+    # batched and sequential rollouts count them the same way
+    statistics = calibration_statistics(
+        dt, env_id, env_func, initial_rtg_range=[0., 1.], trajectories=4, num_envs=2,
+        batched=batched)
+
+    assert [s["prop_truncated"] for s in statistics] == [1.0, 1.0]
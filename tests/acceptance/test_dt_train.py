@@ -1,10 +1,15 @@
+import copy
+
 import pytest
 import torch
+from torch.utils.data import DataLoader
 from src.config import TransformerModelConfig, EnvironmentConfig
 from src.models.trajectory_model import DecisionTransformer
 from src.environments.environments import make_env
-from src.decision_transformer.train import evaluate_dt_agent
-from src.decision_transformer.offline_dataset import TrajectoryDataset
+from src.decision_transformer.export import export_decision_transformer
+from src.decision_transformer.train import evaluate_dt_agent, train
+from src.decision_transformer.train import test as run_test
+from src.decision_transformer.offline_dataset import TrajectoryBatchSampler, TrajectoryDataset
 
 # need an agent.
 
@@ -94,3 +99,173 @@ def test_evaluate_dt_agent():
     assert statistics["prop_positive_reward"] == 0.0
     # traj length approx 10
     assert statistics["mean_traj_length"] == pytest.approx(10.0, 1.0)
+
+
+@pytest.mark.parametrize("n_ctx", [2, 8])
+def test_evaluate_dt_agent_kv_cache_matches_full_context(n_ctx):
+
+    trajectory_data_set = TrajectoryDataset(
+        "tests/fixtures/test_trajectories.pkl", pct_traj=1, device="cpu")
+    env_id = trajectory_data_set.metadata['args']['env_id']
+
+    torch.manual_seed(1)
+    dt = DecisionTransformer(
+        environment_config=EnvironmentConfig(
+            env_id=env_id,
+            one_hot_obs=trajectory_data_set.observation_type == "one_hot",
+            view_size=7,
+            fully_observed=False,
+            capture_video=False,
+            render_mode='rgb_array',
+            max_steps=1000),
+        transformer_config=TransformerModelConfig(
+            d_model=32,
+            n_heads=2,
+            d_mlp=64,
+            n_layers=2,
+            state_embedding_type="grid",
+            n_ctx=n_ctx,
+            device="cpu",
+        ))
+
+    statistics = []
+    for use_kv_cache in [True, False]:
+        eval_env_func = make_env(
+            env_id=env_id,
+            seed=0,
+            idx=0,
+            capture_video=False,
+            max_steps=20,
+            run_name="dt_eval_kv_cache",
+            fully_observed=False,
+            flat_one_hot=(trajectory_data_set.observation_type == "one_hot"),
+        )
+        statistics.append(evaluate_dt_agent(
+            env_id=env_id,
+            model=dt,
+            env_func=eval_env_func,
+            track=False,
+            initial_rtg=1,
+            trajectories=10,
+            use_tqdm=False,
+            device="cpu",
+            use_kv_cache=use_kv_cache))
+
+    assert statistics[0]["traj_lengths"] == statistics[1]["traj_lengths"]
+    assert statistics[0]["mean_reward"] == statistics[1]["mean_reward"]
+
+
+@pytest.mark.parametrize("n_ctx", [2, 8])
+def test_evaluate_exported_dt_agent(n_ctx):
+
+    trajectory_data_set = TrajectoryDataset(
+        "tests/fixtures/test_trajectories.pkl", pct_traj=1, device="cpu")
+    env_id = trajectory_data_set.metadata['args']['env_id']
+
+    torch.manual_seed(1)
+    dt = DecisionTransformer(
+        environment_config=EnvironmentConfig(
+            env_id=env_id,
+            one_hot_obs=trajectory_data_set.observation_type == "one_hot",
+            view_size=7,
+            fully_observed=False,
+            capture_video=False,
+            render_mode='rgb_array',
+            max_steps=1000),
+        transformer_config=TransformerModelConfig(
+            d_model=32,
+            n_heads=2,
+            d_mlp=64,
+            n_layers=2,
+            state_embedding_type="grid",
+            n_ctx=n_ctx,
+            device="cpu",
+        ))
+    exported = export_decision_transformer(dt, batch_size=4)
+
+    eval_env_func = make_env(
+        env_id=env_id,
+        seed=0,
+        idx=0,
+        capture_video=False,
+        max_steps=20,
+        run_name="dt_eval_exported",
+        fully_observed=False,
+        flat_one_hot=(trajectory_data_set.observation_type == "one_hot"),
+    )
+    statistics = evaluate_dt_agent(
+        env_id=env_id,
+        model=exported,
+        env_func=eval_env_func,
+        track=False,
+        initial_rtg=1,
+        trajectories=8,
+        use_tqdm=False,
+        device="cpu",
+        num_envs=4)
+
+    assert len(statistics["traj_lengths"]) >= 8
+    assert all(0 < length <= 20 for length in statistics["traj_lengths"])
+
+    with pytest.raises(AssertionError):
+        evaluate_dt_agent(env_id=env_id, model=exported, env_func=eval_env_func,
+                          trajectories=8, use_tqdm=False, num_envs=8)
+
+
+def test_bf16_accuracy_matches_fp32():
+
+    trajectory_data_set = TrajectoryDataset(
+        "tests/fixtures/test_trajectories.pkl", pct_traj=1, device="cpu", max_len=1)
+    env_id = trajectory_data_set.metadata['args']['env_id']
+    env = make_env(env_id, seed=1, idx=0, capture_video=False,
+                   run_name="dev", fully_observed=False, max_steps=30)()
+
+    torch.manual_seed(1)
+    dt = DecisionTransformer(
+        environment_config=EnvironmentConfig(
+            env_id=env_id,
+            one_hot_obs=trajectory_data_set.observation_type == "one_hot",
+            view_size=7,
+            fully_observed=False,
+            capture_video=False,
+            render_mode='rgb_array',
+            max_steps=1000),
+        transformer_config=TransformerModelConfig(
+            d_model=64,
+            n_heads=2,
+            d_mlp=128,
+            n_layers=1,
+            state_embedding_type="grid",
+            n_ctx=2,
+            device="cpu",
+        ))
+
+    models = {}
+    for precision in ["fp32", "bf16"]:
+        torch.manual_seed(0)
+        models[precision] = train(
+            copy.deepcopy(dt), trajectory_data_set, env, make_env, batch_size=64,
+            train_epochs=1, test_epochs=1, eval_episodes=1, eval_max_time_steps=5,
+            precision=precision)
+        # the weights stay in float32
+        assert all(p.dtype == torch.float32 for p in models[precision].parameters())
+
+    torch.manual_seed(0)
+    dataloader = DataLoader(trajectory_data_set, batch_size=None, sampler=TrajectoryBatchSampler(
+        weights=trajectory_data_set.sampling_probabilities, num_samples=512,
+        batch_size=128, indices=range(len(trajectory_data_set))))
+
+    def evaluate(model, precision):
+        torch.manual_seed(0)
+        return run_test(model, dataloader, env, epochs=1, precision=precision)
+
+    # inference: the same weights give about the same loss and accuracy
+    fp32_loss, fp32_accuracy = evaluate(models["fp32"], "fp32")
+    bf16_loss, bf16_accuracy = evaluate(models["fp32"], "bf16")
+    assert bf16_loss == pytest.approx(fp32_loss, rel=0.02)
+    assert bf16_accuracy == pytest.approx(fp32_accuracy, abs=0.05)
+
+    # training: the model trained in bf16 is about as good as the fp32 one
+    bf16_trained_loss, bf16_trained_accuracy = evaluate(models["bf16"], "fp32")
+    assert bf16_trained_loss == pytest.approx(fp32_loss, rel=0.05)
+    assert bf16_trained_accuracy == pytest.approx(fp32_accuracy, abs=0.05)
@@ -1,12 +1,26 @@
+import os
+import pickle
+import shutil
+
 import pytest
 
+import numpy as np
 import torch
-from src.decision_transformer.offline_dataset import TrajectoryDataset, TrajectoryReader
+from src.decision_transformer.offline_dataset import (AliasTable,
+                                                    TrajectoryBatchSampler,
+                                                    TrajectoryDataset,
+                                                    TrajectoryReader,
+                                                    TrajectorySequence,
+                                                    TrajectoryShard,
+                                                    get_dataloader_kwargs,
+                                                    get_shard_paths)
+from src.trajectory_store import convert_to_columnar
 from torch.utils.data import DataLoader, random_split
 from torch.utils.data.sampler import WeightedRandomSampler
 
 PATH = "tests/fixtures/test_trajectories.pkl"
 PATH_COMPRESSED = "tests/fixtures/test_trajectories.xz"
+PATH_COLUMNAR = "tmp/test_trajectories.traj"
 
 
 def get_len_i_for_i_in_list(l):
@@ -27,6 +41,43 @@ def test_trajectory_reader_xz():
     assert data is not None
 
 
+def test_trajectory_reader_columnar():
+
+    convert_to_columnar(PATH_COMPRESSED, PATH_COLUMNAR, chunk_size=100)
+    legacy_data = TrajectoryReader(PATH_COMPRESSED).read()
+    data = TrajectoryReader(PATH_COLUMNAR).read()
+
+    for field in ["observations", "actions", "rewards", "dones", "truncated"]:
+        assert isinstance(data["data"][field], np.memmap)
+        np.testing.assert_allclose(
+            data["data"][field], legacy_data["data"][field], rtol=1e-6)
+    assert data["metadata"]["args"]["env_id"] == legacy_data["metadata"]["args"]["env_id"]
+
+    # one hot observations are stored as bytes and rewards as float32
+    assert data["data"]["observations"].dtype == np.uint8
+    assert data["data"]["rewards"].dtype == np.float32
+    assert data["metadata"]["dtypes"]["observations"] == "uint8"
+
+
+def test_trajectory_dataset_init_columnar():
+
+    convert_to_columnar(PATH_COMPRESSED, PATH_COLUMNAR, chunk_size=100)
+    trajectory_data_set = TrajectoryDataset(
+        PATH_COLUMNAR, pct_traj=1.0, device="cpu")
+
+    assert trajectory_data_set.num_trajectories == 238
+    assert trajectory_data_set.num_timesteps == 1920
+    assert trajectory_data_set.observation_type == "one_hot"
+
+    # the observations stay memory mapped, trajectories are read on access
+    assert all(isinstance(shard.observations, np.memmap)
+               for shard in trajectory_data_set.observations.shards)
+    assert all(isinstance(s, torch.Tensor) for s in trajectory_data_set.states)
+
+    s, a, r, d, rtg, timesteps, mask = trajectory_data_set[0]
+    assert s.dtype == torch.float32
+
+
 def test_trajectory_dataset_init():
 
     trajectory_data_set = TrajectoryDataset(PATH, pct_traj=1.0, device="cpu")
@@ -56,6 +107,86 @@ def test_trajectory_dataset_init():
     assert trajectory_data_set.max_ep_len == trajectory_data_set.metadata["args"]["max_steps"]
 
 
+def test_trajectory_dataset_is_lazy():
+
+    trajectory_data_set = TrajectoryDataset(PATH, pct_traj=1.0, device="cpu")
+
+    # trajectories are views into flat buffers, created on access
+    assert isinstance(trajectory_data_set.states, TrajectorySequence)
+    assert isinstance(trajectory_data_set.actions, TrajectorySequence)
+    assert trajectory_data_set.traj_starts.shape == trajectory_data_set.traj_lens.shape
+
+    for i in [0, 17, -1]:
+        start = trajectory_data_set.traj_starts[i]
+        length = trajectory_data_set.traj_lens[i]
+        actions = trajectory_data_set.actions[i]
+        assert len(actions) == length
+        assert actions.data_ptr() == torch.from_numpy(
+            trajectory_data_set.flat_actions[start:]).data_ptr()
+        assert len(trajectory_data_set.states[i]) == length
+        # every proxy returns tensors, including the memory mapped states
+        assert isinstance(trajectory_data_set.states[i], torch.Tensor)
+        assert isinstance(trajectory_data_set.rewards_to_go[i], torch.Tensor)
+        assert (trajectory_data_set.timesteps[i] == torch.arange(length)).all()
+        assert trajectory_data_set.returns[i] == pytest.approx(
+            trajectory_data_set.rewards[i].sum().item(), rel=1e-5)
+
+    assert len(trajectory_data_set.states[:3]) == 3
+
+
+def make_shards(directory):
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    convert_to_columnar(PATH_COMPRESSED, os.path.join(
+        directory, "a.traj"), chunk_size=100)
+    shutil.copy(PATH_COMPRESSED, os.path.join(directory, "b.xz"))
+
+
+def test_get_shard_paths():
+
+    make_shards("tmp/shards")
+
+    assert get_shard_paths(PATH) == [PATH]
+    assert get_shard_paths("tmp/shards/a.traj") == ["tmp/shards/a.traj"]
+    assert get_shard_paths("tmp/shards") == [
+        "tmp/shards/a.traj", "tmp/shards/b.xz"]
+    assert get_shard_paths("tmp/shards/*.xz") == ["tmp/shards/b.xz"]
+    with pytest.raises(FileNotFoundError):
+        get_shard_paths("tmp/shards/*.pkl")
+
+
+def test_trajectory_dataset_sharded():
+
+    make_shards("tmp/shards")
+    single = TrajectoryDataset(PATH_COMPRESSED, max_len=10, device="cpu")
+    dataset = TrajectoryDataset("tmp/shards", max_len=10, device="cpu")
+
+    assert len(dataset.shards) == 2
+    assert dataset.num_trajectories == 2 * single.num_trajectories
+    assert dataset.num_timesteps == 2 * single.num_timesteps
+    assert (dataset.traj_shards[:single.num_trajectories] == 0).all()
+    assert (dataset.traj_shards[single.num_trajectories:] == 1).all()
+
+    # both shards hold the same trajectories
+    second = single.num_trajectories
+    np.testing.assert_array_equal(dataset.states[second], single.states[0])
+    np.testing.assert_array_equal(
+        dataset.returns[second:], dataset.returns[:second])
+
+    s, a, r, d, rtg, timesteps, mask = dataset[np.arange(len(dataset))]
+    assert s.shape == (len(dataset), 10, 7, 7, 20)
+    assert (s[mask].sum(dim=(-1, -2, -3)) > 0).all()
+
+
+def test_trajectory_dataset_sharded_incompatible():
+
+    make_shards("tmp/shards")
+    shutil.copy(PATH, "tmp/shards/c.pkl")
+
+    with pytest.raises(ValueError):
+        TrajectoryDataset("tmp/shards", device="cpu")
+
+
 def test_trajectory_dataset_init_xz():
 
     trajectory_data_set = TrajectoryDataset(
@@ -133,6 +264,17 @@ def test_trajectory_dataset__getitem__():
     assert mask.shape == (100,)
 
 
+def test_alias_table():
+
+    probabilities = np.array([0.5, 0.25, 0.125, 0.125, 0.0])
+    alias_table = AliasTable(probabilities)
+
+    samples = alias_table.sample(200000)
+    frequencies = np.bincount(samples, minlength=5) / len(samples)
+    np.testing.assert_allclose(frequencies, probabilities, atol=0.01)
+    assert frequencies[-1] == 0
+
+
 def test_trajectory_dataset_sampling_probabilities():
 
     trajectory_data_set = TrajectoryDataset(PATH, pct_traj=1.0, device="cpu")
@@ -164,6 +306,66 @@ def test_trajectory_dataset_discount_cumusum_10():
     torch.testing.assert_allclose(torch.tensor(actual), expected)
 
 
+@pytest.mark.parametrize("gamma", [1.0, 0.9])
+def test_trajectory_dataset_rewards_to_go(gamma):
+
+    dataset = TrajectoryDataset(
+        PATH_COMPRESSED, pct_traj=1.0, rtg_gamma=gamma, device="cpu")
+
+    assert len(dataset.rewards_to_go) == dataset.num_trajectories
+    for rewards, rewards_to_go in zip(dataset.rewards, dataset.rewards_to_go):
+        expected = dataset.discount_cumsum(rewards.numpy(), gamma)
+        np.testing.assert_allclose(rewards_to_go, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_trajectory_dataset_rewards_to_go_cached():
+
+    convert_to_columnar(PATH_COMPRESSED, PATH_COLUMNAR, chunk_size=100)
+    dataset = TrajectoryDataset(
+        PATH_COLUMNAR, pct_traj=1.0, rtg_gamma=0.9, device="cpu")
+    assert os.path.exists(os.path.join(
+        PATH_COLUMNAR, "cache", "reward_to_go_gamma_0.9.bin"))
+
+    cached = TrajectoryDataset(
+        PATH_COLUMNAR, pct_traj=1.0, rtg_gamma=0.9, device="cpu")
+    assert isinstance(cached.flat_rtg, np.memmap)
+    np.testing.assert_array_equal(cached.flat_rtg, dataset.flat_rtg)
+
+    # rewriting the store drops the cache
+    convert_to_columnar(PATH_COMPRESSED, PATH_COLUMNAR, chunk_size=100)
+    assert not os.path.exists(os.path.join(PATH_COLUMNAR, "cache"))
+
+
+def test_trajectory_dataset_statistics_cached(monkeypatch):
+
+    convert_to_columnar(PATH_COMPRESSED, PATH_COLUMNAR, chunk_size=100)
+    dataset = TrajectoryDataset(
+        PATH_COLUMNAR, pct_traj=1.0, normalize_state=True, device="cpu")
+    assert os.path.exists(os.path.join(PATH_COLUMNAR, "cache", "stats.npz"))
+
+    # warm starts neither split trajectories nor pass over the observations
+    def fail(*args, **kwargs):
+        raise AssertionError("statistics were recomputed")
+    monkeypatch.setattr(TrajectoryShard, "get_stats", fail)
+    monkeypatch.setattr(
+        "src.decision_transformer.offline_dataset.get_observation_moments", fail)
+    cached = TrajectoryDataset(
+        PATH_COLUMNAR, pct_traj=1.0, normalize_state=True, device="cpu")
+
+    np.testing.assert_array_equal(cached.traj_starts, dataset.traj_starts)
+    np.testing.assert_array_equal(cached.returns, dataset.returns)
+    np.testing.assert_array_equal(cached.action_counts, dataset.action_counts)
+    np.testing.assert_array_equal(cached.state_mean, dataset.state_mean)
+
+    observations = np.asarray(dataset.shards[0].observations, dtype=np.float64)
+    np.testing.assert_allclose(
+        cached.state_mean, observations.mean(axis=(0, 1)), atol=1e-9)
+    np.testing.assert_allclose(
+        cached.state_std, observations.std(axis=(0, 1)) + 1e-6, atol=1e-9)
+    np.testing.assert_array_equal(
+        cached.action_counts, np.bincount(dataset.flat_actions))
+
+
 def test_trajectory_dataset_as_dataloader():
 
     dataset = TrajectoryDataset(PATH, max_len=100, pct_traj=1.0, device="cpu")
@@ -203,6 +405,100 @@ def test_trajectory_dataset_as_dataloader():
             break
 
 
+def test_trajectory_dataset_get_sequences():
+
+    dataset = TrajectoryDataset(PATH, max_len=100, pct_traj=1.0, device="cpu")
+    s, a, r, d, rtg, timesteps, mask = dataset[[0, 1, 2]]
+
+    assert s.shape == (3, 100, 7, 7, 3)
+    assert a.shape == (3, 100)
+    assert r.shape == (3, 100, 1)
+    assert d.shape == (3, 100)
+    assert rtg.shape == (3, 101, 1)
+    assert timesteps.shape == (3, 100)
+    assert mask.shape == (3, 100)
+
+    # sequences are left padded
+    assert (mask.int().diff(dim=1) >= 0).all()
+    assert (a[~mask] == -10).all()
+    assert (s[~mask] == 0).all()
+
+    # reward-to-go decreases by the reward of each step
+    torch.testing.assert_close(
+        (rtg[:, :-1] - rtg[:, 1:])[mask], r[mask], rtol=1e-4, atol=1e-4)
+
+    # from the end of a trajectory the last reward-to-go is 0
+    s, a, r, d, rtg, timesteps, mask = dataset.get_sequences(
+        dataset.indices[:3], max_len=100, prob_go_from_end=1.0)
+    assert (rtg[:, -1] == 0).all()
+    assert (timesteps[:, -1] == torch.tensor(
+        dataset.traj_lens[dataset.indices[:3]] - 1)).all()
+
+
+def test_trajectory_batch_sampler():
+
+    dataset = TrajectoryDataset(PATH, max_len=100, pct_traj=1.0, device="cpu")
+    train_dataset, test_dataset = random_split(dataset, [0.80, 0.20])
+
+    sampler = TrajectoryBatchSampler(
+        weights=dataset.sampling_probabilities[test_dataset.indices],
+        num_samples=len(test_dataset),
+        batch_size=4,
+        indices=test_dataset.indices,
+    )
+    assert len(sampler) == (len(test_dataset) + 3) // 4
+    for batch in sampler:
+        assert set(batch).issubset(set(test_dataset.indices))
+
+    dataloader = DataLoader(dataset, batch_size=None, sampler=sampler)
+    batches = list(dataloader)
+    assert len(batches) == len(sampler)
+
+    s, a, r, d, rtg, timesteps, mask = batches[0]
+    assert s.shape == (4, 100, 7, 7, 3)
+    assert s.dtype == torch.float32
+    assert a.dtype == torch.long
+    assert rtg.shape == (4, 101, 1)
+
+
+def test_trajectory_dataset_pickles_without_memory_maps():
+
+    convert_to_columnar(PATH_COMPRESSED, PATH_COLUMNAR, chunk_size=100)
+    dataset = TrajectoryDataset(
+        PATH_COLUMNAR, max_len=10, pct_traj=1.0, normalize_state=True, device="cpu")
+
+    # only the arguments are pickled, each process opens its own memory maps
+    pickled = pickle.dumps(dataset)
+    assert len(pickled) < dataset.observations.nbytes / 10
+
+    unpickled = pickle.loads(pickled)
+    assert unpickled.num_trajectories == dataset.num_trajectories
+    assert isinstance(unpickled.observations.shards[0].observations, np.memmap)
+    np.testing.assert_array_equal(unpickled.state_mean, dataset.state_mean)
+    assert unpickled[0][0].shape == (10, 7, 7, 20)
+
+
+def test_trajectory_dataset_worker_dataloader():
+
+    convert_to_columnar(PATH_COMPRESSED, PATH_COLUMNAR, chunk_size=100)
+    dataset = TrajectoryDataset(
+        PATH_COLUMNAR, max_len=10, pct_traj=1.0, device="cpu")
+    sampler = TrajectoryBatchSampler(
+        weights=dataset.sampling_probabilities,
+        num_samples=64,
+        batch_size=8,
+    )
+    dataloader = DataLoader(
+        dataset, batch_size=None, sampler=sampler,
+        **get_dataloader_kwargs(num_workers=2, prefetch_factor=2))
+
+    batches = list(dataloader)
+    assert len(batches) == 8
+    for s, a, r, d, rtg, timesteps, mask in batches:
+        assert s.shape == (8, 10, 7, 7, 20)
+        assert rtg.shape == (8, 11, 1)
+
+
 def test_train_test_split():
 
     dataset = TrajectoryDataset(PATH, max_len=100, pct_traj=1.0, device="cpu")
@@ -1,13 +1,17 @@
+import os
 from dataclasses import dataclass
 
 import gymnasium as gym
 import pytest
 from gymnasium.spaces import Discrete
 
-from src.environments.environments import make_env
+from src.config import EnvironmentConfig, OnlineTrainConfig
+from src.environments.environments import make_env, make_env_fns, make_vector_env
+from src.ppo.actor_learner import get_worker_trajectory_path, train_ppo_actor_learner
 from src.ppo.agent import FCAgent, TrajPPOAgent
 from src.ppo.memory import Memory, Minibatch, TrajectoryMinibatch
 from src.ppo.train import train_ppo
+from src.utils import TrajectoryWriter
 
 
 @pytest.fixture
@@ -278,3 +282,34 @@ def test_ppo_traj_agent_rollout_and_learn_minibatches(
 
     agent.rollout(memory, online_config.num_steps, envs, None)
     agent.learn(memory, online_config, optimizer, scheduler, track=False)
+
+
+@pytest.mark.parametrize("off_policy_correction", ["none", "ratio", "vtrace"])
+def test_ppo_actor_learner(run_config, off_policy_correction, tmp_path):
+
+    run_config.run_name = "test_actor_learner"
+    environment_config = EnvironmentConfig(
+        env_id="MiniGrid-Dynamic-Obstacles-8x8-v0", max_steps=30)
+    # no update epochs: this tests collecting, correcting and broadcasting
+    # rollouts, agent.learn is tested with the agents
+    online_config = OnlineTrainConfig(
+        num_envs=4, num_steps=16, total_timesteps=4 * 16 * 3, update_epochs=0,
+        num_workers=2, off_policy_correction=off_policy_correction,
+        trajectory_path=str(tmp_path / "test_ppo_actor_learner.gz"))
+    trajectory_writer = TrajectoryWriter(
+        online_config.trajectory_path, run_config, environment_config, online_config)
+    envs = make_vector_env(make_env_fns(environment_config, "test", [4]))
+
+    agent = train_ppo_actor_learner(
+        run_config=run_config,
+        online_config=online_config,
+        environment_config=environment_config,
+        transformer_model_config=None,
+        envs=envs,
+        trajectory_writer=trajectory_writer)
+
+    assert isinstance(agent, FCAgent)
+    # every worker writes the trajectories of its envs
+    for worker_idx in range(2):
+        path = get_worker_trajectory_path(online_config.trajectory_path, worker_idx)
+        assert os.path.exists(path)
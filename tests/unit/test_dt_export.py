@@ -0,0 +1,73 @@
+import pytest
+import torch
+from src.config import EnvironmentConfig, TransformerModelConfig
+from src.decision_transformer.export import (ExportedDecisionTransformer,
+                                             check_exported_model,
+                                             export_decision_transformer,
+                                             get_example_inputs,
+                                             load_exported_decision_transformer)
+from src.models.trajectory_model import DecisionTransformer
+
+
+@pytest.fixture
+def decision_transformer():
+    torch.manual_seed(0)
+    return DecisionTransformer(
+        transformer_config=TransformerModelConfig(n_ctx=8, d_model=32, n_heads=2, d_mlp=64),
+        environment_config=EnvironmentConfig(max_steps=100)
+    )
+
+
+@pytest.mark.parametrize("context_length", [1, 2, 3])
+def test_export_decision_transformer(decision_transformer, context_length):
+
+    exported = export_decision_transformer(
+        decision_transformer, batch_size=4, context_length=context_length)
+
+    assert isinstance(exported, ExportedDecisionTransformer)
+    assert exported.transformer_config is decision_transformer.transformer_config
+
+    states, actions, rtgs, timesteps = get_example_inputs(
+        decision_transformer, 4, context_length, seed=2)
+    if context_length == 1:
+        actions = None
+    state_preds, action_preds, reward_preds = exported(states, actions, rtgs, timesteps)
+    assert state_preds is None and reward_preds is None
+    with torch.no_grad():
+        _, expected, _ = decision_transformer(states, actions, rtgs, timesteps)
+    torch.testing.assert_close(action_preds, expected, atol=1e-5, rtol=1e-4)
+
+    with pytest.raises(ValueError):
+        exported(*get_example_inputs(decision_transformer, 2, context_length))
+
+
+def test_export_decision_transformer_strips_hooks(decision_transformer):
+
+    decision_transformer.transformer.blocks[0].hook_resid_pre.add_hook(
+        lambda x, hook: torch.zeros_like(x))
+    exported = export_decision_transformer(decision_transformer, batch_size=2, check=False)
+
+    # the hook is still there in the eager model
+    assert len(decision_transformer.transformer.blocks[0].hook_resid_pre.fwd_hooks) == 1
+    with pytest.raises(ValueError):
+        check_exported_model(exported, decision_transformer)
+
+    decision_transformer.transformer.reset_hooks()
+    check_exported_model(exported, decision_transformer)
+
+
+def test_save_and_load_exported_decision_transformer(decision_transformer, tmp_path):
+
+    exported = export_decision_transformer(decision_transformer, batch_size=2, context_length=2)
+    path = str(tmp_path / "exported_decision_transformer.ts")
+    exported.save(path)
+
+    loaded = load_exported_decision_transformer(path, decision_transformer)
+    assert loaded.batch_size == 2
+    assert loaded.context_length == 2
+
+    # the load time check compares the outputs with the eager model
+    with torch.no_grad():
+        decision_transformer.action_predictor.weight.add_(1)
+    with pytest.raises(ValueError):
+        load_exported_decision_transformer(path, decision_transformer)
@@ -1,6 +1,6 @@
 import pytest
 
-from src.environments.environments import make_env
+from src.environments.environments import make_env, make_vector_env
 import numpy as np
 
 
@@ -159,3 +159,34 @@ def test_make_env_flat_one_hot_view_size_change():
     assert obs["image"].shape == (5, 5, 20,)
     assert obs["image"].max() == 1
     assert env_func is not None
+
+
+@pytest.mark.parametrize("vector_env", ["sync", "async", "async_shared_memory"])
+def test_make_vector_env(vector_env):
+    env_fns = [make_env(
+        env_id="MiniGrid-Dynamic-Obstacles-8x8-v0",
+        seed=i,
+        idx=i,
+        capture_video=False,
+        run_name="test",
+        max_steps=10) for i in range(3)]
+
+    sync_envs = make_vector_env(env_fns, vector_env="sync")
+    envs = make_vector_env(env_fns, vector_env=vector_env)
+
+    assert envs.get_attr("run_name") == ("test", "test", "test")
+    assert envs.single_observation_space["image"].shape == (7, 7, 3)
+
+    # every backend steps the same environments
+    obs, _ = envs.reset(seed=0)
+    sync_obs, _ = sync_envs.reset(seed=0)
+    for _ in range(12):
+        actions = np.array([0, 1, 2])
+        obs, reward, terminated, truncated, _ = envs.step(actions)
+        sync_obs, sync_reward, sync_terminated, sync_truncated, _ = sync_envs.step(actions)
+        np.testing.assert_array_equal(obs["image"], sync_obs["image"])
+        np.testing.assert_array_equal(reward, sync_reward)
+        np.testing.assert_array_equal(truncated, sync_truncated)
+
+    envs.close()
+    sync_envs.close()
@@ -0,0 +1,52 @@
+import queue
+from types import SimpleNamespace
+
+from src.ppo.actor_learner import Rollout, RolloutWorkerPool
+
+
+def make_pool(num_workers, version):
+    # the batching of a pool, without starting worker processes
+    pool = RolloutWorkerPool.__new__(RolloutWorkerPool)
+    pool.policy = SimpleNamespace(version=SimpleNamespace(value=version))
+    pool.rollouts = queue.Queue()
+    pool.free_slots = [queue.Queue() for _ in range(num_workers)]
+    pool.workers = [SimpleNamespace(is_alive=lambda: True) for _ in range(num_workers)]
+    pool.held = []
+    return pool
+
+
+def make_rollout(worker_idx, slot, version):
+    return Rollout(worker_idx, slot, version, [], [], [], 0)
+
+
+def test_get_batch_takes_one_rollout_per_worker():
+
+    pool = make_pool(num_workers=2, version=1)
+    # worker 0 is fast, worker 1 slow
+    for rollout in [make_rollout(0, 0, 0), make_rollout(0, 1, 1), make_rollout(1, 0, 1)]:
+        pool.rollouts.put(rollout)
+
+    batch = pool.get_batch(max_policy_lag=1)
+    assert [(rollout.worker_idx, rollout.version) for rollout in batch] == [(0, 0), (1, 1)]
+    # the extra rollout of worker 0 keeps its slot for the next batch
+    assert [(rollout.worker_idx, rollout.slot) for rollout in pool.held] == [(0, 1)]
+    assert pool.free_slots[0].empty()
+
+    pool.rollouts.put(make_rollout(1, 1, 1))
+    batch = pool.get_batch(max_policy_lag=1)
+    assert [(rollout.worker_idx, rollout.slot) for rollout in batch] == [(0, 1), (1, 1)]
+    assert pool.held == []
+
+
+def test_get_batch_drops_stale_rollouts():
+
+    pool = make_pool(num_workers=2, version=3)
+    pool.held = [make_rollout(0, 0, 1)]
+    for rollout in [make_rollout(1, 0, 2), make_rollout(0, 1, 3), make_rollout(1, 1, 3)]:
+        pool.rollouts.put(rollout)
+
+    batch = pool.get_batch(max_policy_lag=1)
+    assert [(rollout.worker_idx, rollout.version) for rollout in batch] == [(0, 3), (1, 2)]
+    # the held rollout of worker 0 was too old, its slot is free again
+    assert pool.free_slots[0].get_nowait() == 0
+    assert pool.held == [] and pool.rollouts.qsize() == 1
@@ -5,6 +5,7 @@ import torch.nn as nn
 import torch.optim as optim
 from dataclasses import dataclass
 
+from src.environments.environments import make_vector_env
 from src.ppo.agent import PPOScheduler, PPOAgent, FCAgent, TrajPPOAgent
 from src.models.trajectory_model import TrajectoryTransformer
 from src.ppo.memory import Memory
@@ -265,6 +266,33 @@ def test_traj_agent_rollout(transformer_model_config, environment_config):
     assert len(memory.experiences[0]) == 6
 
 
+def test_traj_agent_rollout_stores_each_step_value(transformer_model_config, environment_config):
+
+    num_steps = 10
+    envs = gym.vector.SyncVectorEnv(
+        [lambda: gym.make(environment_config.env_id) for _ in range(4)])
+    environment_config.action_space = envs.single_action_space
+    environment_config.observation_space = envs.single_observation_space
+
+    agent = TrajPPOAgent(
+        envs=envs,
+        environment_config=environment_config,
+        transformer_model_config=transformer_model_config,
+        device="cpu"
+    )
+    memory = Memory(envs=envs, args=online_config, device="cpu")
+    agent.rollout(memory, num_steps, envs)
+
+    # with n_ctx = 1 the context is the current obs, so v(s_t) is the
+    # critic's value of obs t, at every step rather than only the first
+    obs, _, _, _, values, _ = memory.get_buffers()
+    expected = agent.get_values(
+        obs.flatten(0, 1).unsqueeze(1), None,
+        torch.zeros((num_steps * envs.num_envs, 1, 1), dtype=torch.long))
+    torch.testing.assert_close(values.flatten(), expected[:, -1].flatten())
+    assert not (values == values[0]).all()
+
+
 def test_traj_agent_learn(transformer_model_config, environment_config, online_config):
 
     num_steps = 10
@@ -382,3 +410,124 @@ def test_traj_agent_larger_context_learn(big_transformer_model_config, environme
     assert len(memory.next_value) == envs.num_envs
     assert len(memory.experiences) == num_steps
     assert len(memory.experiences[0]) == 6
+
+
+@pytest.mark.parametrize("use_trajectory_model", [False, True])
+def test_pipelined_rollout(use_trajectory_model, big_transformer_model_config,
+                           environment_config, online_config):
+
+    num_steps = 6
+
+    def rollout(vector_env, pipelined):
+        envs = make_vector_env(
+            [lambda: gym.make(environment_config.env_id) for _ in range(4)],
+            vector_env=vector_env, pipelined=pipelined)
+        envs.reset(seed=1)
+        environment_config.action_space = envs.single_action_space
+        environment_config.observation_space = envs.single_observation_space
+        torch.manual_seed(1)
+        if use_trajectory_model:
+            agent = TrajPPOAgent(envs, environment_config, big_transformer_model_config)
+        else:
+            agent = FCAgent(envs, hidden_dim=32)
+        memory = Memory(envs=envs, args=online_config, device="cpu")
+        agent.rollout(memory, num_steps, envs)
+        envs.close()
+        return memory
+
+    sequential = rollout("sync", False)
+    pipelined = rollout("sync", True)
+    async_pipelined = rollout("async", True)
+
+    assert len(pipelined) == num_steps
+    assert pipelined.next_value.shape == sequential.next_value.shape
+    # the halves start where the whole vector env does
+    assert torch.equal(pipelined.get_buffers()[0][0], sequential.get_buffers()[0][0])
+    # stepping the halves in subprocesses does not change the rollout
+    for buffer, async_buffer, sequential_buffer in zip(
+            pipelined.get_buffers(), async_pipelined.get_buffers(), sequential.get_buffers()):
+        assert buffer.shape == sequential_buffer.shape
+        assert torch.equal(buffer, async_buffer)
+    assert torch.equal(pipelined.next_obs, async_pipelined.next_obs)
+
+
+def test_traj_agent_shared_trunk_rollout(big_transformer_model_config, environment_config, online_config):
+
+    num_steps = 10
+    envs = gym.vector.SyncVectorEnv(
+        [lambda: gym.make(environment_config.env_id) for _ in range(4)])
+    environment_config.action_space = envs.single_action_space
+    environment_config.observation_space = envs.single_observation_space
+    big_transformer_model_config.shared_trunk = True
+    big_transformer_model_config.value_trunk_weight = 0.5
+
+    agent = TrajPPOAgent(
+        envs=envs,
+        environment_config=environment_config,
+        transformer_model_config=big_transformer_model_config,
+        device="cpu"
+    )
+    big_transformer_model_config.shared_trunk = False
+    two_network_agent = TrajPPOAgent(
+        envs=envs,
+        environment_config=environment_config,
+        transformer_model_config=big_transformer_model_config,
+        device="cpu"
+    )
+
+    # one transformer, with an extra value head
+    assert agent.actor is None and agent.critic is None
+    n_parameters = sum(p.numel() for p in agent.parameters())
+    n_actor_parameters = sum(p.numel() for p in two_network_agent.actor.parameters())
+    assert n_parameters == n_actor_parameters + big_transformer_model_config.d_model + 1
+
+    memory = Memory(envs=envs, args=online_config, device="cpu")
+    agent.rollout(memory, num_steps, envs)
+
+    assert len(memory) == num_steps
+    assert len(memory.next_value) == envs.num_envs
+    values = memory.get_buffers()[4]
+    # the values are those of each step, not of the first one
+    assert not (values == values[0]).all()
+
+
+@pytest.mark.parametrize("use_trajectory_model", [False, True])
+def test_bf16_rollout(use_trajectory_model, big_transformer_model_config,
+                      environment_config, online_config):
+
+    num_steps = 6
+    envs = gym.vector.SyncVectorEnv(
+        [lambda: gym.make(environment_config.env_id) for _ in range(4)])
+    environment_config.action_space = envs.single_action_space
+    environment_config.observation_space = envs.single_observation_space
+
+    def get_logits_and_values(agent, obs):
+        if use_trajectory_model:
+            return agent.get_logits_and_values(obs.unsqueeze(1), None, torch.zeros(
+                (obs.shape[0], 1, 1), dtype=torch.long))
+        return agent.get_logits_and_values(obs)
+
+    torch.manual_seed(1)
+    if use_trajectory_model:
+        agent = TrajPPOAgent(envs, environment_config, big_transformer_model_config,
+                             precision="bf16")
+    else:
+        agent = FCAgent(envs, hidden_dim=32, precision="bf16")
+    memory = Memory(envs=envs, args=online_config, device="cpu")
+    agent.rollout(memory, num_steps, envs)
+
+    # the buffers and the advantages are not bfloat16
+    assert len(memory) == num_steps
+    assert all(buffer.dtype != torch.bfloat16 for buffer in memory.get_buffers())
+    assert memory.next_value.dtype == torch.float32
+    assert memory.get_advantages(online_config.gae_lambda).dtype != torch.bfloat16
+
+    # and the outputs are close to those of float32
+    obs = memory.get_buffers()[0][0]
+    with torch.inference_mode():
+        logits, values = get_logits_and_values(agent, obs)
+        agent.precision = "fp32"
+        fp32_logits, fp32_values = get_logits_and_values(agent, obs)
+    assert logits.dtype == values.dtype == torch.float32
+    torch.testing.assert_close(logits, fp32_logits, atol=0.02, rtol=0.02)
+    torch.testing.assert_close(values, fp32_values, atol=0.02, rtol=0.02)
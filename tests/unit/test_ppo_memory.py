@@ -1,9 +1,13 @@
 import pytest
 import gymnasium as gym
 import minigrid
+import numpy as np
 import torch
+from einops import rearrange
+from src.ppo.compute_adv_vectorized import compute_vtrace
 from src.ppo.utils import PPOArgs
 from src.ppo.memory import Memory, Minibatch
+from src.utils import pad_tensor
 
 
 @pytest.fixture
@@ -101,7 +105,8 @@ def test_memory_add_end_of_episode(memory):
         0: {'episode_length': 1, 'episode_return': 1.0}}
 
 
-def test_memory_compute_advantages(memory):
+@pytest.mark.parametrize("method", ["auto", "loop", "vectorized", "scan"])
+def test_memory_compute_advantages(memory, method):
 
     info = {"final_info": [{"episode": {"l": 1, "r": 1.0}}]}
     obs = torch.tensor([1.0, 2.0, 3.0])
@@ -121,9 +126,173 @@ def test_memory_compute_advantages(memory):
         dones=torch.tensor([1, 0, 0]).repeat(2, 1),
         device=torch.device("cpu"),
         gamma=0.99,
-        gae_lambda=0.95)
+        gae_lambda=0.95,
+        method=method)
 
     torch.testing.assert_allclose(
         advantages,
         torch.tensor([[0.0, 1.98, 5.7633], [0.99, 0.00, 2.97]])
     )
+
+
+@pytest.mark.parametrize("T", [1, 5, 16, 37])
+def test_advantage_methods_match_loop(memory, T):
+
+    generator = torch.Generator().manual_seed(T)
+    inputs = dict(
+        next_value=torch.rand(4, generator=generator),
+        next_done=(torch.rand(4, generator=generator) < 0.2).float(),
+        rewards=torch.rand((T, 4), generator=generator),
+        values=torch.rand((T, 4), generator=generator),
+        dones=(torch.rand((T, 4), generator=generator) < 0.2).float(),
+        device=torch.device("cpu"),
+        gamma=0.99,
+        gae_lambda=0.95)
+
+    expected = memory.compute_advantages(**inputs, method="loop")
+    for method in ["vectorized", "scan"]:
+        torch.testing.assert_close(
+            memory.compute_advantages(**inputs, method=method), expected)
+
+
+def test_vtrace_on_policy_matches_gae(memory):
+
+    generator = torch.Generator().manual_seed(0)
+    inputs = dict(
+        next_value=torch.rand(4, generator=generator),
+        next_done=(torch.rand(4, generator=generator) < 0.2).float(),
+        rewards=torch.rand((16, 4), generator=generator),
+        values=torch.rand((16, 4), generator=generator),
+        dones=(torch.rand((16, 4), generator=generator) < 0.2).float())
+
+    vs, advantages = compute_vtrace(**inputs, log_rhos=torch.zeros((16, 4)), gamma=0.99)
+    expected = memory.compute_advantages(
+        **inputs, device=torch.device("cpu"), gamma=0.99, gae_lambda=1.0, method="loop")
+    torch.testing.assert_close(advantages, expected)
+    torch.testing.assert_close(vs, expected + inputs["values"])
+
+
+def get_trajectory_minibatches_per_window(memory, timesteps, prob_go_from_end):
+    '''
+    The previous implementation of get_trajectory_minibatches, which split
+    the rollout into trajectories and computed the advantages of every
+    sampled window separately.
+    '''
+    obs, dones, actions, logprobs, values, rewards = [
+        torch.stack(arr) for arr in zip(*memory.experiences)]
+    next_values = torch.cat([values[1:], memory.next_value.unsqueeze(0)])
+    next_dones = torch.cat([dones[1:], memory.next_done.unsqueeze(0)])
+    dones[-1] = torch.ones(dones.shape[-1])
+
+    def split(arr):
+        arr = rearrange(arr, "T E ... -> (E T) ...")
+        return [traj for traj in torch.tensor_split(arr, traj_end_idxs) if len(traj) > 0]
+
+    traj_end_idxs = torch.where(rearrange(dones, "T E -> (E T)"))[0].tolist()
+    traj_obs, traj_actions, traj_logprobs, traj_values, traj_rewards, traj_dones, \
+        traj_next_values, traj_next_dones = [split(arr) for arr in [
+            obs, actions, logprobs, values, rewards, dones, next_values, next_dones]]
+
+    traj_idxs, end_idxs = memory.sample_trajectory_windows(
+        np.array([len(traj) for traj in traj_obs]),
+        memory.args.num_minibatches * memory.args.minibatch_size,
+        timesteps,
+        prob_go_from_end)
+
+    windows = []
+    for traj_idx, end_idx in zip(traj_idxs, end_idxs):
+        start_idx = max(0, end_idx - timesteps)
+        window_values = traj_values[traj_idx][start_idx:end_idx]
+        advantages = memory.compute_advantages(
+            traj_next_values[traj_idx][end_idx - 1],
+            traj_next_dones[traj_idx][end_idx - 1],
+            traj_rewards[traj_idx][start_idx:end_idx],
+            window_values,
+            traj_dones[traj_idx][start_idx:end_idx],
+            memory.device,
+            memory.args.gamma,
+            memory.args.gae_lambda,
+            method="loop")
+        windows.append(dict(
+            obs=pad_tensor(traj_obs[traj_idx][start_idx:end_idx], timesteps,
+                           ignore_first_dim=False, pad_left=True),
+            actions=pad_tensor(traj_actions[traj_idx][start_idx:end_idx], timesteps,
+                               ignore_first_dim=False, pad_left=True),
+            timesteps=pad_tensor(torch.arange(start_idx, end_idx), timesteps,
+                                 ignore_first_dim=False, pad_left=True),
+            logprobs=traj_logprobs[traj_idx][end_idx - 1],
+            advantages=advantages[-1],
+            values=window_values[-1],
+            returns=advantages[-1] + window_values[-1],
+            rewards=traj_rewards[traj_idx][end_idx - 1],
+        ))
+    return windows
+
+
+@pytest.mark.parametrize("timesteps", [1, 3, 6])
+@pytest.mark.parametrize("prob_go_from_end", [None, 0.5])
+def test_trajectory_minibatches_match_per_window_advantages(timesteps, prob_go_from_end):
+
+    args = PPOArgs(num_envs=3, num_steps=16, num_minibatches=4)
+    envs = gym.vector.SyncVectorEnv(
+        [lambda: gym.make('MiniGrid-Dynamic-Obstacles-5x5-v0') for _ in range(args.num_envs)])
+    memory = Memory(envs, args, torch.device("cpu"))
+
+    generator = torch.Generator().manual_seed(timesteps)
+    for step in range(args.num_steps):
+        memory.add(
+            {},
+            torch.rand((args.num_envs, 5, 5, 3), generator=generator),
+            (torch.rand(args.num_envs, generator=generator) < 0.2).float(),
+            torch.randint(0, 3, (args.num_envs,), generator=generator),
+            torch.rand(args.num_envs, generator=generator),
+            torch.rand(args.num_envs, generator=generator),
+            torch.rand(args.num_envs, generator=generator))
+    memory.next_value = torch.rand(args.num_envs, generator=generator)
+    memory.next_done = torch.tensor([0.0, 1.0, 0.0])
+
+    np.random.seed(0)
+    minibatches = memory.get_trajectory_minibatches(timesteps, prob_go_from_end)
+    np.random.seed(0)
+    windows = get_trajectory_minibatches_per_window(memory, timesteps, prob_go_from_end)
+
+    assert len(minibatches) == args.num_minibatches
+    for i, minibatch in enumerate(minibatches):
+        for field, value in vars(minibatch).items():
+            expected = torch.stack([
+                window[field] for window in
+                windows[i * args.minibatch_size:(i + 1) * args.minibatch_size]])
+            torch.testing.assert_close(value, expected, check_dtype=False)
+
+
+def test_memory_buffers_are_reused_and_advantages_cached(monkeypatch):
+
+    args = PPOArgs(num_envs=2, num_steps=4, num_minibatches=2)
+    envs = gym.vector.SyncVectorEnv(
+        [lambda: gym.make('MiniGrid-Dynamic-Obstacles-5x5-v0') for _ in range(args.num_envs)])
+    memory = Memory(envs, args, torch.device("cpu"))
+
+    calls = []
+    compute_advantages = memory.compute_advantages
+    monkeypatch.setattr(memory, "compute_advantages",
+                        lambda *args, **kwargs: calls.append(1) or compute_advantages(*args, **kwargs))
+
+    for rollout in range(2):
+        for step in range(args.num_steps):
+            memory.add({}, torch.full((2, 3), float(step)), torch.zeros(2),
+                       torch.ones(2, dtype=torch.long), torch.zeros(2), torch.zeros(2), torch.ones(2))
+        memory.next_value = torch.zeros(2)
+        memory.next_done = torch.zeros(2)
+
+        if rollout == 0:
+            pointers = [buffer.data_ptr() for buffer in memory.buffers]
+        assert [buffer.data_ptr() for buffer in memory.buffers] == pointers
+        assert memory.buffers[0].shape == (args.num_steps, 2, 3)
+        assert len(memory) == len(memory.experiences) == args.num_steps
+
+        for epoch in range(3):
+            minibatches = memory.get_minibatches()
+        assert len(calls) == rollout + 1
+        assert sorted(torch.cat([mb.obs[:, 0] for mb in minibatches]).tolist()) == \
+            [0.0, 0.0, 1.0, 1.0, 2.0, 2.0, 3.0, 3.0]
+        memory.reset()
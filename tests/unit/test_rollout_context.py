@@ -0,0 +1,91 @@
+import numpy as np
+import torch as t
+
+from src.rollout_context import RolloutContext
+
+
+def test_rollout_context_grows_then_slides():
+
+    context = RolloutContext(num_envs=2, max_len=3, obs_shape=(4,))
+    context.start(t.zeros((2, 4)), rtg=t.ones((2, 1)))
+
+    obs, actions, rtg, timesteps = context.get()
+    assert obs.shape == (2, 1, 4)
+    assert actions is None
+
+    for i in range(1, 5):
+        context.append(t.full((2, 4), float(i)), action=t.full((2,), i - 1))
+
+    obs, actions, rtg, timesteps = context.get()
+    assert obs.shape == (2, 3, 4)
+    assert obs[:, :, 0].tolist() == [[2, 3, 4]] * 2
+    # actions are those taken at every timestep but the newest
+    assert actions[:, :, 0].tolist() == [[2, 3]] * 2
+    assert timesteps[:, :, 0].tolist() == [[2, 3, 4]] * 2
+    assert rtg[:, :, 0].tolist() == [[0, 0, 0]] * 2
+
+    obs, actions, rtg, timesteps = context.get(2)
+    assert obs[:, :, 0].tolist() == [[3, 4]] * 2
+    assert actions[:, :, 0].tolist() == [[3]] * 2
+    assert context.get_previous_actions(2)[:, :, 0].tolist() == [[2, 3]] * 2
+
+
+def test_rollout_context_padded_reset():
+
+    context = RolloutContext(
+        num_envs=3, max_len=3, obs_shape=(2,), action_pad_token=7)
+    context.start(t.ones((3, 2)), padded=True)
+
+    obs, actions, _, timesteps = context.get()
+    assert obs[:, :, 0].tolist() == [[0, 0, 1]] * 3
+    assert actions[:, :, 0].tolist() == [[7, 7]] * 3
+
+    context.append(t.full((3, 2), 2.0), action=t.tensor([0, 1, 2]))
+    context.reset(np.array([False, True, False]), t.full((3, 2), 2.0))
+
+    obs, actions, _, timesteps = context.get()
+    assert obs[:, :, 0].tolist() == [[0, 1, 2], [0, 0, 2], [0, 1, 2]]
+    assert actions[:, :, 0].tolist() == [[7, 0], [7, 7], [7, 2]]
+    assert timesteps[:, :, 0].tolist() == [[0, 0, 1], [0, 0, 0], [0, 0, 1]]
+
+
+def test_rollout_context_updates_in_place():
+
+    context = RolloutContext(num_envs=2, max_len=4, obs_shape=(3, 3))
+    context.start(t.zeros((2, 3, 3)), padded=True)
+    pointers = [buffer.data_ptr() for buffer in (
+        context.obs, context.actions, context.rtg, context.timesteps)]
+
+    for i in range(10):
+        new_obs = t.rand((2, 3, 3))
+        context.append(new_obs, action=t.zeros(2, dtype=t.long))
+        context.reset(np.array([i % 3 == 0, False]), new_obs)
+
+        obs, _, _, _ = context.get()
+        # windows are views of the preallocated buffers
+        assert obs.data_ptr() >= pointers[0]
+
+    assert pointers == [buffer.data_ptr() for buffer in (
+        context.obs, context.actions, context.rtg, context.timesteps)]
+
+
+def test_rollout_context_reset_only_touches_masked_envs():
+
+    context = RolloutContext(num_envs=4, max_len=3, obs_shape=(2,), action_pad_token=5)
+    context.start(t.ones((4, 2)), padded=True)
+    for i in range(2, 5):
+        context.append(t.full((4, 2), float(i)), action=t.arange(4))
+    before = [buffer.clone() for buffer in (
+        context.obs, context.actions, context.rtg, context.timesteps)]
+
+    # no episode ended
+    context.reset(np.zeros(4, dtype=bool), t.full((4, 2), 9.0))
+    assert all(t.equal(buffer, previous) for buffer, previous in zip(
+        (context.obs, context.actions, context.rtg, context.timesteps), before))
+
+    # tensor masks work too
+    context.reset(t.tensor([False, False, True, False]), t.full((4, 2), 4.0))
+    obs, actions, _, timesteps = context.get()
+    assert obs[:, :, 0].tolist() == [[2, 3, 4], [2, 3, 4], [0, 0, 4], [2, 3, 4]]
+    assert actions[:, :, 0].tolist() == [[0, 0], [1, 1], [5, 5], [3, 3]]
+    assert timesteps[:, :, 0].tolist() == [[1, 2, 3], [1, 2, 3], [0, 0, 0], [1, 2, 3]]
@@ -2,11 +2,14 @@ import numpy as np
 import pytest
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from gymnasium.spaces import Box, Dict
 from src.config import EnvironmentConfig, TransformerModelConfig
 from src.models.trajectory_model import TrajectoryTransformer, DecisionTransformer
 from src.models.trajectory_model import CloneTransformer, ActorTransformer, CriticTransfomer
+from src.models.trajectory_model import ActorCriticTransformer
 from src.models.trajectory_model import StateEncoder
+from src.precision import autocast
 from transformer_lens import HookedTransformer
 
 
@@ -263,6 +266,253 @@ def test_decision_transformer_get_logits(decision_transformer):
     assert reward_preds.shape == (batch_size, seq_length, 1)
 
 
+@pytest.mark.parametrize("n_ctx", [2, 5, 11])
+def test_decision_transformer_predict_next_action_matches_forward(n_ctx):
+
+    torch.manual_seed(0)
+    decision_transformer = DecisionTransformer(
+        transformer_config=TransformerModelConfig(n_ctx=n_ctx, n_layers=2),
+        environment_config=EnvironmentConfig()
+    ).eval()
+    max_len = 1 + n_ctx // 3
+
+    states = torch.rand((3, 12, 7, 7, 3))
+    rtgs = torch.rand((3, 12, 1))
+    timesteps = torch.randint(0, 50, (3, 12, 1))
+    actions = torch.randint(0, 3, (3, 12, 1))
+
+    decision_transformer.start_episode(batch_size=3)
+    with torch.no_grad():
+        for i in range(12):
+            action_preds = decision_transformer.predict_next_action(
+                states[:, i:i + 1], rtgs[:, i:i + 1], timesteps[:, i:i + 1],
+                actions=actions[:, i - 1:i] if i > 0 else None)
+
+            # the full forward pass over the last max_len timesteps
+            start = max(0, i + 1 - max_len)
+            _, expected, _ = decision_transformer(
+                states[:, start:i + 1],
+                actions[:, start:i] if i > start else None,
+                rtgs[:, start:i + 1],
+                timesteps[:, start:i + 1])
+
+            assert action_preds.shape == (3, 3)
+            torch.testing.assert_close(action_preds, expected[:, -1], atol=1e-5, rtol=1e-5)
+
+
+def test_decision_transformer_window_stride():
+
+    decision_transformer = DecisionTransformer(
+        transformer_config=TransformerModelConfig(n_ctx=11),
+        environment_config=EnvironmentConfig()
+    ).eval()
+
+    cache = decision_transformer.start_episode(batch_size=2, window_stride=2)
+    lengths = []
+    with torch.no_grad():
+        for i in range(8):
+            decision_transformer.predict_next_action(
+                torch.rand((2, 1, 7, 7, 3)), torch.rand((2, 1, 1)),
+                torch.full((2, 1, 1), i),
+                actions=torch.zeros((2, 1, 1), dtype=torch.long) if i > 0 else None)
+            lengths.append(cache.length)
+            assert cache.kv_cache[0].past_keys.shape[1] == cache.length
+
+    # the window fills up to n_ctx, then drops two timesteps at once
+    assert lengths == [2, 5, 8, 11, 8, 11, 8, 11]
+
+
+@pytest.mark.parametrize("n_ctx, window_stride", [(5, 1), (5, 3), (8, 2), (11, 4)])
+def test_decision_transformer_window_starts_at_timestep(n_ctx, window_stride):
+
+    torch.manual_seed(0)
+    decision_transformer = DecisionTransformer(
+        transformer_config=TransformerModelConfig(n_ctx=n_ctx),
+        environment_config=EnvironmentConfig()
+    ).eval()
+
+    states = torch.rand((2, 12, 7, 7, 3))
+    rtgs = torch.rand((2, 12, 1))
+    timesteps = torch.randint(0, 50, (2, 12, 1))
+    actions = torch.randint(0, 3, (2, 12, 1))
+
+    cache = decision_transformer.start_episode(batch_size=2, window_stride=window_stride)
+    with torch.no_grad():
+        for i in range(12):
+            action_preds = decision_transformer.predict_next_action(
+                states[:, i:i + 1], rtgs[:, i:i + 1], timesteps[:, i:i + 1],
+                actions=actions[:, i - 1:i] if i > 0 else None)
+
+            # the window holds whole timesteps, so it matches a full forward
+            # pass over the timesteps it holds, even once it has slid
+            assert cache.length % 3 == 2
+            start = i + 1 - (cache.length + 1) // 3
+            _, expected, _ = decision_transformer(
+                states[:, start:i + 1],
+                actions[:, start:i] if i > start else None,
+                rtgs[:, start:i + 1],
+                timesteps[:, start:i + 1])
+            torch.testing.assert_close(action_preds, expected[:, -1], atol=1e-5, rtol=1e-5)
+
+
+def test_interleave_embeddings(decision_transformer):
+
+    embeddings = [torch.full((2, 3, 128), float(i)) for i in range(3)]
+    token_embeddings = decision_transformer.interleave_embeddings(embeddings, 8)
+
+    assert token_embeddings.shape == (2, 8, 128)
+    assert token_embeddings[0, :, 0].tolist() == [0, 1, 2, 0, 1, 2, 0, 1]
+
+
+def test_interleave_embeddings_reuses_buffer(decision_transformer):
+
+    decision_transformer.reuse_token_buffer = True
+    embeddings = [torch.randn((2, 3, 128)) for i in range(3)]
+
+    # gradients need a new tensor every time
+    first = decision_transformer.interleave_embeddings(embeddings, 9)
+    assert decision_transformer.token_buffer is None
+
+    with torch.no_grad():
+        first = decision_transformer.interleave_embeddings(embeddings, 9)
+        buffer = decision_transformer.token_buffer
+        second = decision_transformer.interleave_embeddings(embeddings, 8)
+
+    assert decision_transformer.token_buffer is buffer
+    assert first.data_ptr() == second.data_ptr() == buffer.data_ptr()
+    assert torch.equal(second, first[:, :8])
+    assert torch.equal(second[:, 1], embeddings[1][:, 0])
+
+
+@pytest.mark.parametrize("layer_norm", [False, True])
+@pytest.mark.parametrize("model_class, n_ctx", [(DecisionTransformer, 8), (CloneTransformer, 9)])
+def test_fast_path_matches_hooked_transformer(model_class, n_ctx, layer_norm):
+
+    torch.manual_seed(0)
+    model = model_class(
+        transformer_config=TransformerModelConfig(n_ctx=n_ctx, layer_norm=layer_norm),
+        environment_config=EnvironmentConfig()
+    )
+    states = torch.rand((4, 3, 7, 7, 3))
+    actions = torch.randint(0, 3, (4, 2, 1))
+    rtgs = torch.rand((4, 3, 1))
+    timesteps = torch.randint(0, 50, (4, 3, 1))
+    inputs = (states, actions, rtgs, timesteps) if model_class is DecisionTransformer \
+        else (states, actions, timesteps)
+
+    def run(fast_path):
+        model.zero_grad()
+        model.fast_path = fast_path
+        outputs = model(*inputs)
+        sum(output.sum() for output in outputs).backward()
+        return outputs, [param.grad.clone() for param in model.parameters()
+                         if param.grad is not None]
+
+    hooked_outputs, hooked_grads = run(False)
+    fast_outputs, fast_grads = run(True)
+
+    for fast, hooked in zip(fast_outputs, hooked_outputs):
+        torch.testing.assert_close(fast, hooked, atol=1e-5, rtol=1e-4)
+    assert len(fast_grads) == len(hooked_grads)
+    for fast, hooked in zip(fast_grads, hooked_grads):
+        torch.testing.assert_close(fast, hooked, atol=1e-4, rtol=1e-3)
+
+
+def test_fast_path_shares_parameters_and_skips_hooks():
+
+    torch.manual_seed(0)
+    decision_transformer = DecisionTransformer(
+        transformer_config=TransformerModelConfig(n_ctx=8, fast_path=True),
+        environment_config=EnvironmentConfig()
+    )
+    assert decision_transformer.fast_path
+    parameters = list(decision_transformer.parameters())
+
+    states = torch.rand((2, 3, 7, 7, 3))
+    actions = torch.randint(0, 3, (2, 2, 1))
+    rtgs = torch.rand((2, 3, 1))
+    timesteps = torch.randint(0, 50, (2, 3, 1))
+
+    cache = []
+    decision_transformer.transformer.blocks[0].hook_resid_pre.add_hook(
+        lambda x, hook: cache.append(x))
+    _, fast, _ = decision_transformer(states, actions, rtgs, timesteps)
+    assert cache == []
+
+    # flipping the switch runs (and hooks) the same weights
+    decision_transformer.fast_path = False
+    _, hooked, _ = decision_transformer(states, actions, rtgs, timesteps)
+    assert len(cache) == 1
+    assert all(a is b for a, b in zip(parameters, decision_transformer.parameters()))
+    torch.testing.assert_close(fast, hooked, atol=1e-5, rtol=1e-4)
+
+
+def test_fast_path_caches_fused_qkv():
+
+    torch.manual_seed(0)
+    decision_transformer = DecisionTransformer(
+        transformer_config=TransformerModelConfig(n_ctx=8, fast_path=True),
+        environment_config=EnvironmentConfig()
+    )
+    tokens = torch.randn((2, 8, 128))
+
+    def check_matches_hooked():
+        decision_transformer.fast_path = True
+        fast = decision_transformer.run_transformer(tokens)
+        decision_transformer.fast_path = False
+        hooked = decision_transformer.run_transformer(tokens)
+        torch.testing.assert_close(fast, hooked, atol=1e-5, rtol=1e-4)
+
+    with torch.no_grad():
+        fused_qkv = decision_transformer.get_fused_qkv()
+        assert decision_transformer.get_fused_qkv() is fused_qkv
+
+    # an optimizer step updates the weights in place
+    decision_transformer.run_transformer(tokens).sum().backward()
+    torch.optim.SGD(decision_transformer.parameters(), lr=1e-4).step()
+    with torch.no_grad():
+        assert decision_transformer.get_fused_qkv() is not fused_qkv
+        check_matches_hooked()
+
+        fused_qkv = decision_transformer.get_fused_qkv()
+        other = DecisionTransformer(
+            transformer_config=TransformerModelConfig(n_ctx=8),
+            environment_config=EnvironmentConfig()
+        )
+        decision_transformer.load_state_dict(other.state_dict())
+        assert decision_transformer.fused_qkv is None
+        check_matches_hooked()
+
+
+def test_fast_path_bf16_attention_in_float32():
+
+    torch.manual_seed(0)
+    decision_transformer = DecisionTransformer(
+        transformer_config=TransformerModelConfig(n_ctx=8, fast_path=True),
+        environment_config=EnvironmentConfig()
+    )
+    tokens = torch.randn((2, 8, 128))
+
+    class AttentionDtypes(torch.overrides.TorchFunctionMode):
+        def __init__(self):
+            super().__init__()
+            self.dtypes = []
+
+        def __torch_function__(self, func, types, args=(), kwargs=None):
+            if func is F.scaled_dot_product_attention:
+                self.dtypes.append(args[0].dtype)
+            return func(*args, **(kwargs or {}))
+
+    with torch.autocast("cpu", dtype=torch.bfloat16), AttentionDtypes() as mode:
+        fast = decision_transformer.run_transformer(tokens)
+    assert mode.dtypes == [torch.float32] * decision_transformer.transformer_config.n_layers
+
+    with autocast("bf16", "cpu", decision_transformer):
+        decision_transformer.fast_path = False
+        hooked = decision_transformer.run_transformer(tokens)
+    torch.testing.assert_close(fast.float(), hooked.float(), atol=0.05, rtol=0.05)
+
+
 def test_clone_transformer_get_token_embeddings_with_actions(clone_transformer):
     # Create dummy data for states, actions, rtgs, and timesteps
     state_embeddings = torch.randn((2, 3, 128))
@@ -428,3 +678,40 @@ def test_critic_transformer_forward_seq_too_long(critic_transformer):
             actions=actions,
             timesteps=timesteps,
             pad_action=True)
+
+
+def test_actor_critic_transformer_forward():
+    torch.manual_seed(0)
+    actor_critic = ActorCriticTransformer(
+        transformer_config=TransformerModelConfig(n_ctx=5),
+        environment_config=EnvironmentConfig(),
+        value_trunk_weight=0.5)
+    batch_size = 4
+    seq_length = 3
+
+    states = torch.randn((batch_size, seq_length, 7, 7, 3))
+    actions = torch.randint(
+        0, 4, (batch_size, seq_length - 1, 1)).to(torch.int64)
+    timesteps = torch.ones((batch_size, seq_length)
+                           ).unsqueeze(-1).to(torch.int64)
+
+    action_preds, value_preds = actor_critic(
+        states=states, actions=actions, timesteps=timesteps)
+
+    assert action_preds.shape == (
+        batch_size, seq_length, actor_critic.environment_config.action_space.n)
+    assert value_preds.shape == (batch_size, seq_length, 1)
+
+    # the value loss reaches the trunk scaled by value_trunk_weight
+    def trunk_grad(value_trunk_weight):
+        actor_critic.zero_grad()
+        actor_critic.value_trunk_weight = value_trunk_weight
+        _, value_preds = actor_critic(states=states, actions=actions, timesteps=timesteps)
+        value_preds.sum().backward()
+        return actor_critic.state_embedding.weight.grad.clone(), \
+            actor_critic.value_predictor.weight.grad.clone()
+
+    trunk, head = trunk_grad(1.0)
+    half_trunk, half_head = trunk_grad(0.5)
+    torch.testing.assert_close(half_trunk, trunk * 0.5)
+    torch.testing.assert_close(half_head, head)
@@ -0,0 +1,234 @@
+import json
+import os
+import time
+from dataclasses import dataclass
+
+import numpy as np
+import pytest
+
+from src.trajectory_store import (ColumnarTrajectoryStore,
+                                  StreamingTrajectoryStore,
+                                  get_content_hash, get_observation_dtype,
+                                  get_observation_moments, read_columnar,
+                                  read_stats_cache, write_columnar,
+                                  write_stats_cache)
+from src.utils import TrajectoryWriter
+
+PATH = "tmp/test_trajectory_store.traj"
+
+
+@dataclass
+class DummyConfig:
+    env_id: str = 'MiniGrid-Dynamic-Obstacles-8x8-v0'
+    seed: int = 1
+
+
+def get_data(n_steps=5, n_envs=3):
+    return {
+        "observations": np.arange(n_steps * n_envs * 3).reshape(n_steps, n_envs, 3),
+        "actions": np.ones((n_steps, n_envs), dtype=np.int64),
+        "rewards": np.zeros((n_steps, n_envs)),
+        "dones": np.zeros((n_steps, n_envs), dtype=bool),
+        "truncated": np.ones((n_steps, n_envs), dtype=bool),
+    }
+
+
+def test_write_read_columnar():
+
+    data = get_data()
+    write_columnar(PATH, data, metadata={"args": {"seed": 1}}, chunk_size=2)
+    loaded = read_columnar(PATH)
+
+    for field, array in data.items():
+        assert isinstance(loaded["data"][field], np.memmap)
+        np.testing.assert_array_equal(loaded["data"][field], array)
+    assert loaded["metadata"] == {"args": {"seed": 1}}
+
+
+def test_rewriting_store_removes_stale_metadata():
+
+    write_columnar(PATH, get_data(), metadata={})
+    ColumnarTrajectoryStore(PATH)
+
+    # until the new store is finalized there is nothing to read
+    assert not os.path.exists(os.path.join(PATH, "metadata.json"))
+    with pytest.raises(FileNotFoundError):
+        read_columnar(PATH)
+
+
+def test_non_serializable_metadata_warns():
+
+    with pytest.warns(UserWarning, match="not JSON serializable"):
+        write_columnar(PATH, get_data(), metadata={"space": object()})
+
+    with open(os.path.join(PATH, "metadata.json")) as f:
+        assert isinstance(json.load(f)["metadata"]["space"], str)
+
+
+def test_trajectory_writer_columnar():
+
+    trajectory_writer = TrajectoryWriter(
+        path="tmp/test_trajectory_writer_writer.traj",
+        run_config=DummyConfig(),
+        environment_config=DummyConfig(),
+        online_config=DummyConfig(),
+        transformer_model_config=None,
+        chunk_size=2)
+
+    for i in range(5):
+        trajectory_writer.accumulate_trajectory(
+            next_obs=np.array([1, 2, 3]) * i,
+            reward=np.array([1, 2, 3]),
+            done=np.array([1, 0, 0]),
+            truncated=np.array([1, 0, 0]),
+            action=np.array([1, 2, 3]),
+            info={"a": 1, "b": 2, "c": 3},
+        )
+
+    trajectory_writer.write()
+
+    assert os.path.exists(
+        "tmp/test_trajectory_writer_writer.traj/metadata.json")
+
+    data = read_columnar("tmp/test_trajectory_writer_writer.traj")
+
+    obs = data["data"]["observations"]
+    assert isinstance(obs, np.memmap)
+    assert obs.shape == (5, 3)
+    assert obs.dtype == np.uint8
+    assert obs[4][2] == 12
+
+    assert data["data"]["actions"].dtype == np.int64
+    assert data["data"]["rewards"].dtype == np.float32
+    assert data["metadata"]["dtypes"]["observations"] == "uint8"
+    assert data["data"]["dones"].dtype == bool
+    assert data["data"]["dones"][0][0]
+    assert data["metadata"]["args"]["env_id"] == DummyConfig.env_id
+
+
+def test_streaming_store_flushes_full_chunks():
+
+    data = get_data(n_steps=7)
+    stream = StreamingTrajectoryStore(PATH, chunk_size=2, dtypes={"rewards": np.float32})
+    for i in range(7):
+        stream.append_step(**{field: array[i] for field, array in data.items()})
+
+    # the three full chunks are flushed in the background, the last step stays in memory
+    for _ in range(500):
+        if os.path.exists(os.path.join(PATH, "metadata.json")) and \
+                len(read_columnar(PATH)["data"]["observations"]) == 6:
+            break
+        time.sleep(0.01)
+    partial = read_columnar(PATH)
+    np.testing.assert_array_equal(partial["data"]["observations"], data["observations"][:6])
+
+    stream.last_step()["dones"][:] = True
+    stream.close(metadata={"seed": 1})
+
+    loaded = read_columnar(PATH)
+    assert loaded["metadata"] == {"seed": 1}
+    assert loaded["data"]["rewards"].dtype == np.float32
+    np.testing.assert_array_equal(loaded["data"]["observations"], data["observations"])
+    assert loaded["data"]["dones"][-1].all()
+    assert not loaded["data"]["dones"][:-1].any()
+
+
+def test_trajectory_writer_stream():
+
+    path = "tmp/test_trajectory_writer_stream.traj"
+    trajectory_writer = TrajectoryWriter(
+        path=path,
+        run_config=DummyConfig(),
+        environment_config=DummyConfig(),
+        online_config=DummyConfig(),
+        transformer_model_config=None,
+        chunk_size=2,
+        stream=True)
+
+    for i in range(5):
+        trajectory_writer.accumulate_trajectory(
+            next_obs=np.array([1, 2, 3]) * i,
+            reward=np.array([1, 2, 3]),
+            done=np.array([1, 0, 0]),
+            truncated=np.array([0, 0, 0]),
+            action=np.array([1, 2, 3]),
+            info={"a": 1, "b": 2, "c": 3},
+        )
+
+    # nothing is buffered in python lists
+    assert trajectory_writer.observations == []
+
+    trajectory_writer.tag_terminated_trajectories()
+    trajectory_writer.write()
+
+    data = read_columnar(path)
+    obs = data["data"]["observations"]
+    assert obs.shape == (5, 3)
+    assert obs[4][2] == 12
+    assert data["data"]["truncated"][-1].all()
+    assert not data["data"]["truncated"][:-1].any()
+    assert data["metadata"]["args"]["env_id"] == DummyConfig.env_id
+
+
+def test_trajectory_writer_stream_requires_columnar_path():
+
+    with pytest.raises(ValueError):
+        TrajectoryWriter(
+            path="tmp/test_trajectory_writer_stream.pkl",
+            run_config=DummyConfig(),
+            environment_config=DummyConfig(),
+            online_config=DummyConfig(),
+            stream=True)
+
+
+def test_get_observation_dtype():
+
+    assert get_observation_dtype(np.ones((2, 7, 7, 3))) == np.uint8
+    assert get_observation_dtype(np.ones((2, 7, 7, 20))) == np.uint8
+    assert get_observation_dtype(np.ones((2, 4))) == np.float32
+    # non integer or out of range values are never narrowed
+    assert get_observation_dtype(np.full((2, 7, 7, 3), 0.5)) == np.float32
+    assert get_observation_dtype(np.full((2, 7, 7, 3), 256)) == np.float32
+
+
+def test_get_observation_moments_matches_numpy():
+
+    observations = np.random.RandomState(0).randint(0, 10, size=(3, 11, 2, 4)).astype(np.uint8)
+    count, mean, m2 = get_observation_moments(observations, chunk_size=4)
+
+    assert count == 33
+    np.testing.assert_allclose(mean, observations.reshape(-1, 2, 4).mean(axis=0))
+    np.testing.assert_allclose(np.sqrt(m2 / count), observations.reshape(-1, 2, 4).std(axis=0))
+
+
+def test_stats_cache_is_keyed():
+
+    write_columnar(PATH, get_data(), metadata={})
+    key = get_content_hash(PATH)
+    write_stats_cache(PATH, key, {"traj_lens": np.arange(3)})
+
+    np.testing.assert_array_equal(read_stats_cache(PATH, key)["traj_lens"], np.arange(3))
+    assert read_stats_cache(PATH, key + "_other") is None
+
+    # rewriting the store changes its hash and removes the cache
+    write_columnar(PATH, get_data(n_steps=4), metadata={})
+    assert get_content_hash(PATH) != key
+    assert read_stats_cache(PATH, key) is None
+
+
+def test_content_hash_covers_observations():
+
+    write_columnar(PATH, get_data(), metadata={})
+    key = get_content_hash(PATH)
+    assert get_content_hash(PATH) == key
+
+    # the metadata and every other field are unchanged
+    observations = read_columnar(PATH, mode="r+")["data"]["observations"]
+    observations[0] += 1
+    observations.flush()
+    del observations
+    # file systems with coarse timestamps may not move the mtime in time
+    path = os.path.join(PATH, "observations.bin")
+    os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns + 1))
+
+    assert get_content_hash(PATH) != key
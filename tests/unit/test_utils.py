@@ -100,7 +100,7 @@ def test_trajectory_writer_numpy(environment_config, run_config, online_config):
 
         obs = data["data"]["observations"]
         assert type(obs) == np.ndarray
-        assert obs.dtype == np.float64
+        assert obs.dtype == np.uint8
 
         assert obs[0][0] == 1
         assert obs[0][1] == 2
@@ -108,7 +108,7 @@ def test_trajectory_writer_numpy(environment_config, run_config, online_config):
 
         rewards = data["data"]["rewards"]
         assert type(rewards) == np.ndarray
-        assert rewards.dtype == np.float64
+        assert rewards.dtype == np.float32
 
         assert rewards[0][0] == 1
         assert rewards[0][1] == 2